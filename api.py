@@ -1,41 +1,62 @@
 import uuid
+import asyncio
+import argparse
 import tempfile
 import shutil
 from pathlib import Path
 from typing import Dict, List, Optional
 from datetime import datetime, timezone
 
-from litestar import Litestar, get, post, delete
-from litestar.datastructures import UploadFile
-from litestar.exceptions import HTTPException
-from litestar.status_codes import HTTP_200_OK, HTTP_202_ACCEPTED, HTTP_400_BAD_REQUEST, HTTP_401_UNAUTHORIZED, HTTP_404_NOT_FOUND, HTTP_500_INTERNAL_SERVER_ERROR
-from litestar.params import Body
-from litestar.enums import RequestEncodingType
-from typing import Annotated
+from litestar import Litestar, Request, Response, WebSocket, get, post, delete, websocket
+from litestar.exceptions import HTTPException, WebSocketDisconnect
+from litestar.status_codes import HTTP_200_OK, HTTP_202_ACCEPTED, HTTP_400_BAD_REQUEST, HTTP_401_UNAUTHORIZED, HTTP_404_NOT_FOUND, HTTP_429_TOO_MANY_REQUESTS, HTTP_500_INTERNAL_SERVER_ERROR
 from loguru import logger
 
-from decode import init, load_audio, endless_decode, batch_decode
+from decode import init, load_audio, endless_decode, batch_decode, decode_features, decode_long_form_features
+import hashlib
+import time
 import torch
+from model.utils import metrics, profiling
+from model.utils.autotune import tune_total_batch_duration
+from model.utils.batching import MicroBatcher
 from model.utils.config import config
-
-
-# Global variables to store the model and character dictionary
-model = None
-char_dict = None
+from model.utils.engine import EngineBusyError, create_engine
+from model.utils.features import FBANK_CONF, compute_fbank
+from model.utils.jobs import JobConsumer, JobStore, QueueFullError
+from model.utils.result_cache import ResultCache, cache_key, checkpoint_id
+from model.utils.streaming import StreamingSession
+from model.utils.uploads import UploadDecoder, iter_multipart_files
+
+
+# The inference engine owns the model and the character dictionary and runs
+# every decode call away from the event loop, on its own thread or on
+# forked CPU workers sharing the weights (engine.mode)
+engine = create_engine(config['engine'])
+batcher: Optional[MicroBatcher] = None
+# Long uploads arriving together are decoded as the lock step streams of one encoder batch
+long_form_batcher: Optional[MicroBatcher] = None
+job_store: Optional[JobStore] = None
+job_consumers: List[JobConsumer] = []
+result_cache: Optional[ResultCache] = None
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 # Cache directory configuration
 CACHE_DIR = Path(config['cache']['dir'])
 AUDIO_CACHE_DIR = CACHE_DIR / "audio"
 TSV_CACHE_DIR = CACHE_DIR / "tsv"
-
-# In-memory storage for batch tasks (replace with a database in production)
-task_store: Dict[str, Dict] = {}
+# Uploads of queued batch jobs live here until the job is finished
+JOB_AUDIO_DIR = CACHE_DIR / "jobs"
+JOBS_DB = Path(config['jobs']['path'])
+RESULT_CACHE_DIR = CACHE_DIR / "results"
+AUTOTUNE_PROFILES = CACHE_DIR / "autotune_profiles.json"
+# Profiles recorded between /profile/start and /profile/stop
+PROFILES_DIR = CACHE_DIR / "profiles"
 
 def ensure_cache_directories():
     """Ensure cache directories exist."""
     AUDIO_CACHE_DIR.mkdir(parents=True, exist_ok=True)
     TSV_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    JOB_AUDIO_DIR.mkdir(parents=True, exist_ok=True)
 
 def cleanup_old_cache_files(max_age_hours: int = config['cache']['max_age_hours']):
     """Clean up cache files older than max_age_hours."""
@@ -55,21 +76,92 @@ def cleanup_old_cache_files(max_age_hours: int = config['cache']['max_age_hours'
                         except Exception as e:
                             logger.error(f"Failed to clean up {file_path}: {e}")
 
-def create_temp_audio_file(content: bytes, filename: str) -> Path:
-    """Create a temporary audio file in the cache directory."""
-    file_extension = Path(filename).suffix
-    temp_filename = f"{uuid.uuid4()}{file_extension}"
-    temp_path = AUDIO_CACHE_DIR / temp_filename
-    
-    with open(temp_path, 'wb') as f:
-        f.write(content)
-    
-    return temp_path
+
+def decode_args(**overrides) -> argparse.Namespace:
+    """Build the decoding arguments expected by decode.py from the config."""
+    args = argparse.Namespace(
+        chunk_size=config['model']['chunk_size'],
+        left_context_size=config['model']['left_context_size'],
+        right_context_size=config['model']['right_context_size'],
+        total_batch_duration=config['model']['total_batch_duration'],
+        prefetch_workers=config['model']['prefetch_workers'],
+        prefetch_batches=config['model']['prefetch_batches'],
+        feature_cache=None,
+        output=None,
+        manifest_chunk_rows=100000,
+        num_workers=1,
+        long_form_mode=config['model']['long_form_mode'],
+        max_streams=config['model']['max_streams'],
+        segment_duration=config['model']['segment_duration'],
+        segment_overlap=config['model']['segment_overlap'],
+        vad=config['vad']['detector'] if config['vad']['enabled'] else None,
+        vad_threshold_db=config['vad']['threshold_db'],
+        vad_min_silence=config['vad']['min_silence'],
+        vad_padding=config['vad']['padding'],
+    )
+    for key, value in overrides.items():
+        setattr(args, key, value)
+    return args
+
+def long_form_args(**overrides) -> argparse.Namespace:
+    """Decoding arguments for long uploads, whose encoder calls also run the lookahead of every window."""
+    duration = config['model'].get('long_form_batch_duration', config['model']['total_batch_duration'])
+    return decode_args(**{"total_batch_duration": duration, **overrides})
+
+def init_result_cache() -> Optional[ResultCache]:
+    """Open the transcription result cache, when enabled in the config."""
+    results_config = config['cache']['results']
+    if not results_config['enabled']:
+        return None
+    return ResultCache(RESULT_CACHE_DIR,
+                       max_entries=results_config['memory_entries'],
+                       max_disk_bytes=results_config['disk_max_mb'] * 1024 * 1024)
+
+# decode arguments that change how fast a transcript is produced, not the transcript
+SPEED_ONLY_ARGS = {"prefetch_workers", "prefetch_batches", "feature_cache", "output", "manifest_chunk_rows",
+                   "num_workers", "max_streams"}
+
+def result_key(audio_sha256: str, output: str) -> str:
+    """Cache key of the `output` ("segments" / "text") transcription of an upload."""
+    params = {key: value for key, value in vars(decode_args()).items() if key not in SPEED_ONLY_ARGS}
+    return cache_key(audio_sha256, {
+        **params,
+        "output": output,
+        "checkpoint": checkpoint_id(config['model']['checkpoint']),
+    })
+
+async def run_transcription_batch(feats: List[torch.Tensor]) -> List:
+    """Decode a micro-batch of fbank features collected by the batcher."""
+    return await engine.run(decode_features, feats, decode_args())
+
+async def run_long_form_batch(feats: List[torch.Tensor]) -> List:
+    """Decode long uploads collected by the long form batcher as parallel streams."""
+    return await engine.run(decode_long_form_features, feats, long_form_args())
+
+def create_job_store() -> JobStore:
+    """Open the batch job database described by the `jobs` config section."""
+    return JobStore(
+        JOBS_DB,
+        lease_seconds=config['jobs']['lease_seconds'],
+        max_attempts=config['jobs']['max_attempts'],
+        max_pending=config['jobs']['max_pending'],
+        result_ttl_hours=config['jobs']['result_ttl_hours'],
+    )
+
+def start_job_consumers(store: JobStore, count: int) -> List[JobConsumer]:
+    """Start `count` consumers processing batch jobs on the inference engine."""
+    consumers = []
+    for _ in range(count):
+        consumer = JobConsumer(store, process_batch_job, on_finished=remove_job_files,
+                               poll_interval=config['jobs']['poll_interval'])
+        consumer.start()
+        consumers.append(consumer)
+    return consumers
 
 def startup_handler() -> None:
     """Initialize the model on application startup."""
     import os
-    global model, char_dict
+    global batcher, long_form_batcher, job_store, job_consumers, result_cache
 
     # Avoid heavy initialization in the uvicorn reloader parent process.
     # When uvicorn --reload is used, a parent "reloader" process is created that
@@ -84,6 +176,12 @@ def startup_handler() -> None:
     # Clean up old cache files
     cleanup_old_cache_files()
 
+    # Batch jobs are read from the job database even when no model is loaded
+    job_store = create_job_store()
+    result_cache = init_result_cache()
+
+    engine.start()
+
     if not run_main:
         logger.warning("Detected uvicorn reload parent process; skipping model initialization to prevent semaphore leaks. "
                        "Model will be initialized only in the main worker process.")
@@ -93,153 +191,349 @@ def startup_handler() -> None:
     model_checkpoint = config['model']['checkpoint']
     if not Path(model_checkpoint).is_dir():
         raise FileNotFoundError(f"Model checkpoint directory not found at {model_checkpoint}")
-    model, char_dict = init(model_checkpoint, device)
+    engine.load(init, model_checkpoint, device)
     logger.info(f"Model loaded from {model_checkpoint} on {device}")
 
+    if config['model']['memory_budget_mb']:
+        # measured where the model runs, the results are used by every later decode_args() / long_form_args()
+        config['model']['total_batch_duration'] = engine.submit(
+            tune_total_batch_duration, decode_args(), config['model']['memory_budget_mb'], AUTOTUNE_PROFILES).result()
+        config['model']['long_form_batch_duration'] = engine.submit(
+            tune_total_batch_duration, decode_args(), config['model']['memory_budget_mb'], AUTOTUNE_PROFILES,
+            True).result()
+
+    if config['batching']['enabled']:
+        batcher = MicroBatcher(
+            run_transcription_batch,
+            max_wait_ms=config['batching']['max_wait_ms'],
+            max_batch_duration=config['batching']['max_batch_duration'],
+            max_batch_size=config['batching']['max_batch_size'],
+        )
+        batcher.start()
+        logger.info("Micro-batching enabled for /transcribe_audio/")
+
+    if config['model']['max_streams'] > 1 and config['model']['long_form_mode'] == 'sequential':
+        long_form_batcher = MicroBatcher(
+            run_long_form_batch,
+            max_wait_ms=config['batching']['max_wait_ms'],
+            max_batch_duration=float('inf'),
+            max_batch_size=config['model']['max_streams'],
+        )
+        long_form_batcher.start()
+        logger.info("Up to {} long uploads are decoded together", config['model']['max_streams'])
+
+    job_consumers = start_job_consumers(job_store, config['jobs']['consumers'])
+
+def collect_queue_depths():
+    yield {"queue": "engine"}, engine.qsize()
+    yield {"queue": "batcher"}, batcher.qsize() if batcher is not None else 0
+    yield {"queue": "long_form_batcher"}, long_form_batcher.qsize() if long_form_batcher is not None else 0
+    yield {"queue": "jobs"}, job_store.counts().get("pending", 0) if job_store is not None else 0
+
+def collect_result_cache_stats():
+    if result_cache is not None:
+        for stat, value in result_cache.stats().items():
+            yield {"stat": stat}, value
+
+metrics.QUEUE_DEPTH.set_function(collect_queue_depths)
+metrics.MODEL_LOADED.set_function(lambda: [({}, int(engine.model is not None))])
+metrics.RESULT_CACHE.set_function(collect_result_cache_stats)
+
+async def shutdown_handler() -> None:
+    """Stop the job consumers, the micro-batchers and the inference engine."""
+    global batcher, long_form_batcher, job_consumers
+    for consumer in job_consumers:
+        await consumer.stop()
+    job_consumers = []
+    if batcher is not None:
+        await batcher.stop()
+        batcher = None
+    if long_form_batcher is not None:
+        await long_form_batcher.stop()
+        long_form_batcher = None
+    await asyncio.to_thread(engine.stop)
+
+async def receive_upload(request: Request, field: str) -> Optional[UploadDecoder]:
+    """Receive the `field` file of a multipart request, decoding it while it arrives."""
+    decoder = None
+    receiving = False
+    try:
+        async for event, value in iter_multipart_files(request):
+            if event == "file":
+                receiving = decoder is None and value.name == field and bool(value.filename)
+                if receiving:
+                    decoder = UploadDecoder(value.filename, AUDIO_CACHE_DIR, config['audio']['frame_rate'])
+            elif event == "data" and receiving:
+                await asyncio.to_thread(decoder.feed, value)
+            elif event == "end":
+                receiving = False
+    except BaseException:
+        if decoder is not None:
+            decoder.close()
+        raise
+    return decoder
+
+async def transcribe_upload(decoder: UploadDecoder):
+    """Transcribe a received upload on the inference engine."""
+    start = time.perf_counter()
+    feats = await asyncio.to_thread(decoder.finish)
+    waveform = None
+    if feats is None:
+        # Formats we cannot decode ourselves were spooled to disk for ffmpeg
+        waveform = await asyncio.to_thread(load_audio, str(decoder.spool_path))
+        duration = waveform.shape[-1] / config['audio']['frame_rate']
+    else:
+        duration = feats.shape[0] * FBANK_CONF['frame_shift'] / 1000
+
+    transcription = None
+    if batcher is not None:
+        if feats is None:
+            feats = await asyncio.to_thread(compute_fbank, waveform)
+        # Short clips are decoded together with other concurrent requests
+        if duration <= config['batching']['max_utterance_duration']:
+            transcription = await batcher.submit(feats, duration)
+
+    if transcription is None and long_form_batcher is not None:
+        if feats is None:
+            feats = await asyncio.to_thread(compute_fbank, waveform)
+        transcription = await long_form_batcher.submit(feats, duration)
+
+    if transcription is None:
+        args = long_form_args(long_form_audio=str(decoder.spool_path) if decoder.spool_path else None)
+        transcription = await engine.run(endless_decode, args, waveform=waveform, feats=feats)
+
+    if duration > 0:
+        metrics.REAL_TIME_FACTOR.observe((time.perf_counter() - start) / duration, endpoint="transcribe_audio")
+    return transcription
+
 @post("/transcribe_audio/")
-async def transcribe_file(data: Annotated[UploadFile, Body(media_type=RequestEncodingType.MULTI_PART)]) -> Dict:
-    """Transcribe a single audio file."""
-    if not data.filename:
+async def transcribe_file(request: Request) -> Dict:
+    """Transcribe a single audio file uploaded as the multipart field "data".
+
+    The upload is streamed: WAV and raw PCM are turned into features while
+    the request body is still arriving and other formats are spooled to
+    disk, so the file is never held in memory as a whole.
+    """
+    decoder = await receive_upload(request, "data")
+    if decoder is None:
         raise HTTPException(detail="No file provided", status_code=HTTP_400_BAD_REQUEST)
 
-    tmp_file_path = None
     try:
-        # Save uploaded file to cache directory
-        content = await data.read()
-        tmp_file_path = create_temp_audio_file(content, data.filename)
-
-        # Load and transcribe the audio
-        audio = load_audio(str(tmp_file_path))
-        
-        # Create a dummy args object for endless_decode
-        class Args:
-            long_form_audio = str(tmp_file_path)
-            chunk_size = config['model']['chunk_size']
-            left_context_size = config['model']['left_context_size']
-            right_context_size = config['model']['right_context_size']
-            total_batch_duration = config['model']['total_batch_duration']
-
-        args = Args()
-        
-        # Get the transcription
-        transcription = endless_decode(args, model, char_dict)
-        
-        # Clean up the temporary file
-        tmp_file_path.unlink()
+        if result_cache is None:
+            transcription = await transcribe_upload(decoder)
+        else:
+            # Identical uploads are answered from the cache, concurrent
+            # duplicates share a single decode
+            key = result_key(decoder.digest.hexdigest(), "segments")
+            transcription = await result_cache.get_or_compute(key, lambda: transcribe_upload(decoder))
 
         return {"transcription": transcription, "timestamp": datetime.now(timezone.utc).isoformat()}
 
+    except EngineBusyError as e:
+        raise HTTPException(detail=str(e), status_code=HTTP_429_TOO_MANY_REQUESTS)
     except Exception as e:
-        # Clean up the temporary file in case of error
-        if tmp_file_path and tmp_file_path.exists():
-            tmp_file_path.unlink()
         raise HTTPException(detail=str(e), status_code=HTTP_500_INTERNAL_SERVER_ERROR)
+    finally:
+        decoder.close()
+
+@websocket("/ws/transcribe")
+async def transcribe_stream(socket: WebSocket) -> None:
+    """Transcribe a live audio stream.
+
+    The client sends binary frames of 16-bit little endian mono PCM at
+    `audio.frame_rate` and a text frame "EOS" once the audio is over. The
+    server answers with JSON events: `partial` for the segment that is still
+    open and `segment` for every segment closed by a silence, followed by
+    `{"type": "end"}` after EOS.
+    """
+    await socket.accept()
+    session = StreamingSession(
+        chunk_size=config['model']['chunk_size'],
+        left_context_size=config['model']['left_context_size'],
+        right_context_size=config['model']['right_context_size'],
+        decoding_window=config['streaming']['decoding_window'],
+        lookahead=config['streaming']['lookahead'],
+    )
+    park_after = config['streaming']['park_after']
+    try:
+        while True:
+            try:
+                message = await asyncio.wait_for(socket.receive(), timeout=park_after or None)
+            except asyncio.TimeoutError:
+                # an idle client should not hold device memory until it speaks again
+                await engine.local.run(session.park)
+                message = await socket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("bytes"):
+                events = await engine.local.run(session.accept_pcm16, message["bytes"])
+            elif (message.get("text") or "").strip() == "EOS":
+                for event in await engine.local.run(session.finalize):
+                    await socket.send_json(event)
+                await socket.send_json({"type": "end"})
+                await socket.close()
+                return
+            else:
+                continue
+            for event in events:
+                await socket.send_json(event)
+    except WebSocketDisconnect:
+        return
+    except EngineBusyError as e:
+        await socket.send_json({"type": "error", "detail": str(e)})
+        await socket.close(code=1013)  # try again later
+    except Exception as e:
+        logger.error(f"Streaming transcription failed: {e}")
+        await socket.send_json({"type": "error", "detail": str(e)})
+        await socket.close(code=1011)
 
 @post("/batch-transcribe")
-async def batch_transcribe_files(data: Annotated[List[UploadFile], Body(media_type=RequestEncodingType.MULTI_PART)]) -> Dict:
-    """Transcribe multiple audio files asynchronously."""
-    if not data:
+async def batch_transcribe_files(request: Request) -> Dict:
+    """Queue multiple audio files for asynchronous transcription."""
+    # Uploads are streamed straight into the job directory, so that the job
+    # survives a restart and no file is ever held in memory as a whole
+    task_id = str(uuid.uuid4())
+    job_dir = JOB_AUDIO_DIR / task_id
+    job_dir.mkdir(parents=True, exist_ok=True)
+    files = []
+    out = None
+    try:
+        async for event, value in iter_multipart_files(request):
+            if event == "file":
+                path = job_dir / f"{len(files):04d}_{Path(value.filename or 'audio').name}"
+                out = await asyncio.to_thread(open, path, "wb")
+                digest = hashlib.sha256()
+            elif event == "data":
+                digest.update(value)
+                await asyncio.to_thread(out.write, value)
+            else:
+                await asyncio.to_thread(out.close)
+                out = None
+                files.append({"path": str(path), "filename": value.filename,
+                              "key": result_key(digest.hexdigest(), "text")})
+    except BaseException:
+        if out is not None:
+            out.close()
+        remove_job_files({"dir": str(job_dir)})
+        raise
+
+    if not files:
+        remove_job_files({"dir": str(job_dir)})
         raise HTTPException(detail="No files provided", status_code=HTTP_400_BAD_REQUEST)
 
-    task_id = str(uuid.uuid4())
-    task_store[task_id] = {
-        "status": "pending",
-        "results": [],
-        "errors": [],
-        "last_updated": datetime.now(timezone.utc).isoformat()
-    }
-
-    # In a real application, you would use a task queue like Celery
-    # For this example, we'll process the files in the background
-    import asyncio
-    asyncio.create_task(process_batch_files(task_id, data))
+    try:
+        await asyncio.to_thread(job_store.create, {"dir": str(job_dir), "files": files}, task_id)
+    except QueueFullError as e:
+        remove_job_files({"dir": str(job_dir)})
+        raise HTTPException(detail=str(e), status_code=HTTP_429_TOO_MANY_REQUESTS)
 
-    return {"task_id": task_id, "timestamp": datetime.now(timezone.utc).isoformat()}
+    for consumer in job_consumers:
+        consumer.notify()
 
-async def process_batch_files(task_id: str, files: List[UploadFile]) -> None:
-    """Process batch transcription in the background."""
-    global task_store
-    task_store[task_id]["status"] = "processing"
-    task_store[task_id]["last_updated"] = datetime.now(timezone.utc).isoformat()
+    return {"task_id": task_id, "timestamp": datetime.now(timezone.utc).isoformat()}
 
-    temp_files = []
-    tsv_file_path = None
+def run_batch_job(payload: Dict, model=None, char_dict=None) -> List[Dict]:
+    """Decode the files of a batch job with `batch_decode`; runs on the inference engine."""
+    tsv_file_path = TSV_CACHE_DIR / f"batch_{uuid.uuid4()}.tsv"
     try:
-        # Save uploaded files to cache directory
-        for file in files:
-            content = await file.read()
-            temp_file_path = create_temp_audio_file(content, file.filename)
-            temp_files.append(temp_file_path)
-
-        # Create a TSV file in the cache directory
-        tsv_filename = f"batch_{task_id}.tsv"
-        tsv_file_path = TSV_CACHE_DIR / tsv_filename
-        
-        # Create a dummy args object for batch_decode
-        class Args:
-            audio_list = str(tsv_file_path)
-            chunk_size = config['model']['chunk_size']
-            left_context_size = config['model']['left_context_size']
-            right_context_size = config['model']['right_context_size']
-            total_batch_duration = config['model']['total_batch_duration']
-
-        args = Args()
-        
         # Create TSV file with the paths to the audio files
-        tsv_content = "wav\n" + "\n".join(str(f) for f in temp_files)
+        tsv_content = "wav\n" + "\n".join(f["path"] for f in payload["files"])
         with open(tsv_file_path, "w") as f:
             f.write(tsv_content)
 
-        # Get the transcriptions
+        args = decode_args(audio_list=str(tsv_file_path))
         batch_decode(args, model, char_dict)
 
         # Read the results from the TSV file
         import pandas as pd
         df = pd.read_csv(tsv_file_path, sep="\t")
         results = []
-        for _, row in df.iterrows():
+        for file, (_, row) in zip(payload["files"], df.iterrows()):
             results.append({
-                "filename": Path(row["wav"]).name,
+                "filename": file["filename"] or Path(row["wav"]).name,
                 "transcription": row.get("decode", "")
             })
-        
-        task_store[task_id]["status"] = "completed"
-        task_store[task_id]["results"] = results
-        task_store[task_id]["last_updated"] = datetime.now(timezone.utc).isoformat()
-
-    except Exception as e:
-        task_store[task_id]["status"] = "failed"
-        task_store[task_id]["errors"].append(str(e))
-        task_store[task_id]["last_updated"] = datetime.now(timezone.utc).isoformat()
+        return results
     finally:
-        # Clean up temporary files
-        for tmp_file_path in temp_files:
-            try:
-                if tmp_file_path.exists():
-                    tmp_file_path.unlink()
-            except Exception as cleanup_error:
-                logger.error(f"Failed to clean up {tmp_file_path}: {cleanup_error}")
-        
         # Clean up TSV file
-        if tsv_file_path and tsv_file_path.exists():
+        if tsv_file_path.exists():
             try:
                 tsv_file_path.unlink()
             except Exception as cleanup_error:
                 logger.error(f"Failed to clean up TSV file {tsv_file_path}: {cleanup_error}")
 
+async def process_batch_job(task_id: str, payload: Dict) -> List[Dict]:
+    """Run one claimed batch job, decoding only the files missing from the result cache."""
+    files = payload["files"]
+    transcriptions = {}
+    if result_cache is not None:
+        for file in files:
+            if file["key"] not in transcriptions:
+                cached = await asyncio.to_thread(result_cache.get, file["key"])
+                if cached is not None:
+                    transcriptions[file["key"]] = cached
+
+    # Identical files within the job are decoded once
+    todo = {}
+    for file in files:
+        if file["key"] not in transcriptions:
+            todo.setdefault(file["key"], file)
+    logger.info(f"Processing batch job {task_id} ({len(files)} files, {len(todo)} to decode)")
+
+    if todo:
+        decoded = await engine.run(run_batch_job, {**payload, "files": list(todo.values())})
+        for key, result in zip(todo, decoded):
+            transcriptions[key] = result["transcription"]
+            if result_cache is not None:
+                await asyncio.to_thread(result_cache.put, key, result["transcription"])
+
+    return [{"filename": file["filename"] or Path(file["path"]).name,
+             "transcription": transcriptions[file["key"]]} for file in files]
+
+def remove_job_files(payload: Dict) -> None:
+    """Delete the uploads of a finished batch job."""
+    shutil.rmtree(payload["dir"], ignore_errors=True)
+
+@get("/metrics", sync_to_thread=True)
+def get_metrics() -> Response:
+    """Expose stage timings, audio throughput, queue depths and cache state for Prometheus."""
+    return Response(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@post("/profile/start")
+async def start_profiling() -> Dict:
+    """Start recording per-stage and per-layer timings of every decode."""
+    if profiling.active() is not None:
+        raise HTTPException(detail="Profiling is already running", status_code=HTTP_400_BAD_REQUEST)
+    profiling.start(device)
+    return {"message": "Profiling started", "timestamp": datetime.now(timezone.utc).isoformat()}
+
+@post("/profile/stop")
+async def stop_profiling() -> Dict:
+    """Stop profiling, write the Chrome trace and summaries and return the per-stage summary."""
+    profiler = profiling.stop()
+    if profiler is None:
+        raise HTTPException(detail="Profiling is not running", status_code=HTTP_400_BAD_REQUEST)
+    directory = PROFILES_DIR / datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+    await asyncio.to_thread(profiler.save, directory)
+    return {"directory": str(directory), "stages": profiler.summary(by_stage=True),
+            "timestamp": datetime.now(timezone.utc).isoformat()}
+
 @get("/task-status/{task_id:str}")
 async def get_task_status(task_id: str) -> Dict:
     """Get the status of a batch transcription task."""
-    if task_id not in task_store:
+    task = await asyncio.to_thread(job_store.get, task_id)
+    if task is None:
         raise HTTPException(detail="Task not found", status_code=HTTP_404_NOT_FOUND)
 
-    return {**task_store[task_id], "timestamp": datetime.now(timezone.utc).isoformat()}
+    return {**task, "timestamp": datetime.now(timezone.utc).isoformat()}
 
 @post("/cache/cleanup")
 async def cleanup_cache() -> Dict:
     """Manually trigger cache cleanup."""
     try:
         cleanup_old_cache_files()
+        for payload in await asyncio.to_thread(job_store.expire):
+            remove_job_files(payload)
         return {"message": "Cache cleanup completed successfully", "timestamp": datetime.now(timezone.utc).isoformat()}
     except Exception as e:
         raise HTTPException(detail=f"Cache cleanup failed: {str(e)}", status_code=HTTP_500_INTERNAL_SERVER_ERROR)
@@ -265,6 +559,7 @@ async def get_cache_status() -> Dict:
                     total_size += file_path.stat().st_size
         
         cache_status["total_cache_size_mb"] = round(total_size / (1024 * 1022), 2)
+        cache_status["result_cache"] = result_cache.stats() if result_cache is not None else None
         
         return {**cache_status, "timestamp": datetime.now(timezone.utc).isoformat()}
     except Exception as e:
@@ -285,8 +580,9 @@ def _cleanup_resources():
 atexit.register(_cleanup_resources)
 
 app = Litestar(
-    route_handlers=[transcribe_file, batch_transcribe_files, get_task_status, cleanup_cache, get_cache_status],
+    route_handlers=[transcribe_file, transcribe_stream, batch_transcribe_files, get_task_status, cleanup_cache, get_cache_status, get_metrics, start_profiling, stop_profiling],
     on_startup=[startup_handler],
+    on_shutdown=[shutdown_handler],
     request_max_body_size=100 * 1024 * 1024,  # 100 MB
 )
 
@@ -0,0 +1,57 @@
+import argparse
+import asyncio
+import os
+from pathlib import Path
+
+from loguru import logger
+
+import api
+from decode import init
+from model.utils.config import config
+from model.utils.logging import setup_logger
+
+
+async def consume(num_consumers: int) -> None:
+    store = api.create_job_store()
+    consumers = api.start_job_consumers(store, num_consumers)
+    logger.info(f"Consuming batch jobs from {store.path} with {num_consumers} consumers")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for consumer in consumers:
+            await consumer.stop()
+
+
+def main():
+    """Process /batch-transcribe jobs outside of the API process.
+
+    Any number of workers can run next to the API on the same host (set
+    `jobs.consumers: 0` to keep the API process free of batch work). They
+    must share its local disk: the job database is SQLite in WAL mode,
+    which does not work over network filesystems, and jobs refer to the
+    uploads by their local paths. Jobs held by a worker that is killed are
+    picked up again by another one once their lease expires.
+    """
+    parser = argparse.ArgumentParser(description="Consume batch transcription jobs.")
+    parser.add_argument("--consumers", type=int, default=max(1, config['jobs']['consumers']),
+                        help="Jobs processed concurrently by this worker")
+    args = parser.parse_args()
+
+    setup_logger(os.environ.get("ENV", "development"))
+    model_checkpoint = config['model']['checkpoint']
+    if not Path(model_checkpoint).is_dir():
+        raise FileNotFoundError(f"Model checkpoint directory not found at {model_checkpoint}")
+    api.ensure_cache_directories()
+    api.result_cache = api.init_result_cache()
+    api.engine.load(init, model_checkpoint, api.device)
+    logger.info(f"Model loaded from {model_checkpoint} on {api.device}")
+    try:
+        asyncio.run(consume(args.consumers))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        api.engine.stop()
+
+
+if __name__ == "__main__":
+    main()
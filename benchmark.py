@@ -0,0 +1,227 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+import yaml
+
+from model.utils.autotune import memory_mb, reset_peak_memory
+from model.utils.batch_plan import duration_to_frames, num_chunks, plan_batches
+from model.utils.ctc_utils import get_output
+from model.utils.features import compute_fbank
+from model.utils.init_model import init_model
+from model.utils.presets import MODEL_PRESETS
+
+
+DTYPES = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def build_model(args):
+    """Random-weight model from a preset or a checkpoint config, or the real checkpoint."""
+    if args.model_checkpoint:
+        from decode import init
+        return init(args.model_checkpoint, torch.device(args.device))
+    if args.model_config:
+        with open(args.model_config) as f:
+            configs = yaml.safe_load(f)
+    else:
+        configs = MODEL_PRESETS[args.preset]
+    configs = dict(configs, input_dim=80, cmvn_file=None, is_json_cmvn=True)
+    torch.manual_seed(0)
+    model = init_model(configs, None)
+    model.eval()
+    model.to(args.device)
+    char_dict = {i: chr(ord('a') + i % 26) for i in range(configs['output_dim'])}
+    return model, char_dict
+
+
+def synthetic_features(durations, seed: int = 0):
+    """fbank features of noise utterances of the given durations (seconds)."""
+    rng = np.random.default_rng(seed)
+    feats = []
+    for duration in durations:
+        waveform = rng.standard_normal(int(duration * 16000)).astype(np.float32) * 3000
+        feats.append(compute_fbank(torch.from_numpy(waveform).unsqueeze(0)))
+    return feats
+
+
+def percentiles(values):
+    values = np.asarray(values) * 1000
+    return {"p50": round(float(np.percentile(values, 50)), 2),
+            "p90": round(float(np.percentile(values, 90)), 2),
+            "p99": round(float(np.percentile(values, 99)), 2),
+            "max": round(float(values.max()), 2)}
+
+
+@torch.no_grad()
+def run_config(model, char_dict, feats, durations, chunk_size, left_context_size, right_context_size,
+               total_batch_duration, dtype, threads, device, repeats=1):
+    """Decode `feats` the way batch_decode does and measure it."""
+    torch.set_num_threads(threads)
+    encoder = model.encoder
+    subsampling = encoder.embed.subsampling_factor
+    context = encoder.embed.right_context + 1
+    max_frames = int(total_batch_duration // 0.01) // 2
+    max_chunks = max(1, max_frames // chunk_size // subsampling)
+    batches = plan_batches(durations, max_chunks, chunk_size, subsampling, context)
+
+    def decode_batch(batch):
+        xs = [feats[i] for i in batch]
+        xs_origin_lens = torch.tensor([x.shape[0] for x in xs], dtype=torch.int, device=device)
+        offset = torch.zeros(len(xs), dtype=torch.int, device=device)
+        with torch.autocast(device.type, DTYPES[dtype]) if DTYPES[dtype] is not None else nullcontext():
+            encoder_outs, encoder_lens, n_chunks, _, _, _ = encoder.forward_parallel_chunk(
+                xs=xs, xs_origin_lens=xs_origin_lens, chunk_size=chunk_size,
+                left_context_size=left_context_size, right_context_size=right_context_size, offset=offset)
+            hyps = encoder.ctc_forward(encoder_outs, encoder_lens, n_chunks)
+        get_output(hyps, char_dict)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    decode_batch(batches[0])  # warm up
+    reset_peak_memory(device)
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for batch in batches:
+            batch_start = time.perf_counter()
+            decode_batch(batch)
+            latencies.append(time.perf_counter() - batch_start)
+    wall_time = time.perf_counter() - start
+
+    audio_seconds = sum(durations) * repeats
+    chunks = sum(num_chunks(duration_to_frames(d), chunk_size, subsampling, context) for d in durations)
+    frames_per_chunk = chunk_size * subsampling
+    return {
+        "chunk_size": chunk_size,
+        "left_context_size": left_context_size,
+        "right_context_size": right_context_size,
+        "total_batch_duration": total_batch_duration,
+        "dtype": dtype,
+        "threads": threads,
+        "utterances": len(durations) * repeats,
+        "batches": len(batches) * repeats,
+        "audio_seconds": round(audio_seconds, 2),
+        "wall_seconds": round(wall_time, 4),
+        "real_time_factor": round(wall_time / audio_seconds, 5),
+        "throughput_x_real_time": round(audio_seconds / wall_time, 2),
+        "batch_latency_ms": percentiles(latencies),
+        "padded_fraction": round(1 - sum(duration_to_frames(d) for d in durations) / (chunks * frames_per_chunk), 4),
+        "peak_memory_mb": round(memory_mb(device, peak=True), 1),
+    }
+
+
+def environment(device):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "device": str(device),
+        "git_commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def run_benchmark(args):
+    """Sweep every combination of the listed settings; returns the JSON report."""
+    device = torch.device(args.device)
+    model, char_dict = build_model(args)
+    rng = np.random.default_rng(args.seed)
+    # utterances of the requested durations, jittered by up to 10% so batches hold a realistic mix
+    durations = [round(float(d * rng.uniform(0.9, 1.1)), 2)
+                 for d in args.durations for _ in range(args.utterances_per_duration)]
+    feats = synthetic_features(durations, args.seed)
+
+    results = []
+    for chunk_size, left, right, batch_duration, dtype, threads in itertools.product(
+            args.chunk_sizes, args.left_context_sizes, args.right_context_sizes,
+            args.total_batch_durations, args.dtypes, args.threads):
+        try:
+            result = run_config(model, char_dict, feats, durations, chunk_size, left, right,
+                                batch_duration, dtype, threads, device, args.repeats)
+        except RuntimeError as e:
+            # e.g. an autocast dtype the device does not support
+            result = {"chunk_size": chunk_size, "left_context_size": left, "right_context_size": right,
+                      "total_batch_duration": batch_duration, "dtype": dtype, "threads": threads,
+                      "error": str(e).splitlines()[0]}
+        results.append(result)
+        print(json.dumps(result), file=sys.stderr)
+
+    encoder = model.encoder
+    return {
+        "environment": environment(device),
+        "model": {
+            "source": args.model_checkpoint or args.model_config or f"preset:{args.preset}",
+            "num_blocks": encoder.num_blocks,
+            "output_size": encoder._output_size,
+            "attention_heads": encoder.attention_heads,
+            "parameters": sum(p.numel() for p in model.parameters()),
+        },
+        "durations": durations,
+        "results": results,
+    }
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def float_list(value):
+    return [float(v) for v in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ChunkFormer batch inference on synthetic audio.")
+    parser.add_argument("--preset", choices=sorted(MODEL_PRESETS), default="tiny",
+                        help="Random-weight model to benchmark (default: tiny)")
+    parser.add_argument("--model_config", type=str, default=None,
+                        help="config.yaml of a checkpoint, benchmarked with random weights instead of a preset")
+    parser.add_argument("--model_checkpoint", type=str, default=None,
+                        help="Checkpoint directory, benchmarked with its real weights instead of a preset")
+    parser.add_argument("--device", type=str, default="cpu", help="Device to run on (default: cpu)")
+    parser.add_argument("--durations", type=float_list, default=[2.0, 8.0, 30.0],
+                        help="Comma separated utterance durations in seconds (default: 2,8,30)")
+    parser.add_argument("--utterances_per_duration", type=int, default=8,
+                        help="Synthetic utterances generated for each duration (default: 8)")
+    parser.add_argument("--chunk_sizes", type=int_list, default=[64], help="Comma separated (default: 64)")
+    parser.add_argument("--left_context_sizes", type=int_list, default=[128], help="Comma separated (default: 128)")
+    parser.add_argument("--right_context_sizes", type=int_list, default=[128], help="Comma separated (default: 128)")
+    parser.add_argument("--total_batch_durations", type=int_list, default=[1800],
+                        help="Comma separated, in seconds (default: 1800)")
+    parser.add_argument("--dtypes", type=lambda v: v.split(","), default=["fp32"],
+                        help=f"Comma separated autocast dtypes among {','.join(DTYPES)} (default: fp32)")
+    parser.add_argument("--threads", type=int_list, default=[torch.get_num_threads()],
+                        help=f"Comma separated torch thread counts (default: {torch.get_num_threads()})")
+    parser.add_argument("--repeats", type=int, default=1, help="Passes over the utterances per setting (default: 1)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="JSON report file (default: stdout)")
+    args = parser.parse_args()
+    for dtype in args.dtypes:
+        if dtype not in DTYPES:
+            parser.error(f"unknown dtype {dtype}")
+
+    report = run_benchmark(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
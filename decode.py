@@ -1,19 +1,34 @@
 import os
 import torch
 import torchaudio
+import torch.distributed as dist
 import yaml
-import jiwer
 import argparse
+import time
 import pandas as pd
+import jiwer
 
 from tqdm import tqdm
+from collections import deque
 from colorama import Fore, Style
 
-import torchaudio.compliance.kaldi as kaldi
 from model.utils.init_model import init_model
 from model.utils.checkpoint import load_checkpoint
 from model.utils.file_utils import read_symbol_table
-from model.utils.ctc_utils import get_output_with_timestamps, get_output
+from model.utils.ctc_utils import CTCSegmenter, get_output_with_timestamps, get_output
+from model.utils import metrics, profiling
+from model.utils.audio import iter_audio_blocks, read_audio_file
+from model.utils.batch_plan import plan_batches, probe_duration
+from model.utils.batch_output import ResultWriter, WerCounter, merge_outputs, rank_output_path
+from model.utils.feature_store import FeatureStore
+from model.utils.features import FbankStream, compute_fbank
+from model.utils.pipeline import BatchPipeline
+from model.utils.engine import ProcessInferenceEngine
+from model.utils.autotune import tune_total_batch_duration
+from model.utils.vad import FRAMES_PER_SECOND, collapse, expand_hyps, load_detector, speech_regions
+from model.utils.long_form import frame_agreement, plan_segments, stitch_hyps
+from model.utils.multi_stream import MultiStreamDecoder, window_size
+from model.utils.wavefront import WavefrontDecoder, layer_lookahead, wavefront_window
 from contextlib import nullcontext
 from pydub import AudioSegment
 
@@ -40,147 +55,548 @@ def init(model_checkpoint, device):
     return model, char_dict
 
 def load_audio(audio_path):
-    audio = AudioSegment.from_file(audio_path)
-    audio = audio.set_frame_rate(16000)
-    audio = audio.set_sample_width(2)  # set bit depth to 16bit
-    audio = audio.set_channels(1)  # set to mono
-    audio = torch.as_tensor(audio.get_array_of_samples(), dtype=torch.float32).unsqueeze(0)
+    with metrics.stage("load_audio"):
+        # WAV and FLAC are decoded in-process, ffmpeg is only spawned for other containers
+        audio = read_audio_file(audio_path)
+        if audio is not None:
+            return audio
+        audio = AudioSegment.from_file(audio_path)
+        audio = audio.set_frame_rate(16000)
+        audio = audio.set_sample_width(2)  # set bit depth to 16bit
+        audio = audio.set_channels(1)  # set to mono
+        audio = torch.as_tensor(audio.get_array_of_samples(), dtype=torch.float32).unsqueeze(0)
     return audio
 
 @torch.no_grad()
-def endless_decode(args, model, char_dict):    
-    def get_max_input_context(c, r, n):
-        return r + max(c, r) * (n-1)
-    
-    device = next(model.parameters()).device
+def endless_decode(args, model, char_dict, waveform=None, feats=None):
     audio_path = args.long_form_audio
-    # model configuration
     subsampling_factor = model.encoder.embed.subsampling_factor
-    chunk_size = args.chunk_size
-    left_context_size = args.left_context_size
-    right_context_size = args.right_context_size
-    conv_lorder = model.encoder.cnn_module_kernel // 2
+    if getattr(args, "stream_audio", False) and waveform is None and feats is None:
+        return stream_decode(args, model, char_dict)
+
+    if feats is None:
+        if waveform is None:
+            waveform = load_audio(audio_path)
+        # waveform = padding(waveform, sample_rate)
+        feats = compute_fbank(waveform)
+
+    feats, regions, num_frames = skip_non_speech(feats, args, model)
+    metrics.AUDIO_SECONDS.inc(feats.shape[0] / 100, entrypoint="endless_decode")
+
+    if getattr(args, "long_form_mode", "sequential") == "parallel":
+        start_time = time.perf_counter()
+        hyps = parallel_hyps(feats, args, model, char_dict)
+        if getattr(args, "compare_sequential", False):
+            parallel_time = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            reference = sequential_hyps(feats, args, model)
+            report_agreement(hyps, reference, char_dict, parallel_time, time.perf_counter() - start_time)
+    elif getattr(args, "long_form_mode", "sequential") == "wavefront":
+        hyps = wavefront_hyps(feats, args, model)
+    else:
+        hyps = sequential_hyps(feats, args, model)
+    if regions is not None:
+        # skipped silences become blank frames again, for timestamps in original time
+        hyps = expand_hyps(hyps, regions, subsampling_factor, num_frames)
+    with metrics.stage("get_output_with_timestamps"):
+        decode = get_output_with_timestamps([hyps], char_dict)[0]
 
-    # get the maximum length that the gpu can consume
-    max_length_limited_context = args.total_batch_duration
-    max_length_limited_context = int((max_length_limited_context // 0.01))//2 # in 10ms second
+    for item in decode:
+        start = f"{Fore.RED}{item['start']}{Style.RESET_ALL}"
+        end = f"{Fore.RED}{item['end']}{Style.RESET_ALL}"
+        print(f"{start} - {end}: {item['decode']}")
+    return decode
 
-    multiply_n = max_length_limited_context // chunk_size // subsampling_factor
-    truncated_context_size = chunk_size * multiply_n # we only keep this part for text decoding
 
-    # get the relative right context size
-    rel_right_context_size = get_max_input_context(chunk_size, max(right_context_size, conv_lorder), model.encoder.num_blocks)
-    rel_right_context_size = rel_right_context_size * subsampling_factor
+@torch.no_grad()
+def stream_decode(args, model, char_dict):
+    """Decode `long_form_audio` while it is being read, in memory bounded by the window size.
+
+    The audio is read block by block and its features are computed as it
+    arrives. Each window is decoded as soon as its features and those of
+    its right context are there, and the segments it closes are printed
+    right away. The transcript is the same as decoding the whole file in
+    the same mode.
+    """
+    if getattr(args, "long_form_mode", "sequential") == "wavefront":
+        decoder = create_wavefront_decoder(args, model)
+        accept, finish = decoder.accept, decoder.finalize
+    else:
+        subsampling_factor = model.encoder.embed.subsampling_factor
+        window = window_size(args.total_batch_duration, args.chunk_size, subsampling_factor)
+        decoder = MultiStreamDecoder(model, args.chunk_size, args.left_context_size, args.right_context_size,
+                                     window=window, max_streams=1)
+        stream_id = decoder.open()
+
+        def accept(feats):
+            decoder.extend(stream_id, feats)
+            tokens = []
+            while True:
+                decoder.step()
+                tokens.append(decoder.pop_tokens(stream_id))
+                if tokens[-1].numel() == 0:
+                    return torch.cat(tokens)
+
+        def finish():
+            decoder.close(stream_id)
+            return decoder.run()[stream_id]
+
+    fbank = FbankStream()
+    segmenter = CTCSegmenter(char_dict)
+    decode = []
+
+    def emit(segments):
+        for item in segments:
+            start = f"{Fore.RED}{item['start']}{Style.RESET_ALL}"
+            end = f"{Fore.RED}{item['end']}{Style.RESET_ALL}"
+            print(f"{start} - {end}: {item['decode']}")
+        decode.extend(segments)
+
+    for waveform in iter_audio_blocks(args.long_form_audio, args.stream_block_duration):
+        feats = fbank.accept_waveform(waveform)
+        if feats is None:
+            continue
+        metrics.AUDIO_SECONDS.inc(feats.shape[0] / 100, entrypoint="endless_decode")
+        emit(segmenter.accept(accept(feats)))
+    emit(segmenter.accept(finish()))
+    emit(segmenter.finalize())
+    return decode
+
+
+def skip_non_speech(feats, args, model):
+    """With a VAD, only the speech regions go through the encoder.
+
+    Returns the features to decode, the speech regions (None without a VAD)
+    and the encoder frames of the original recording, for `expand_hyps`.
+    Recordings too short for a single encoder frame are left as they are.
+    """
+    if not getattr(args, "vad", None) or feats.shape[0] < model.encoder.embed.right_context + 1:
+        return feats, None, None
+    subsampling_factor = model.encoder.embed.subsampling_factor
+    with metrics.stage("vad"):
+        detector = load_detector(args.vad, args.vad_threshold_db)
+        regions = speech_regions(detector(feats),
+                                 min_silence=int(args.vad_min_silence * FRAMES_PER_SECOND),
+                                 padding=int(args.vad_padding * FRAMES_PER_SECOND),
+                                 align=subsampling_factor)
+    num_frames = int(model.encoder.embed.calc_length(torch.tensor([feats.shape[0]])))
+    speech_frames = sum(end - start for start, end in regions)
+    metrics.VAD_SKIPPED_SECONDS.inc((feats.shape[0] - speech_frames) / FRAMES_PER_SECOND)
+    return collapse(feats, regions), regions, num_frames
 
 
-    waveform = load_audio(audio_path)
-    offset = torch.zeros(1, dtype=torch.int, device=device)
+@torch.no_grad()
+def sequential_hyps(feats, args, model):
+    """Greedy CTC tokens of a long recording, decoded window after window with attention / conv caches."""
+    subsampling_factor = model.encoder.embed.subsampling_factor
+    # half of total_batch_duration is kept per window, the rest is its right context
+    window = window_size(args.total_batch_duration, args.chunk_size, subsampling_factor)
+    decoder = MultiStreamDecoder(model, args.chunk_size, args.left_context_size, args.right_context_size,
+                                 window=window, max_streams=1)
+    decoder.add(feats)
+    hyps = {}
+    with tqdm(total=decoder.num_windows(feats.shape[0])) as progress:
+        while decoder.pending:
+            hyps.update(decoder.step())
+            progress.update()
+    return hyps[0]
+
+
+def create_wavefront_decoder(args, model):
+    """`WavefrontDecoder` whose layer calls, window plus lookahead, fill `total_batch_duration`."""
+    subsampling_factor = model.encoder.embed.subsampling_factor
+    lookahead = layer_lookahead(model, args.chunk_size, args.right_context_size)
+    window = wavefront_window(args.total_batch_duration, args.chunk_size, subsampling_factor, lookahead)
+    return WavefrontDecoder(model, args.chunk_size, args.left_context_size, args.right_context_size, window=window)
 
-    # waveform = padding(waveform, sample_rate)
-    xs = kaldi.fbank(waveform,
-                            num_mel_bins=80,
-                            frame_length=25,
-                            frame_shift=10,
-                            dither=0.0,
-                            energy_floor=0.0,
-                            sample_frequency=16000).unsqueeze(0)
 
-    hyps = []
-    att_cache = torch.zeros((model.encoder.num_blocks, left_context_size, model.encoder.attention_heads, model.encoder._output_size * 2 // model.encoder.attention_heads)).to(device)
-    cnn_cache = torch.zeros((model.encoder.num_blocks, model.encoder._output_size, conv_lorder)).to(device)    # print(context_size)
-    for idx, _ in tqdm(list(enumerate(range(0, xs.shape[1], truncated_context_size * subsampling_factor)))):
-        start = max(truncated_context_size * subsampling_factor * idx, 0)
-        end = min(truncated_context_size * subsampling_factor * (idx+1) + 7, xs.shape[1])
-
-        x = xs[:, start:end+rel_right_context_size]
-        x_len = torch.tensor([x[0].shape[0]], dtype=torch.int).to(device)
-
-        encoder_outs, encoder_lens, _, att_cache, cnn_cache, offset = model.encoder.forward_parallel_chunk(xs=x, 
-                                                                    xs_origin_lens=x_len, 
-                                                                    chunk_size=chunk_size,
-                                                                    left_context_size=left_context_size,
-                                                                    right_context_size=right_context_size,
-                                                                    att_cache=att_cache,
-                                                                    cnn_cache=cnn_cache,
-                                                                    truncated_context_size=truncated_context_size,
-                                                                    offset=offset
-                                                                    )
-        encoder_outs = encoder_outs.reshape(1, -1, encoder_outs.shape[-1])[:, :encoder_lens]
-        if chunk_size * multiply_n * subsampling_factor * idx + rel_right_context_size < xs.shape[1]:
-            encoder_outs = encoder_outs[:, :truncated_context_size]  # (B, maxlen, vocab_size) # exclude the output of rel right context
-        offset = offset - encoder_lens + encoder_outs.shape[1]
+@torch.no_grad()
+def wavefront_hyps(feats, args, model):
+    """Greedy CTC tokens of a long recording, encoded layer by layer without recomputing the lookahead."""
+    decoder = create_wavefront_decoder(args, model)
+    hyps = [decoder.accept(piece) for piece in tqdm(feats.split(decoder.fbank_step))]
+    hyps.append(decoder.finalize())
+    return torch.cat(hyps)
 
 
-        hyp = model.encoder.ctc_forward(encoder_outs).squeeze(0)
+@torch.no_grad()
+def decode_long_form_features(feats_list, args, model, char_dict):
+    """Decode several long recordings together, as the lock step streams of a `MultiStreamDecoder`.
+
+    Up to `max_streams` recordings share each encoder call, every one with
+    a window of `total_batch_duration / max_streams`. Returns one list of
+    timestamped segments per recording, in the same format as
+    `endless_decode`.
+    """
+    subsampling_factor = model.encoder.embed.subsampling_factor
+    max_streams = max(1, min(args.max_streams, len(feats_list)))
+    window = window_size(args.total_batch_duration, args.chunk_size, subsampling_factor, max_streams)
+    decoder = MultiStreamDecoder(model, args.chunk_size, args.left_context_size, args.right_context_size,
+                                 window=window, max_streams=max_streams)
+    streams = []
+    for feats in feats_list:
+        feats, regions, num_frames = skip_non_speech(feats, args, model)
+        metrics.AUDIO_SECONDS.inc(feats.shape[0] / 100, entrypoint="decode_long_form_features")
+        streams.append((decoder.add(feats), regions, num_frames))
+
+    results = {}
+    with tqdm(total=len(streams)) as progress:
+        while decoder.pending:
+            finished = decoder.step()
+            results.update(finished)
+            progress.update(len(finished))
+
+    hyps = []
+    for stream_id, regions, num_frames in streams:
+        hyp = results[stream_id]
+        if regions is not None:
+            hyp = expand_hyps(hyp, regions, subsampling_factor, num_frames)
         hyps.append(hyp)
-        if device.type == "cuda":
-            torch.cuda.empty_cache()
-        if chunk_size * multiply_n * subsampling_factor * idx + rel_right_context_size >= xs.shape[1]:
-            break
-    hyps = torch.cat(hyps)
-    decode = get_output_with_timestamps([hyps], char_dict)[0]
+    with metrics.stage("get_output_with_timestamps"):
+        return get_output_with_timestamps(hyps, char_dict)
+
+
+def decode_long_form_files(audio_paths, args, model, char_dict):
+    """Decode several long audio files with `decode_long_form_features` and print their segments.
+
+    Only the sequential mode decodes recordings in lock step; in the other
+    modes the files are decoded one after another with `endless_decode`.
+    """
+    if getattr(args, "long_form_mode", "sequential") != "sequential":
+        decodes = []
+        for audio_path in audio_paths:
+            print(f"{Fore.GREEN}{audio_path}{Style.RESET_ALL}")
+            decodes.append(endless_decode(argparse.Namespace(**{**vars(args), "long_form_audio": audio_path}),
+                                          model, char_dict))
+        return decodes
+    feats_list = []
+    for audio_path in audio_paths:
+        waveform = load_audio(audio_path)
+        with metrics.stage("fbank"):
+            feats_list.append(compute_fbank(waveform))
+    decodes = decode_long_form_features(feats_list, args, model, char_dict)
+    for audio_path, decode in zip(audio_paths, decodes):
+        print(f"{Fore.GREEN}{audio_path}{Style.RESET_ALL}")
+        for item in decode:
+            start = f"{Fore.RED}{item['start']}{Style.RESET_ALL}"
+            end = f"{Fore.RED}{item['end']}{Style.RESET_ALL}"
+            print(f"{start} - {end}: {item['decode']}")
+    return decodes
 
-    for item in decode:
-        start = f"{Fore.RED}{item['start']}{Style.RESET_ALL}"
-        end = f"{Fore.RED}{item['end']}{Style.RESET_ALL}"
-        print(f"{start} - {end}: {item['decode']}")
+
+@torch.no_grad()
+def parallel_hyps(feats, args, model, char_dict):
+    """Greedy CTC tokens of a long recording, decoded as overlapping segments in parallel.
+
+    The recording is cut into `segment_duration` segments, preferably in
+    pauses, that overlap by `segment_overlap` seconds. The segments are
+    decoded as independent utterances, in batches of `total_batch_duration`
+    or on `num_workers` processes, and their tokens are stitched back
+    together in the overlaps. Unlike `sequential_hyps`, nothing is carried
+    from one segment to the next, so the result can differ close to the cuts.
+    """
+    subsampling_factor = model.encoder.embed.subsampling_factor
+    context = model.encoder.embed.right_context + 1
+    if feats.shape[0] < context:
+        # not a single encoder frame, e.g. a recording the VAD found no speech in
+        return torch.zeros(0, dtype=torch.long)
+    cuts, segments = plan_segments(feats, int(args.segment_duration * FRAMES_PER_SECOND),
+                                   int(args.segment_overlap * FRAMES_PER_SECOND), align=subsampling_factor)
+    xs = [feats[start:end] for start, end in segments]
+
+    max_frames = int(args.total_batch_duration // 0.01) // 2
+    max_chunks = max(1, max_frames // args.chunk_size // subsampling_factor)
+    batches = plan_batches([x.shape[0] / FRAMES_PER_SECOND for x in xs], max_chunks, args.chunk_size,
+                           subsampling_factor, context)
+
+    segment_hyps = [None] * len(xs)
+    num_workers = getattr(args, "num_workers", 1)
+    if num_workers > 1 and len(batches) > 1:
+        assert next(model.parameters()).device.type == "cpu", "`num_workers` is for CPU decoding"
+        engine = ProcessInferenceEngine(max_queue_size=len(batches), num_workers=num_workers,
+                                        threads_per_worker=args.threads_per_worker, pin_cpus=args.pin_cpus,
+                                        name="parallel-decode")
+        engine.load(lambda: (model, char_dict))
+        try:
+            futures = [(batch, engine.submit(encode_segments_job, [xs[i] for i in batch], args)) for batch in batches]
+            for batch, future in futures:
+                for i, hyp in zip(batch, future.result()):
+                    segment_hyps[i] = hyp
+        finally:
+            engine.stop()
+    else:
+        for batch in tqdm(batches):
+            for i, hyp in zip(batch, encode_features([xs[i] for i in batch], args, model, entrypoint=None)):
+                segment_hyps[i] = hyp
+
+    num_frames = int(model.encoder.embed.calc_length(torch.tensor([feats.shape[0]])))
+    return stitch_hyps(segment_hyps, segments, cuts, subsampling_factor, num_frames)
 
 
 @torch.no_grad()
-def batch_decode(args, model, char_dict):
-    df = pd.read_csv(args.audio_list, sep="\t")
+def encode_segments_job(xs, args, model=None, char_dict=None):
+    """Greedy CTC tokens of a batch of segments; runs on a `ProcessInferenceEngine` worker."""
+    return encode_features(xs, args, model, entrypoint=None)
+
+
+def report_agreement(hyps, reference, char_dict, parallel_time, sequential_time):
+    """Print how far the parallel decoding of a recording is from the sequential one."""
+    text, reference_text = get_output([hyps, reference], char_dict)
+    agreement = frame_agreement(hyps, reference)
+    wer = jiwer.wer(reference_text, text) if reference_text.strip() else float(text.strip() != "")
+    print(f"Agreement with sequential decoding: {agreement:.2%} of frames, WER {wer:.4f} "
+          f"(parallel {parallel_time:.1f}s, sequential {sequential_time:.1f}s)")
+    return agreement, wer
+
+
+@torch.no_grad()
+def decode_waveforms(waveforms, args, model, char_dict):
+    """Decode several short waveforms in a single forward_parallel_chunk call.
+
+    Returns one list of timestamped segments per waveform, in the same
+    format as `endless_decode`.
+    """
+    return decode_features([compute_fbank(waveform) for waveform in waveforms], args, model, char_dict)
+
+
+@torch.no_grad()
+def decode_features(xs, args, model, char_dict):
+    """Same as `decode_waveforms`, for already computed (T, 80) fbank features."""
+    hyps = encode_features(xs, args, model, entrypoint="decode_features")
+    with metrics.stage("get_output_with_timestamps"):
+        return get_output_with_timestamps(hyps, char_dict)
 
+
+@torch.no_grad()
+def batch_decode(args, model, char_dict):
     max_length_limited_context = args.total_batch_duration
-    max_length_limited_context = int((max_length_limited_context // 0.01)) // 2 # in 10ms second    xs = []
-    max_frames = max_length_limited_context
-    chunk_size = args.chunk_size
-    left_context_size = args.left_context_size
-    right_context_size = args.right_context_size
+    max_length_limited_context = int((max_length_limited_context // 0.01)) // 2 # in 10ms second
+    feature_store = FeatureStore(args.feature_cache, args.feature_cache_dtype) if args.feature_cache else None
+    # under torch.distributed, every rank decodes the rows `row % world_size == rank`
+    distributed = dist.is_available() and dist.is_initialized()
+    rank, world_size = (dist.get_rank(), dist.get_world_size()) if distributed else (0, 1)
+    output_path = args.output
+    if args.output and distributed:
+        output_path = rank_output_path(args.output, rank, world_size)
+    writer = ResultWriter(output_path) if output_path else None
+    wer = WerCounter()
+
+    # with --output, the rows found in it were decoded by a previous run
+    done = set()
+    if writer is not None:
+        references, hypotheses = [], []
+        for record in writer.resume():
+            done.add(record["row"])
+            if "txt" in record:
+                references.append(record["txt"])
+                hypotheses.append(record["decode"])
+        wer.update(references, hypotheses)
+        if done:
+            print(f"Resuming: {len(done)} rows already decoded in {output_path}")
+
+    engine = None
+    if args.num_workers > 1:
+        assert next(model.parameters()).device.type == "cpu", "`num_workers` is for CPU decoding"
+        # one copy of the weights in shared memory, num_workers narrow replicas using it
+        engine = ProcessInferenceEngine(max_queue_size=2 * args.num_workers,
+                                        num_workers=args.num_workers,
+                                        threads_per_worker=args.threads_per_worker,
+                                        pin_cpus=args.pin_cpus,
+                                        name="batch-decode")
+        engine.load(lambda: (model, char_dict))
+
+    decodes = {}
+    stats, wall_time = None, 0.0
+    start_time = time.perf_counter()
+    progress = tqdm()
+    try:
+        # the manifest is read piece by piece, each piece is planned and decoded on its own
+        for rows in pd.read_csv(args.audio_list, sep="\t", chunksize=args.manifest_chunk_rows,
+                                dtype=str, keep_default_na=False):
+            rows = rows[(rows.index % world_size == rank) & ~rows.index.isin(done)]
+            if len(rows) == 0:
+                continue
+            row_ids = rows.index.to_list()
+            audio_paths = rows['wav'].to_list()
+            references = rows['txt'].to_list() if "txt" in rows else None
+
+            def output(batch, batch_decodes):
+                if references is not None:
+                    wer.update([references[i] for i in batch], batch_decodes)
+                if writer is None:
+                    decodes.update((row_ids[i], decode) for i, decode in zip(batch, batch_decodes))
+                else:
+                    records = []
+                    for i, decode in zip(batch, batch_decodes):
+                        record = {"row": row_ids[i], "wav": audio_paths[i]}
+                        if references is not None:
+                            record["txt"] = references[i]
+                        record["decode"] = decode
+                        records.append(record)
+                    writer.write(records)
+                progress.update(len(batch))
+
+            batches = plan_manifest_batches(audio_paths, max_length_limited_context, args, model, feature_store)
+            if engine is not None:
+                decode_batches_on_workers(engine, audio_paths, batches, output, args)
+            else:
+                pipeline = decode_planned_batches(audio_paths, batches, output,
+                                                  args, model, char_dict, feature_store, stats)
+                stats = pipeline.stats
+                wall_time += pipeline.wall_time
+    finally:
+        progress.close()
+        if engine is not None:
+            engine.stop()
+        if feature_store is not None:
+            feature_store.close()
+        if writer is not None:
+            writer.close()
+
+    for stage_stats in stats or []:
+        print(stage_stats.summary(wall_time))
+    if engine is not None:
+        print(f"{progress.n} files decoded by {args.num_workers} workers "
+              f"({engine.threads_per_worker} threads each) in {time.perf_counter() - start_time:.1f}s")
+    if distributed:
+        wer.all_reduce()
+        if writer is not None:
+            dist.barrier()
+            if rank == 0:
+                merge_outputs([rank_output_path(args.output, r, world_size) for r in range(world_size)], args.output)
+        else:
+            gathered = [None] * world_size if rank == 0 else None
+            dist.gather_object(decodes, gathered, dst=0)
+            if rank == 0:
+                decodes = {row: decode for rank_decodes in gathered for row, decode in rank_decodes.items()}
+        if rank != 0:
+            return
+
+    if wer.wer is not None:
+        print("WER: ", wer.wer)
+    if writer is None:
+        # without --output, the decodes are added to the input TSV as before
+        df = pd.read_csv(args.audio_list, sep="\t")
+        df['decode'] = [decodes[row] for row in df.index]
+        df.to_csv(args.audio_list, sep="\t", index=False)
+
+
+def plan_manifest_batches(audio_paths, max_frames, args, model, feature_store=None):
+    """Group `audio_paths` into length-sorted batches of at most `max_frames` worth of chunks."""
+    subsampling_factor = model.encoder.embed.subsampling_factor
+    context = model.encoder.embed.right_context + 1
+    # the batch budget in chunks, the unit forward_parallel_chunk actually pays for
+    max_chunks = max(1, max_frames // args.chunk_size // subsampling_factor)
+
+    def duration(audio_path):
+        frames = feature_store.num_frames(audio_path) if feature_store is not None else None
+        return frames / 100 if frames is not None else probe_duration(audio_path)
+
+    durations = [duration(audio_path) for audio_path in audio_paths]
+    return plan_batches(durations, max_chunks, args.chunk_size, subsampling_factor, context)
+
+
+def load_features(audio_path, feature_store=None):
+    if feature_store is not None:
+        x = feature_store.get(audio_path)
+        if x is not None:
+            return x
+    x = compute_fbank(load_audio(audio_path))
+    if feature_store is not None:
+        # decoded in the stored precision, like every later run that reads them
+        x = feature_store.put(audio_path, x)
+    return x
+
+
+@torch.no_grad()
+def encode_features(xs, args, model, entrypoint="batch_decode"):
+    """Greedy CTC tokens of a batch of (T, 80) fbank features, in one forward_parallel_chunk call.
+
+    The audio is counted under `entrypoint`, or not at all when it is None.
+    """
     device = next(model.parameters()).device
+    xs_origin_lens = torch.tensor([x.shape[0] for x in xs], dtype=torch.int, device=device)
+    offset = torch.zeros(len(xs), dtype=torch.int, device=device)
+    if entrypoint is not None:
+        metrics.AUDIO_SECONDS.inc(int(xs_origin_lens.sum()) / 100, entrypoint=entrypoint)
+    with metrics.stage("forward_parallel_chunk"):
+        encoder_outs, encoder_lens, n_chunks, _, _, _ = model.encoder.forward_parallel_chunk(xs=xs,
+                                                                    xs_origin_lens=xs_origin_lens,
+                                                                    chunk_size=args.chunk_size,
+                                                                    left_context_size=args.left_context_size,
+                                                                    right_context_size=args.right_context_size,
+                                                                    offset=offset
+        )
+    metrics.record_chunk_batch(encoder_outs, encoder_lens)
+
+    with metrics.stage("ctc_forward"):
+        hyps = model.encoder.ctc_forward(encoder_outs, encoder_lens, n_chunks)
+    return [hyp.cpu() for hyp in hyps]
+
+
+def decode_planned_batches(audio_paths, batches, output, args, model, char_dict, feature_store=None, stats=None):
+    """Decode the planned `batches` of `audio_paths` in this process.
+
+    `output(batch, decodes)` is called as each batch finishes, with the
+    indices of its files in `audio_paths` and their transcriptions.
+
+    Returns:
+        the `BatchPipeline` that ran, for its per-stage throughput; pass its
+        `stats` back in as `stats` to accumulate them over several calls.
+    """
+    def post_process(batch, hyps):
+        with metrics.stage("get_output"):
+            decodes = get_output(hyps, char_dict)
+        output(batch, decodes)
+
+    # audio loading, the encoder and post-processing overlap, each on its own threads
+    pipeline = BatchPipeline(lambda idx: load_features(audio_paths[idx], feature_store),
+                             lambda batch, xs: encode_features(xs, args, model),
+                             post_process,
+                             num_workers=args.prefetch_workers,
+                             prefetch_batches=args.prefetch_batches,
+                             stats=stats)
+    pipeline.run(batches)
+    return pipeline
 
-    decodes = []
-    xs = []
-    xs_origin_lens = []
-    for idx, audio_path in tqdm(enumerate(df['wav'].to_list())):
-        waveform = load_audio(audio_path)
-        x = kaldi.fbank(waveform,
-                                num_mel_bins=80,
-                                frame_length=25,
-                                frame_shift=10,
-                                dither=0.0,
-                                energy_floor=0.0,
-                                sample_frequency=16000)
-
-        xs.append(x)
-        xs_origin_lens.append(x.shape[0])
-        max_frames -= xs_origin_lens[-1]
-
-        if (max_frames <= 0) or (idx == len(df) - 1):
-            xs_origin_lens = torch.tensor(xs_origin_lens, dtype=torch.int, device=device)
-            offset = torch.zeros(len(xs), dtype=torch.int, device=device)
-            encoder_outs, encoder_lens, n_chunks, _, _, _ = model.encoder.forward_parallel_chunk(xs=xs, 
-                                                                        xs_origin_lens=xs_origin_lens, 
-                                                                        chunk_size=chunk_size,
-                                                                        left_context_size=left_context_size,
-                                                                        right_context_size=right_context_size,
-                                                                        offset=offset
-            )
-
-            hyps = model.encoder.ctc_forward(encoder_outs, encoder_lens, n_chunks)
-            decodes += get_output(hyps, char_dict)
-                                         
-
-            # reset
-            xs = []
-            xs_origin_lens = []
-            max_frames = max_length_limited_context
-
-
-    df['decode'] = decodes
-    if "txt" in df:
-        wer = jiwer.wer(df["txt"].to_list(), decodes)
-        print("WER: ", wer)
-    df.to_csv(args.audio_list, sep="\t", index=False)
+
+# feature stores of the --num_workers processes, opened by each of them
+_worker_feature_stores = {}
+
+
+@torch.no_grad()
+def decode_batch_job(audio_paths, args, model=None, char_dict=None):
+    """Decode one planned batch; runs on a `ProcessInferenceEngine` worker (`--num_workers`)."""
+    feature_store = None
+    if args.feature_cache:
+        # sqlite connections must not cross a fork, every worker opens its own store
+        key = (os.getpid(), args.feature_cache, args.feature_cache_dtype)
+        if key not in _worker_feature_stores:
+            _worker_feature_stores[key] = FeatureStore(args.feature_cache, args.feature_cache_dtype)
+        feature_store = _worker_feature_stores[key]
+    xs = [load_features(audio_path, feature_store) for audio_path in audio_paths]
+    hyps = encode_features(xs, args, model)
+    with metrics.stage("get_output"):
+        return get_output(hyps, char_dict)
+
+
+def decode_batches_on_workers(engine, audio_paths, batches, output, args):
+    """Same as `decode_planned_batches`, with every batch decoded by an engine worker.
+
+    Idle workers take the next batch, so faster workers do more of them;
+    `output` still sees the batches in planned order.
+    """
+    in_flight = deque()
+    for batch in batches:
+        future = engine.submit(decode_batch_job, [audio_paths[i] for i in batch], args)
+        in_flight.append((batch, future))
+        # keep every worker busy without queueing the whole manifest
+        while len(in_flight) >= engine.max_queue_size:
+            batch, future = in_flight.popleft()
+            output(batch, future.result())
+    while in_flight:
+        batch, future = in_flight.popleft()
+        output(batch, future.result())
 
 
 
@@ -201,6 +617,18 @@ def main():
         default=1800, 
         help="The total audio duration (in second) in a batch that your GPU memory can handle at once. Default is 1800s"
     )
+    parser.add_argument(
+        "--memory_budget_mb",
+        type=float,
+        default=None,
+        help="Memory (MB) decoding may use: peak RSS on CPU, allocated device memory on GPU. When provided, `total_batch_duration` is picked from it (default: None)"
+    )
+    parser.add_argument(
+        "--autotune_profiles",
+        type=str,
+        default=os.path.join("cache", "autotune_profiles.json"),
+        help="File keeping the measured memory cost per chunk of each model / chunk config / dtype, so later runs skip the measurement (default: cache/autotune_profiles.json)"
+    )
     parser.add_argument(
         "--chunk_size", 
         type=int, 
@@ -222,8 +650,26 @@ def main():
     parser.add_argument(
         "--long_form_audio", 
         type=str, 
+        nargs="+",
         default=None, 
-        help="Path to the long audio file (default: None)"
+        help="Path to the long audio file; several files are decoded together, `max_streams` at a time (default: None)"
+    )
+    parser.add_argument(
+        "--stream_audio",
+        action="store_true",
+        help="Read `long_form_audio` and compute its features piece by piece while it is decoded, so that memory does not grow with the recording and segments are printed as soon as they are decoded; sequential or wavefront mode without VAD (default: False)"
+    )
+    parser.add_argument(
+        "--stream_block_duration",
+        type=float,
+        default=10.0,
+        help="With `stream_audio`, seconds of audio read at a time (default: 10.0)"
+    )
+    parser.add_argument(
+        "--max_streams",
+        type=int,
+        default=8,
+        help="With several `long_form_audio` files in the sequential mode, recordings advanced in lock step in each encoder call, sharing `total_batch_duration`; a finished one is replaced by the next file (default: 8)"
     )
     parser.add_argument(
         "--audio_list", 
@@ -232,17 +678,141 @@ def main():
         required=False, 
         help="Path to the TSV file containing the audio list. The TSV file must have one column named 'wav'. If 'txt' column is provided, Word Error Rate (WER) is computed"
     )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="JSONL or TSV file the `audio_list` results are appended to as batches finish; rerunning with the same file resumes the job. If not provided, the `audio_list` TSV is rewritten with a 'decode' column at the end (default: None)"
+    )
+    parser.add_argument(
+        "--manifest_chunk_rows",
+        type=int,
+        default=100000,
+        help="Rows of `audio_list` read, planned and decoded at a time (default: 100000)"
+    )
+    parser.add_argument(
+        "--prefetch_workers",
+        type=int,
+        default=4,
+        help="Threads loading audio and computing features ahead of the encoder in batch decoding (default: 4)"
+    )
+    parser.add_argument(
+        "--prefetch_batches",
+        type=int,
+        default=2,
+        help="Batches loaded ahead of the encoder, and encoded ahead of the output writer (default: 2)"
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="CPU worker processes decoding `audio_list` batches, or the segments of the parallel `long_form_mode`, in parallel, sharing one copy of the weights (default: 1)"
+    )
+    parser.add_argument(
+        "--threads_per_worker",
+        type=int,
+        default=0,
+        help="Torch threads of each worker with `num_workers`, 0 = cpu_count // num_workers (default: 0)"
+    )
+    parser.add_argument(
+        "--pin_cpus",
+        action="store_true",
+        help="Pin each worker to its own block of `threads_per_worker` cores (Linux, default: False)"
+    )
+    parser.add_argument(
+        "--feature_cache",
+        type=str,
+        default=None,
+        help="Directory caching the fbank features of `audio_list` files between runs, e.g. for chunk/context size sweeps (default: None)"
+    )
+    parser.add_argument(
+        "--feature_cache_dtype",
+        type=str,
+        choices=["float16", "float32"],
+        default="float16",
+        help="Dtype the cached features are stored in (default: float16)"
+    )
     parser.add_argument(
         "--full_attn", 
         action="store_true",
         help="Whether to use full attention with caching. If not provided, limited-chunk attention will be used (default: False)"
     )
+    parser.add_argument(
+        "--distributed",
+        action="store_true",
+        help="Split `audio_list` across the ranks of a torch.distributed job started with torchrun; rank 0 writes the merged results and WER (default: False)"
+    )
+    parser.add_argument(
+        "--dist_backend",
+        type=str,
+        default="gloo",
+        help="torch.distributed backend with `distributed`, e.g. gloo (CPU) or nccl (default: gloo)"
+    )
     parser.add_argument(
         "--device",
         type=torch.device,
         default="cuda" if torch.cuda.is_available() else "cpu",
         help="Device to run the model on (default: cuda if available else cpu)"
     )
+    parser.add_argument(
+        "--long_form_mode",
+        type=str,
+        choices=["sequential", "parallel", "wavefront"],
+        default="sequential",
+        help="How `long_form_audio` is decoded: 'sequential' windows carrying attention / conv caches, 'parallel' overlapping segments decoded in batches and stitched, or 'wavefront' layer by layer with per-layer caches, so the right context lookahead is not encoded again in every window (default: sequential)"
+    )
+    parser.add_argument(
+        "--segment_duration",
+        type=float,
+        default=30.0,
+        help="With the parallel mode, length of the segments in seconds; cuts are moved to the quietest point within a quarter of it (default: 30.0)"
+    )
+    parser.add_argument(
+        "--segment_overlap",
+        type=float,
+        default=4.0,
+        help="With the parallel mode, seconds of audio decoded by both segments around each cut (default: 4.0)"
+    )
+    parser.add_argument(
+        "--compare_sequential",
+        action="store_true",
+        help="With the parallel mode, also decode sequentially and print the agreement of the two (default: False)"
+    )
+    parser.add_argument(
+        "--vad",
+        type=str,
+        default=None,
+        help="Skip non-speech before the encoder with `long_form_audio`: 'energy', or 'package.module:function' returning a speech mask over the fbank frames (default: None)"
+    )
+    parser.add_argument(
+        "--vad_threshold_db",
+        type=float,
+        default=12.0,
+        help="With the energy VAD, frames this many dB above the noise floor are speech (default: 12.0)"
+    )
+    parser.add_argument(
+        "--vad_min_silence",
+        type=float,
+        default=1.0,
+        help="Shortest silence, in seconds, that is skipped; shorter pauses are decoded (default: 1.0)"
+    )
+    parser.add_argument(
+        "--vad_padding",
+        type=float,
+        default=0.3,
+        help="Seconds of audio kept on each side of the detected speech (default: 0.3)"
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Directory to write a per-stage / per-layer timing and memory profile to: trace.json (Chrome trace), summary.txt and summary.json (default: None)"
+    )
+    parser.add_argument(
+        "--profile_torch",
+        action="store_true",
+        help="With `profile`, also run torch.profiler and write its operator level trace to torch_trace.json; slow, use on a few files (default: False)"
+    )
     parser.add_argument(
         "--autocast_dtype",
         type=str,
@@ -253,6 +823,11 @@ def main():
 
     # Parse arguments
     args = parser.parse_args()
+    if args.distributed:
+        # rank, world size and rendezvous address come from torchrun's environment
+        dist.init_process_group(backend=args.dist_backend)
+        if args.device.type == "cuda" and args.device.index is None:
+            args.device = torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0)))
     device = torch.device(args.device)
     dtype = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16, None: None}[args.autocast_dtype]
 
@@ -268,13 +843,46 @@ def main():
     
     assert args.model_checkpoint is not None, "You must specify the path to the model"
     assert args.long_form_audio or args.audio_list, "`long_form_audio` or `audio_list` must be activated"
+    assert not args.distributed or args.audio_list, "`distributed` decoding needs an `audio_list`"
+    assert not args.stream_audio or (args.long_form_audio and len(args.long_form_audio) == 1
+                                     and args.long_form_mode != "parallel" and not args.vad), \
+        "`stream_audio` decodes a single `long_form_audio` in the sequential or wavefront mode, without VAD"
 
     model, char_dict = init(args.model_checkpoint, device)
     with torch.autocast(device.type, dtype) if dtype is not None else nullcontext():
-        if args.long_form_audio:
-            endless_decode(args, model, char_dict)
-        else:
-            batch_decode(args, model, char_dict)
+        if args.memory_budget_mb:
+            args.total_batch_duration = tune_total_batch_duration(args, args.memory_budget_mb, args.autotune_profiles,
+                                                                  long_form=bool(args.long_form_audio),
+                                                                  model=model, char_dict=char_dict)
+            print(f"Tuned Total Duration in a Batch (in second): {args.total_batch_duration}")
+        if args.profile:
+            profiling.start(device)
+        torch_profiler = None
+        if args.profile and args.profile_torch:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if device.type == "cuda":
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            torch_profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+        with torch_profiler if torch_profiler is not None else nullcontext():
+            if args.long_form_audio and len(args.long_form_audio) > 1:
+                decode_long_form_files(args.long_form_audio, args, model, char_dict)
+            elif args.long_form_audio:
+                args.long_form_audio = args.long_form_audio[0]
+                endless_decode(args, model, char_dict)
+            else:
+                batch_decode(args, model, char_dict)
+    if args.profile:
+        profile_dir = args.profile
+        if args.distributed:
+            profile_dir = os.path.join(profile_dir, f"rank{dist.get_rank()}")
+        profiler = profiling.stop()
+        profiler.save(profile_dir)
+        if torch_profiler is not None:
+            torch_profiler.export_chrome_trace(os.path.join(profile_dir, "torch_trace.json"))
+        print(profiler.format_summary(by_stage=True))
+        print(f"Profile written to {profile_dir}")
+    if args.distributed:
+        dist.destroy_process_group()
 
 if __name__ == "__main__":
     main()
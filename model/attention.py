@@ -1,7 +1,7 @@
 """Multi-Head Attention layer definition."""
 
 import math
-from typing import Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 import torch
 from torch import nn
@@ -226,7 +226,8 @@ class StreamingRelPositionMultiHeadedAttention(MultiHeadedAttention):
                 cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
                 right_context_size: int = 0,
                 left_context_size: int = 0,
-                truncated_context_size: int = 0
+                truncated_context_size: int = 0,
+                n_chunks: Optional[List[int]] = None
                 ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Compute 'Scaled Dot Product Attention' with rel. positional encoding.
         Args:
@@ -240,28 +241,43 @@ class StreamingRelPositionMultiHeadedAttention(MultiHeadedAttention):
             cache (torch.Tensor): Cache tensor (B, 1, head, cache_t, d_k * 2),
                 where `cache_t == chunk_size * num_decoding_left_chunks`
                 and `head * d_k == size`
+            n_chunks (List[int]): chunks of each stream of the batch, when
+                every stream has its own cache. `cache` is then stacked
+                along a leading stream axis (#streams, cache_t, head, d_k * 2)
+                and each stream's cache is put in front of its own chunks.
         Returns:
             torch.Tensor: Output tensor (#batch, time1, d_model).
             torch.Tensor: Cache tensor (1, head, cache_t + time1, d_k * 2)
                 where `cache_t == chunk_size * num_decoding_left_chunks`
-                and `head * d_k == size`
+                and `head * d_k == size`; with `n_chunks`, one per stream.
         """
         q, k, v = self.forward_qkv(query, key, value)
 
         q = q.transpose(1, 2)  # (batch, time1, head, d_k)
 
         if cache.size(2) <= 0:
-            cache = torch.zeros((left_context_size, self.h, self.d_k * 2), device=q.device, dtype=q.dtype)
+            cache_shape = (left_context_size, self.h, self.d_k * 2)
+            if n_chunks is not None:
+                cache_shape = (len(n_chunks),) + cache_shape
+            cache = torch.zeros(cache_shape, device=q.device, dtype=q.dtype)
 
         kv = torch.cat([k, v], dim=-1) # (B, head, time1, d_k * 2),
         kv = kv.transpose(1, 2).reshape(-1, self.h, self.d_k * 2) # [n_chunk * chunk_size, head, F]
 
+        if n_chunks is None:
+            caches, kvs = [cache], [kv]
+        else:
+            caches, kvs = cache, kv.split([n_chunk * q.shape[1] for n_chunk in n_chunks])
 
         #----------Overlapping Chunk Transformation-----------------------------------
-        kv = torch.cat([cache, kv], dim=0)
-        new_cache = kv[:truncated_context_size + cache.size(0)][-cache.size(0):].cpu()
-        kv = torch.nn.functional.pad(kv, (0, 0, 0, 0, 0, right_context_size))
-        kv = kv.unfold(0, left_context_size + q.shape[1] + right_context_size, q.shape[1])
+        windows, new_cache = [], []
+        for cache, kv in zip(caches, kvs):
+            kv = torch.cat([cache, kv], dim=0)
+            new_cache.append(kv[:truncated_context_size + cache.size(0)][-cache.size(0):])
+            kv = torch.nn.functional.pad(kv, (0, 0, 0, 0, 0, right_context_size))
+            windows.append(kv.unfold(0, left_context_size + q.shape[1] + right_context_size, q.shape[1]))
+        kv = torch.cat(windows) if len(windows) > 1 else windows[0]
+        new_cache = new_cache[0] if n_chunks is None else torch.stack(new_cache)
         #-----------------------------------------------------------------------------
 
 
@@ -15,7 +15,7 @@
 
 """ConvolutionModule definition."""
 
-from typing import Tuple
+from typing import List, Optional, Tuple
 
 import torch
 from torch import nn
@@ -97,8 +97,8 @@ class ConvolutionModule(nn.Module):
         x: torch.Tensor,
         mask_pad: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         cache: torch.Tensor = torch.zeros((0, 0, 0)),
-        truncated_context_size: int = 0
-
+        truncated_context_size: int = 0,
+        n_chunks: Optional[List[int]] = None
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Compute convolution module.
         Args:
@@ -108,6 +108,8 @@ class ConvolutionModule(nn.Module):
             cache (torch.Tensor): left context cache, it is only
                 used in causal convolution (#batch, channels, cache_t),
                 (0, 0, 0) meas fake cache.
+            n_chunks (List[int]): chunks of each stream of the batch, when
+                every stream has its own cache (#streams, channels, cache_t).
         Returns:
             torch.Tensor: Output tensor (#batch, time, channels).
         """
@@ -116,17 +118,26 @@ class ConvolutionModule(nn.Module):
         lorder = self.kernel_size//2
         chunk_size = x.shape[-1]
         if cache.size(0) == 0:
-            cache = torch.zeros(self.channels, lorder).to(x.device)
+            cache_shape = (self.channels, lorder) if n_chunks is None else (len(n_chunks), self.channels, lorder)
+            cache = torch.zeros(cache_shape).to(x.device)
         # GLU mechanism
         x = self.pointwise_conv1(x)  # (batch, 2*channel, dim)
         x = nn.functional.glu(x, dim=1)  # (batch, channel, dim)
 
         #----------Overlapping Chunk Transformation-----------------------------------
         x = x.transpose(0, 1).reshape( self.channels, -1)  # [C, n_chunk * T]
-        x = torch.cat([cache, x], dim=-1)
-        new_cache = x[:, :truncated_context_size + cache.size(-1)][:, -cache.size(-1):].cpu()
-        x = nn.functional.pad(x, (0, lorder), 'constant', 0.0)
-        x = x.unfold(-1, chunk_size + 2 * lorder, chunk_size).transpose(0, 1) #[n_chunk +1, C, cnn_cache_size]
+        if n_chunks is None:
+            caches, xs = [cache], [x]
+        else:
+            caches, xs = cache, x.split([n_chunk * chunk_size for n_chunk in n_chunks], dim=-1)
+        windows, new_cache = [], []
+        for cache, x in zip(caches, xs):
+            x = torch.cat([cache, x], dim=-1)
+            new_cache.append(x[:, :truncated_context_size + cache.size(-1)][:, -cache.size(-1):])
+            x = nn.functional.pad(x, (0, lorder), 'constant', 0.0)
+            windows.append(x.unfold(-1, chunk_size + 2 * lorder, chunk_size).transpose(0, 1)) #[n_chunk +1, C, cnn_cache_size]
+        x = torch.cat(windows) if len(windows) > 1 else windows[0]
+        new_cache = new_cache[0] if n_chunks is None else torch.stack(new_cache)
         #-----------------------------------------------------------------------------
 
         if mask_pad.size(2) > 0:  # time > 0
@@ -30,6 +30,7 @@ from model.positionwise_feed_forward import PositionwiseFeedForward
 from model.subsampling import DepthwiseConvSubsampling
 from model.utils.common import get_activation
 from model.utils.mask import make_pad_mask
+from model.utils import profiling
 
 class BaseEncoder(torch.nn.Module):
     def __init__(
@@ -150,6 +151,8 @@ class BaseEncoder(torch.nn.Module):
         cnn_cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
         truncated_context_size:int = 0,
         offset: torch.Tensor = torch.zeros(0),
+        stream_caches: bool = False,
+        update_caches_in_place: bool = False,
         ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Embed positions in tensor.
 
@@ -164,6 +167,16 @@ class BaseEncoder(torch.nn.Module):
             the chunk size is decoding_chunk_size.
                 >=0: use num_decoding_left_chunks
                 <0: use all left chunks
+            stream_caches: every utterance of `xs` is the next window of
+                its own stream, with its own caches stacked along the batch
+                axis: att_cache (elayers, B, cache_t1, head, d_k * 2) and
+                cnn_cache (elayers, B, hidden-dim, cache_t2). The returned
+                caches have the same layout.
+            update_caches_in_place: overwrite `att_cache` / `cnn_cache`,
+                which must be full size and on the device of
+                `xs_origin_lens`, with the new caches layer by layer and
+                return them, instead of returning new tensors and leaving
+                the caller's untouched; used with `EncoderCache`.
         Returns:
             encoder output tensor xs, and subsampled masks
             xs: padded output tensor (B, T' ~= T/subsample_rate, D)
@@ -181,92 +194,106 @@ class BaseEncoder(torch.nn.Module):
 
         conv_lorder = self.cnn_module_kernel // 2
 
-        upper_bounds = []
-        lower_bounds = []
-        upper_bounds_conv = []
-        lower_bounds_conv = []
-        x_pad = []
-        xs_lens = []
-        n_chunks = []
-        for xs_origin_len, x, offs in zip(xs_origin_lens, xs, offset): # cost O(input_batch_size | ccu)
-            x = x.to(device)
-            if x.size(0) >= size:
-                n_frames_pad = (step - ((x.size(0) - size) %  step)) % step
-            else:
-                n_frames_pad = size - x.size(0)
-            x = torch.nn.functional.pad(x, (0, 0, 0, n_frames_pad)) # (T, 80)
-            n_chunk = ((x.size(0) - size) // step) + 1
-            x = x.unfold(0, size=size, step=step) # [n_chunk, 80, size]
-            x = x.transpose(2, 1)
-
-            max_len = 1  + (xs_origin_len - context)//subsampling
-            upper_bound = chunk_size + right_context_size + torch.arange(0, 1 + (xs_origin_len + n_frames_pad - context)//subsampling, 1 + (size - context)//subsampling, device=device)
-            lower_bound = upper_bound - max_len
-            upper_bound += offs
+        with profiling.region("chunk_unfold"):
+            upper_bounds = []
+            lower_bounds = []
+            upper_bounds_conv = []
+            lower_bounds_conv = []
+            x_pad = []
+            xs_lens = []
+            n_chunks = []
+            for xs_origin_len, x, offs in zip(xs_origin_lens, xs, offset): # cost O(input_batch_size | ccu)
+                x = x.to(device)
+                if x.size(0) >= size:
+                    n_frames_pad = (step - ((x.size(0) - size) %  step)) % step
+                else:
+                    n_frames_pad = size - x.size(0)
+                x = torch.nn.functional.pad(x, (0, 0, 0, n_frames_pad)) # (T, 80)
+                n_chunk = ((x.size(0) - size) // step) + 1
+                x = x.unfold(0, size=size, step=step) # [n_chunk, 80, size]
+                x = x.transpose(2, 1)
+
+                max_len = 1  + (xs_origin_len - context)//subsampling
+                upper_bound = chunk_size + right_context_size + torch.arange(0, 1 + (xs_origin_len + n_frames_pad - context)//subsampling, 1 + (size - context)//subsampling, device=device)
+                lower_bound = upper_bound - max_len
+                upper_bound += offs
             
-            upper_bound_conv = chunk_size + conv_lorder + torch.arange(0, 1  + (xs_origin_len + n_frames_pad - context)//subsampling, 1 + (size - context)//subsampling, device=device)
-            lower_bound_conv = torch.maximum(upper_bound_conv - max_len, torch.full_like(upper_bound_conv, conv_lorder - right_context_size))
-            upper_bound_conv += offs
+                upper_bound_conv = chunk_size + conv_lorder + torch.arange(0, 1  + (xs_origin_len + n_frames_pad - context)//subsampling, 1 + (size - context)//subsampling, device=device)
+                lower_bound_conv = torch.maximum(upper_bound_conv - max_len, torch.full_like(upper_bound_conv, conv_lorder - right_context_size))
+                upper_bound_conv += offs
 
 
-            xs_lens += [size] * (n_chunk - 1) + [size - n_frames_pad]
-            upper_bounds.append(upper_bound)
-            lower_bounds.append(lower_bound)
-            upper_bounds_conv.append(upper_bound_conv)
-            lower_bounds_conv.append(lower_bound_conv)
-            x_pad.append(x)
-            n_chunks.append(n_chunk)
+                xs_lens += [size] * (n_chunk - 1) + [size - n_frames_pad]
+                upper_bounds.append(upper_bound)
+                lower_bounds.append(lower_bound)
+                upper_bounds_conv.append(upper_bound_conv)
+                lower_bounds_conv.append(lower_bound_conv)
+                x_pad.append(x)
+                n_chunks.append(n_chunk)
 
 
-        xs = torch.cat(x_pad, dim=0).to(device)
-        xs_lens = torch.tensor(xs_lens).to(device)
-        upper_bounds = torch.cat(upper_bounds).unsqueeze(1).to(device)
-        lower_bounds = torch.cat(lower_bounds).unsqueeze(1).to(device)
-        upper_bounds_conv = torch.cat(upper_bounds_conv).unsqueeze(1).to(device)
-        lower_bounds_conv = torch.cat(lower_bounds_conv).unsqueeze(1).to(device)
+            xs = torch.cat(x_pad, dim=0).to(device)
+            xs_lens = torch.tensor(xs_lens).to(device)
+            upper_bounds = torch.cat(upper_bounds).unsqueeze(1).to(device)
+            lower_bounds = torch.cat(lower_bounds).unsqueeze(1).to(device)
+            upper_bounds_conv = torch.cat(upper_bounds_conv).unsqueeze(1).to(device)
+            lower_bounds_conv = torch.cat(lower_bounds_conv).unsqueeze(1).to(device)
 
 
         # forward model
         if self.global_cmvn is not None:
-            xs = self.global_cmvn(xs)
-
+            with profiling.region("cmvn"):
+                xs = self.global_cmvn(xs)
 
-        xs, pos_emb, xs_lens = self.embed(xs, xs_lens, offset=left_context_size, right_context_size=right_context_size)
-        masks = ~make_pad_mask(xs_lens, xs.size(1)).unsqueeze(1)  # (B, 1, T)
 
+        with profiling.region("subsampling"):
+            xs, pos_emb, xs_lens = self.embed(xs, xs_lens, offset=left_context_size, right_context_size=right_context_size)
 
-        mask_pad = torch.arange(0, conv_lorder + chunk_size + conv_lorder, device=masks.device).unsqueeze(0).repeat(xs.size(0), 1) # [B, left_context_size + chunksize]
-        mask_pad = (lower_bounds_conv <= mask_pad) & (mask_pad < upper_bounds_conv)
-        mask_pad = mask_pad.flip(-1).unsqueeze(1)
-        att_mask = torch.arange(0, left_context_size + chunk_size + right_context_size, device=masks.device).unsqueeze(0).repeat(xs.size(0), 1) # [B, left_context_size + chunksize]
-        att_mask = (lower_bounds <= att_mask) & (att_mask < upper_bounds)
-        att_mask = att_mask.flip(-1).unsqueeze(1)
+        with profiling.region("masks"):
+            masks = ~make_pad_mask(xs_lens, xs.size(1)).unsqueeze(1)  # (B, 1, T)
+            mask_pad = torch.arange(0, conv_lorder + chunk_size + conv_lorder, device=masks.device).unsqueeze(0).repeat(xs.size(0), 1) # [B, left_context_size + chunksize]
+            mask_pad = (lower_bounds_conv <= mask_pad) & (mask_pad < upper_bounds_conv)
+            mask_pad = mask_pad.flip(-1).unsqueeze(1)
+            att_mask = torch.arange(0, left_context_size + chunk_size + right_context_size, device=masks.device).unsqueeze(0).repeat(xs.size(0), 1) # [B, left_context_size + chunksize]
+            att_mask = (lower_bounds <= att_mask) & (att_mask < upper_bounds)
+            att_mask = att_mask.flip(-1).unsqueeze(1)
 
 
+        if update_caches_in_place:
+            assert att_cache.device == device and cnn_cache.device == device, \
+                "caches updated in place must be on the compute device"
         r_att_cache = []
         r_cnn_cache = []
         for i, layer in enumerate(self.encoders):
-            xs, _, new_att_cache, new_cnn_cache = layer.forward_parallel_chunk(xs, att_mask, pos_emb, 
-                mask_pad=mask_pad,
-                right_context_size=right_context_size,
-                left_context_size=left_context_size,
-                att_cache=att_cache[i].to(device) if att_cache.size(0) > 0 else att_cache,
-                cnn_cache=cnn_cache[i].to(device) if cnn_cache.size(0) > 0 else cnn_cache,
-                truncated_context_size=truncated_context_size
-
-            )
-            r_att_cache.append(new_att_cache)
-            r_cnn_cache.append(new_cnn_cache)
+            with profiling.region(f"layer{i:02d}"):
+                xs, _, new_att_cache, new_cnn_cache = layer.forward_parallel_chunk(xs, att_mask, pos_emb, 
+                    mask_pad=mask_pad,
+                    right_context_size=right_context_size,
+                    left_context_size=left_context_size,
+                    att_cache=att_cache[i] if update_caches_in_place else
+                        att_cache[i].to(device) if att_cache.size(0) > 0 else att_cache,
+                    cnn_cache=cnn_cache[i] if update_caches_in_place else
+                        cnn_cache[i].to(device) if cnn_cache.size(0) > 0 else cnn_cache,
+                    truncated_context_size=truncated_context_size,
+                    n_chunks=n_chunks if stream_caches else None
+                )
+            if update_caches_in_place:
+                att_cache[i].copy_(new_att_cache)
+                cnn_cache[i].copy_(new_cnn_cache)
+            else:
+                r_att_cache.append(new_att_cache)
+                r_cnn_cache.append(new_cnn_cache)
 
-        del att_cache
-        del cnn_cache
         if self.normalize_before:
-            xs = self.after_norm(xs)
+            with profiling.region("after_norm"):
+                xs = self.after_norm(xs)
 
         xs_lens = self.embed.calc_length(xs_origin_lens)
         offset += xs_lens
 
 
+        if update_caches_in_place:
+            return xs, xs_lens, n_chunks, att_cache, cnn_cache, offset
         # NOTE(xcsong): shape(r_att_cache) is (elayers, head, ?, d_k * 2),
         #   ? may be larger than cache_t1, it depends on required_cache_size
         r_att_cache = torch.stack(r_att_cache, dim=0)
@@ -274,6 +301,58 @@ class BaseEncoder(torch.nn.Module):
         r_cnn_cache = torch.stack(r_cnn_cache, dim=0)
         return xs, xs_lens, n_chunks, r_att_cache, r_cnn_cache, offset
     
+    def embed_chunks(self, xs, chunk_size: int, left_context_size: int, right_context_size: int):
+        """Subsample the fbank frames of consecutive chunks, as `forward_parallel_chunk` does.
+
+        Args:
+            xs: (T, 80) fbank frames starting on a chunk boundary; the last
+                chunk may be incomplete at the end of a recording.
+        Returns:
+            the (T', D) encoder frames and the relative positional encoding
+            of the chunks.
+        """
+        subsampling = self.embed.subsampling_factor
+        context = self.embed.right_context + 1
+        size = (chunk_size - 1) * subsampling + context
+        step = subsampling * chunk_size
+        if xs.size(0) >= size:
+            n_frames_pad = (step - ((xs.size(0) - size) % step)) % step
+        else:
+            n_frames_pad = size - xs.size(0)
+        x = torch.nn.functional.pad(xs, (0, 0, 0, n_frames_pad))
+        x = x.unfold(0, size=size, step=step).transpose(2, 1)
+        n_chunk = x.size(0)
+        x_lens = torch.tensor([size] * (n_chunk - 1) + [size - n_frames_pad], device=x.device)
+        if self.global_cmvn is not None:
+            x = self.global_cmvn(x)
+        x, pos_emb, _ = self.embed(x, x_lens, offset=left_context_size, right_context_size=right_context_size)
+        num_frames = int(self.embed.calc_length(torch.tensor([xs.size(0)])))
+        return x.reshape(-1, x.size(-1))[:max(num_frames, 0)], pos_emb
+
+    def chunk_masks(self, n_chunk: int, num_frames: int, offset: int, chunk_size: int,
+                    left_context_size: int, right_context_size: int, device=None):
+        """Attention and convolution masks of `n_chunk` consecutive chunks of one utterance.
+
+        They are the masks `forward_parallel_chunk` builds: the first
+        `num_frames` frames of the chunks and `offset` frames of cached
+        history before them are visible.
+        """
+        conv_lorder = self.cnn_module_kernel // 2
+        starts = torch.arange(0, n_chunk * chunk_size, chunk_size, device=device).unsqueeze(1)
+        upper_bound = chunk_size + right_context_size + starts
+        lower_bound = upper_bound - num_frames
+        upper_bound = upper_bound + offset
+        upper_bound_conv = chunk_size + conv_lorder + starts
+        lower_bound_conv = torch.maximum(upper_bound_conv - num_frames,
+                                         torch.full_like(upper_bound_conv, conv_lorder - right_context_size))
+        upper_bound_conv = upper_bound_conv + offset
+
+        mask_pad = torch.arange(0, conv_lorder + chunk_size + conv_lorder, device=device).unsqueeze(0)
+        mask_pad = (lower_bound_conv <= mask_pad) & (mask_pad < upper_bound_conv)
+        att_mask = torch.arange(0, left_context_size + chunk_size + right_context_size, device=device).unsqueeze(0)
+        att_mask = (lower_bound <= att_mask) & (att_mask < upper_bound)
+        return att_mask.flip(-1).unsqueeze(1), mask_pad.flip(-1).unsqueeze(1)
+
     def ctc_forward(self, xs, xs_lens=None, n_chunks=None):
         ctc_probs = self.ctc.log_softmax(xs)
         topk_prob, topk_index = ctc_probs.topk(1, dim=2)  # (B, maxlen, 1)
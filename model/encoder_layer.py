@@ -1,10 +1,12 @@
 """Encoder self-attention layer definition."""
 
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
 import torch
 from torch import nn
 
+from model.utils import profiling
+
 
 class ChunkFormerEncoderLayer(nn.Module):
     """Encoder layer module.
@@ -73,7 +75,8 @@ class ChunkFormerEncoderLayer(nn.Module):
         cnn_cache: torch.Tensor = torch.zeros((0, 0, 0)),
         right_context_size: int = 0,
         left_context_size: int = 0,
-        truncated_context_size: int = 0
+        truncated_context_size: int = 0,
+        n_chunks: Optional[List[int]] = None
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         """Compute encoded features.
 
@@ -89,6 +92,8 @@ class ChunkFormerEncoderLayer(nn.Module):
                 (batch, 1, head, cache_t1, d_k * 2), head * d_k == size.
             cnn_cache (torch.Tensor): Convolution cache in ChunkFormer layer
                 (batch, 1, size, cache_t2)
+            n_chunks (List[int]): chunks of each stream of the batch when
+                both caches are per stream, stacked along a leading axis.
         Returns:
             torch.Tensor: Output tensor (#batch, time, size).
             torch.Tensor: Mask tensor (#batch, time, time).
@@ -100,48 +105,54 @@ class ChunkFormerEncoderLayer(nn.Module):
 
         # whether to use macaron style
         if self.feed_forward_macaron is not None:
-            residual = x
-            if self.normalize_before:
-                x = self.norm_ff_macaron(x)
-            x = residual + self.ff_scale * self.dropout(
-                self.feed_forward_macaron(x))
-            if not self.normalize_before:
-                x = self.norm_ff_macaron(x)
+            with profiling.region("ffn_macaron"):
+                residual = x
+                if self.normalize_before:
+                    x = self.norm_ff_macaron(x)
+                x = residual + self.ff_scale * self.dropout(
+                    self.feed_forward_macaron(x))
+                if not self.normalize_before:
+                    x = self.norm_ff_macaron(x)
 
         # multi-headed self-attention module
-        residual = x
-        if self.normalize_before:
-            x = self.norm_mha(x)
+        with profiling.region("attention"):
+            residual = x
+            if self.normalize_before:
+                x = self.norm_mha(x)
 
-        x_att, new_att_cache = self.self_attn.forward_parallel_chunk(
-            x, x, x, mask, pos_emb, att_cache, right_context_size=right_context_size, left_context_size=left_context_size, truncated_context_size=truncated_context_size)
+            x_att, new_att_cache = self.self_attn.forward_parallel_chunk(
+                x, x, x, mask, pos_emb, att_cache, right_context_size=right_context_size, left_context_size=left_context_size, truncated_context_size=truncated_context_size,
+                n_chunks=n_chunks)
 
-        x = residual + self.dropout(x_att)
-        if not self.normalize_before:
-            x = self.norm_mha(x)
+            x = residual + self.dropout(x_att)
+            if not self.normalize_before:
+                x = self.norm_mha(x)
 
         # convolution module
         # Fake new cnn cache here, and then change it in conv_module
         new_cnn_cache = torch.zeros((0, 0, 0), dtype=x.dtype, device=x.device)
         if self.conv_module is not None:
-            residual = x
-            if self.normalize_before:
-                x = self.norm_conv(x)
+            with profiling.region("conv"):
+                residual = x
+                if self.normalize_before:
+                    x = self.norm_conv(x)
 
-            x, new_cnn_cache = self.conv_module.forward_parallel_chunk(x, mask_pad, cnn_cache, truncated_context_size=truncated_context_size)
+                x, new_cnn_cache = self.conv_module.forward_parallel_chunk(x, mask_pad, cnn_cache, truncated_context_size=truncated_context_size,
+                                                                         n_chunks=n_chunks)
 
-            x = residual + self.dropout(x)
+                x = residual + self.dropout(x)
 
-            if not self.normalize_before:
-                x = self.norm_conv(x)
+                if not self.normalize_before:
+                    x = self.norm_conv(x)
         # feed forward module
-        residual = x
-        if self.normalize_before:
-            x = self.norm_ff(x)
+        with profiling.region("ffn"):
+            residual = x
+            if self.normalize_before:
+                x = self.norm_ff(x)
 
-        x = residual + self.ff_scale * self.dropout(self.feed_forward(x))
-        if not self.normalize_before:
-            x = self.norm_ff(x)
+            x = residual + self.ff_scale * self.dropout(self.feed_forward(x))
+            if not self.normalize_before:
+                x = self.norm_ff(x)
 
         if self.conv_module is not None:
             x = self.norm_final(x)
@@ -0,0 +1,241 @@
+import io
+import shutil
+import struct
+import subprocess
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional
+
+import numpy as np
+import soundfile
+import torch
+import torchaudio
+
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+RAW_PCM_EXTENSIONS = {".pcm", ".raw"}
+# bytes searched for the "data" chunk of a WAV file
+WAV_HEADER_BYTES = 64 * 1024
+
+
+class WavInfo(NamedTuple):
+    format_tag: int
+    channels: int
+    sample_rate: int
+    bits_per_sample: int
+    data_offset: int
+    data_size: int
+
+
+def parse_wav_header(header: bytes) -> Optional[WavInfo]:
+    """Parse the RIFF/WAVE header of a PCM or IEEE float WAV file.
+
+    Args:
+        header: the first bytes of the file, up to and including the
+            header of the "data" chunk.
+
+    Returns:
+        the stream description, or None when the bytes are not a WAV file
+        we can read without ffmpeg (compressed codecs, RF64, ...).
+    """
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        return None
+
+    fmt = None
+    pos = 12
+    while pos + 8 <= len(header):
+        chunk_id = header[pos:pos + 4]
+        chunk_size = struct.unpack_from("<I", header, pos + 4)[0]
+        body = pos + 8
+        if chunk_id == b"fmt ":
+            if chunk_size < 16 or body + 16 > len(header):
+                return None
+            format_tag, channels, sample_rate, _, _, bits = struct.unpack_from("<HHIIHH", header, body)
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 40:
+                if body + 26 > len(header):
+                    return None
+                # the real format is the first two bytes of the SubFormat GUID
+                format_tag = struct.unpack_from("<H", header, body + 24)[0]
+            fmt = (format_tag, channels, sample_rate, bits)
+        elif chunk_id == b"data":
+            if fmt is None:
+                return None
+            format_tag, channels, sample_rate, bits = fmt
+            if format_tag == WAVE_FORMAT_PCM and bits not in (8, 16, 24, 32):
+                return None
+            if format_tag == WAVE_FORMAT_IEEE_FLOAT and bits not in (32, 64):
+                return None
+            if format_tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT) or channels == 0:
+                return None
+            return WavInfo(format_tag, channels, sample_rate, bits, body, chunk_size)
+        # chunks are word aligned
+        pos = body + chunk_size + (chunk_size & 1)
+    return None
+
+
+def pcm_to_int16_scale(data, info: WavInfo) -> np.ndarray:
+    """Convert interleaved WAV sample bytes to float32 in 16-bit integer scale.
+
+    The features are computed on samples scaled like `load_audio` returns
+    them (the int16 range), so every sample format is brought to that scale.
+    """
+    frame_bytes = info.channels * info.bits_per_sample // 8
+    data = data[:len(data) - len(data) % frame_bytes]
+    if info.format_tag == WAVE_FORMAT_IEEE_FLOAT:
+        dtype = "<f4" if info.bits_per_sample == 32 else "<f8"
+        samples = np.frombuffer(data, dtype=dtype).astype(np.float32) * 32768.0
+    elif info.bits_per_sample == 8:
+        samples = (np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 128.0) * 256.0
+    elif info.bits_per_sample == 16:
+        samples = np.frombuffer(data, dtype="<i2").astype(np.float32)
+    elif info.bits_per_sample == 24:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        samples = (raw[:, 0].astype(np.int32) | (raw[:, 1].astype(np.int32) << 8)
+                   | (raw[:, 2].astype(np.int8).astype(np.int32) << 16)).astype(np.float32) / 256.0
+    else:
+        samples = np.frombuffer(data, dtype="<i4").astype(np.float32) / 65536.0
+    return samples.reshape(-1, info.channels)
+
+
+def to_mono_waveform(samples: np.ndarray, sample_rate: int, frame_rate: int = 16000) -> torch.Tensor:
+    """Down-mix (T, C) samples and resample them to a (1, T') tensor."""
+    if samples.shape[1] > 1:
+        samples = samples.mean(axis=1, dtype=np.float32)
+    else:
+        samples = samples[:, 0]
+    waveform = torch.from_numpy(np.ascontiguousarray(samples, dtype=np.float32)).unsqueeze(0)
+    if sample_rate != frame_rate:
+        waveform = get_resampler(sample_rate, frame_rate)(waveform)
+    return waveform
+
+
+@lru_cache(maxsize=16)
+def get_resampler(orig_freq: int, new_freq: int) -> torchaudio.transforms.Resample:
+    """Polyphase resampler from `orig_freq` to `new_freq`, built once per rate pair.
+
+    `torchaudio.functional.resample` recomputes the windowed sinc kernel on
+    every call, which costs more than resampling a short utterance.
+    """
+    return torchaudio.transforms.Resample(orig_freq, new_freq)
+
+
+def read_audio_file(path, frame_rate: int = 16000) -> Optional[torch.Tensor]:
+    """Decode a WAV (PCM / float) or FLAC file in-process, without ffmpeg.
+
+    The samples are read straight into a NumPy buffer and handed to torch
+    without a further copy; FLAC is decoded by `soundfile`.
+
+    Returns:
+        a (1, T) float32 tensor in the same scale as `load_audio`, or None
+        when the file needs the pydub / ffmpeg fallback.
+    """
+    with open(path, "rb") as f:
+        header = f.read(WAV_HEADER_BYTES)
+        info = parse_wav_header(header)
+        if info is not None:
+            f.seek(info.data_offset)
+            # streamed WAV files often leave the data size at 0 or 0xFFFFFFFF
+            data = f.read(info.data_size if 0 < info.data_size < 0xFFFFFFFF else -1)
+            if len(data) < info.channels * info.bits_per_sample // 8:
+                return None
+            return to_mono_waveform(pcm_to_int16_scale(data, info), info.sample_rate, frame_rate)
+
+    if header[:4] == b"fLaC":
+        try:
+            samples, sample_rate = soundfile.read(path, dtype="int16", always_2d=True)
+        except RuntimeError:
+            return None
+        return to_mono_waveform(samples.astype(np.float32), sample_rate, frame_rate)
+    return None
+
+
+def decode_audio_bytes(content: bytes, filename: str = "", frame_rate: int = 16000) -> Optional[torch.Tensor]:
+    """Decode an uploaded file straight from memory, without ffmpeg.
+
+    WAV (PCM / float), FLAC and headerless
+    16-bit little endian mono PCM (".pcm" / ".raw", assumed to already be at
+    `frame_rate`) are supported.
+
+    Returns:
+        a (1, T) float32 tensor in the same scale as `load_audio`, or None
+        when the content needs the ffmpeg based fallback.
+    """
+    suffix = Path(filename).suffix.lower()
+    if suffix in RAW_PCM_EXTENSIONS:
+        if len(content) < 2:
+            return None
+        samples = np.frombuffer(content[:len(content) - len(content) % 2], dtype="<i2")
+        return torch.from_numpy(samples.astype(np.float32)).unsqueeze(0)
+
+    info = parse_wav_header(content[:WAV_HEADER_BYTES])
+    if info is not None:
+        data = memoryview(content)[info.data_offset:info.data_offset + info.data_size]
+        if len(data) == 0:
+            return None
+        return to_mono_waveform(pcm_to_int16_scale(data, info), info.sample_rate, frame_rate)
+
+    if content[:4] == b"fLaC":
+        try:
+            samples, sample_rate = soundfile.read(io.BytesIO(content), dtype="int16", always_2d=True)
+        except RuntimeError:
+            return None
+        return to_mono_waveform(samples.astype(np.float32), sample_rate, frame_rate)
+
+    return None
+
+
+def iter_audio_blocks(path, block_seconds: float = 10.0, frame_rate: int = 16000) -> Iterator[torch.Tensor]:
+    """Read an audio file piece by piece, in (1, T) blocks of `block_seconds`.
+
+    WAV (PCM / float) files already at `frame_rate` are memory mapped, other
+    files are decoded and resampled by an ffmpeg pipe, so that only one
+    block is in memory at a time however long the recording is. The samples
+    have the same scale as `load_audio`. Without ffmpeg, files that
+    `read_audio_file` can decode are read whole and handed out in blocks.
+    """
+    block_samples = int(block_seconds * frame_rate)
+    with open(path, "rb") as f:
+        info = parse_wav_header(f.read(WAV_HEADER_BYTES))
+    if info is not None and info.sample_rate == frame_rate:
+        data = np.memmap(path, dtype=np.uint8, mode="r", offset=info.data_offset)
+        if 0 < info.data_size < 0xFFFFFFFF:
+            data = data[:info.data_size]
+        block_bytes = block_samples * info.channels * info.bits_per_sample // 8
+        for start in range(0, len(data), block_bytes):
+            samples = pcm_to_int16_scale(data[start:start + block_bytes], info)
+            if len(samples):
+                yield to_mono_waveform(samples, frame_rate, frame_rate)
+        return
+
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        waveform = read_audio_file(path, frame_rate)
+        if waveform is None:
+            raise RuntimeError(f"ffmpeg is needed to read {path}")
+        for start in range(0, waveform.shape[1], block_samples):
+            yield waveform[:, start:start + block_samples]
+        return
+
+    command = [ffmpeg, "-nostdin", "-loglevel", "error", "-i", str(path),
+               "-f", "s16le", "-acodec", "pcm_s16le", "-ac", "1", "-ar", str(frame_rate), "-"]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while True:
+            data = process.stdout.read(block_samples * 2)
+            if len(data) < 2:
+                break
+            samples = np.frombuffer(data[:len(data) - len(data) % 2], dtype="<i2")
+            yield torch.from_numpy(samples.astype(np.float32)).unsqueeze(0)
+        error = process.stderr.read().decode(errors="replace").strip()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to decode {path}: {error}")
+    finally:
+        # the reader may stop early, don't leave ffmpeg behind
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
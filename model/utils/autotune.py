@@ -0,0 +1,192 @@
+import json
+import math
+import os
+from pathlib import Path
+from typing import Callable, Dict, NamedTuple, Optional
+
+import torch
+from loguru import logger
+
+from model.utils.multi_stream import relative_right_context, window_size
+from model.utils.wavefront import layer_lookahead, wavefront_window
+
+
+# batches of this many chunks are run to measure the memory cost of a chunk
+PROBE_CHUNKS = (4, 16)
+# share of the memory budget batches are planned to use
+SAFETY_FACTOR = 0.85
+
+
+class MemoryProfile(NamedTuple):
+    base_mb: float  # process (CPU) or device (CUDA) memory before decoding: weights, runtime
+    per_chunk_mb: float  # peak memory added by every chunk of a forward_parallel_chunk batch
+
+
+def profile_key(model, args, device: torch.device) -> str:
+    """Identify what the memory cost of a chunk depends on: architecture, chunk config, dtype, device."""
+    encoder = model.encoder
+    return "|".join(str(part) for part in (
+        type(encoder).__name__, encoder.num_blocks, encoder._output_size, encoder.attention_heads,
+        encoder.cnn_module_kernel, encoder.embed.subsampling_factor,
+        args.chunk_size, args.left_context_size, args.right_context_size,
+        getattr(args, "autocast_dtype", None) or "fp32", device.type,
+    ))
+
+
+def reset_peak_memory(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    else:
+        # Linux: "5" resets the peak resident set size (VmHWM) to the current one
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+
+
+def memory_mb(device: torch.device, peak: bool) -> float:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        used = torch.cuda.max_memory_allocated(device) if peak else torch.cuda.memory_allocated(device)
+        return used / (1024 * 1024)
+    field = "VmHWM:" if peak else "VmRSS:"
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1]) / 1024
+    raise OSError(f"{field} not found in /proc/self/status")
+
+
+@torch.no_grad()
+def probe_memory_profile(model, args) -> MemoryProfile:
+    """Measure the peak memory of `forward_parallel_chunk` batches on random features.
+
+    CUDA uses the allocator's peak statistics and CPU the peak RSS of the
+    process (Linux only). The per chunk cost is taken from the probe with
+    the highest cost per chunk, which errs on the safe side.
+    """
+    device = next(model.parameters()).device
+    encoder = model.encoder
+    subsampling = encoder.embed.subsampling_factor
+    size = (args.chunk_size - 1) * subsampling + encoder.embed.right_context + 1
+    step = args.chunk_size * subsampling
+
+    base_mb = memory_mb(device, peak=False)
+    per_chunk_mb = 0.0
+    for n_chunks in PROBE_CHUNKS:
+        x = torch.randn((n_chunks - 1) * step + size, 80)
+        reset_peak_memory(device)
+        encoder.forward_parallel_chunk(xs=[x],
+                                       xs_origin_lens=torch.tensor([x.shape[0]], dtype=torch.int, device=device),
+                                       chunk_size=args.chunk_size,
+                                       left_context_size=args.left_context_size,
+                                       right_context_size=args.right_context_size,
+                                       offset=torch.zeros(1, dtype=torch.int, device=device))
+        per_chunk_mb = max(per_chunk_mb, (memory_mb(device, peak=True) - base_mb) / n_chunks)
+    return MemoryProfile(round(base_mb, 1), round(max(per_chunk_mb, 0.01), 3))
+
+
+def load_profiles(path) -> Dict[str, Dict]:
+    try:
+        return json.loads(Path(path).read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_profile(path, key: str, profile: MemoryProfile) -> None:
+    path = Path(path)
+    profiles = load_profiles(path)
+    profiles[key] = profile._asdict()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(profiles, indent=2, sort_keys=True))
+    os.replace(tmp_path, path)
+
+
+def batch_chunks(duration: float, chunk_size: int, subsampling: int = 8) -> int:
+    """Chunks per batch of `batch_decode` for a `total_batch_duration`."""
+    return int(duration // 0.01) // 2 // chunk_size // subsampling
+
+
+def long_form_chunks(duration: float, model, args) -> int:
+    """Chunks of the largest encoder call long-form decoding makes for a `total_batch_duration`.
+
+    Besides its window, every call of the sequential mode runs the relative
+    right context of the whole encoder, once per stream, and every layer
+    call of the wavefront mode runs the layer lookahead.
+    """
+    chunk_size = args.chunk_size
+    subsampling = model.encoder.embed.subsampling_factor
+    mode = getattr(args, "long_form_mode", "sequential")
+    if mode == "parallel":
+        return batch_chunks(duration, chunk_size, subsampling)
+    if mode == "wavefront":
+        lookahead = layer_lookahead(model, chunk_size, args.right_context_size)
+        return (wavefront_window(duration, chunk_size, subsampling, lookahead) + lookahead) // chunk_size
+    streams = max(1, getattr(args, "max_streams", 1))
+    right_context = -(-relative_right_context(model, chunk_size, args.right_context_size) // subsampling)
+    window = window_size(duration, chunk_size, subsampling, streams)
+    return streams * -(-(window + right_context) // chunk_size)
+
+
+def batch_duration_for_budget(profile: MemoryProfile, memory_budget_mb: float, chunk_size: int,
+                              subsampling: int = 8, safety: float = SAFETY_FACTOR,
+                              chunks: Optional[Callable[[float], int]] = None) -> int:
+    """Largest `total_batch_duration` whose batches fit in `memory_budget_mb`.
+
+    `chunks` maps a duration to the chunks of the largest encoder call it
+    leads to, by default a batch of `batch_decode` (`batch_chunks`).
+
+    Raises:
+        ValueError: if not even the smallest encoder call fits in the budget.
+    """
+    max_chunks = int((memory_budget_mb * safety - profile.base_mb) // profile.per_chunk_mb)
+    if max_chunks < 1:
+        raise ValueError(f"A memory budget of {memory_budget_mb} MB is too small: "
+                         f"{profile.base_mb} MB are used before decoding and a chunk needs {profile.per_chunk_mb} MB")
+    if chunks is None:
+        def chunks(duration):
+            return batch_chunks(duration, chunk_size, subsampling)
+
+    # no encoder call runs fewer chunks than a batch of the same duration
+    low, high = 1, math.ceil(max_chunks * chunk_size * subsampling * 2 / 100) + 1
+    while low < high:
+        duration = (low + high + 1) // 2
+        if chunks(duration) > max_chunks:
+            high = duration - 1
+        else:
+            low = duration
+    if chunks(low) > max_chunks:
+        raise ValueError(f"A memory budget of {memory_budget_mb} MB is too small: the smallest encoder call "
+                         f"runs {chunks(low)} chunks of {profile.per_chunk_mb} MB, only {max_chunks} fit")
+    return low
+
+
+def tune_total_batch_duration(args, memory_budget_mb: float, profile_path=None, long_form: bool = False,
+                              model=None, char_dict=None) -> int:
+    """Pick `total_batch_duration` for the loaded model from a memory budget.
+
+    With `long_form`, the duration is sized for the encoder calls of
+    `args.long_form_mode`, window plus lookahead (`long_form_chunks`),
+    instead of the batches of `batch_decode`. The memory profile of the model and chunk configuration is read from
+    `profile_path` when an earlier run measured it, and measured (then
+    saved) otherwise. Takes `model=` / `char_dict=` keywords so that it can
+    run as an inference engine job, where the model lives.
+    """
+    device = next(model.parameters()).device
+    key = profile_key(model, args, device)
+    profiles = load_profiles(profile_path) if profile_path else {}
+    if key in profiles:
+        profile = MemoryProfile(**profiles[key])
+    else:
+        profile = probe_memory_profile(model, args)
+        logger.info("Measured memory profile {}: {}", key, profile)
+        if profile_path:
+            save_profile(profile_path, key, profile)
+    # the fixed part is what this process uses now, only the per chunk cost carries over
+    profile = profile._replace(base_mb=round(memory_mb(device, peak=False), 1))
+    chunks = (lambda duration: long_form_chunks(duration, model, args)) if long_form else None
+    duration = batch_duration_for_budget(profile, memory_budget_mb, args.chunk_size,
+                                         model.encoder.embed.subsampling_factor, chunks=chunks)
+    logger.info("total_batch_duration set to {}s for a {} MB budget{}", duration, memory_budget_mb,
+                " (long form)" if long_form else "")
+    return duration
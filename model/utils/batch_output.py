@@ -0,0 +1,137 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import jiwer
+import torch
+import torch.distributed as dist
+
+
+OUTPUT_FORMATS = {".jsonl": "jsonl", ".json": "jsonl", ".tsv": "tsv"}
+
+
+class ResultWriter:
+    """Append batch decoding results to a JSONL or TSV file as batches finish.
+
+    The output doubles as the progress checkpoint: every record carries the
+    row number of its manifest line, and the records are flushed to disk
+    batch by batch, so a restarted run reads back which rows are done
+    (`resume`) and only decodes the others. Records are in batch order,
+    not manifest order; sort on "row" when the order matters.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.format = OUTPUT_FORMATS.get(self.path.suffix.lower())
+        if self.format is None:
+            raise ValueError(f"Unsupported output format {self.path.suffix!r}, use one of {sorted(OUTPUT_FORMATS)}")
+        self.columns: Optional[List[str]] = None
+        self._file = None
+
+    def resume(self) -> Iterator[Dict]:
+        """Yield the records of a previous run, dropping a line cut short by a crash."""
+        if not self.path.exists():
+            return
+        complete = 0
+        with open(self.path, "rb") as f:
+            for number, line in enumerate(f):
+                if not line.endswith(b"\n"):
+                    break
+                complete += len(line)
+                fields = line.decode("utf-8").rstrip("\r\n")
+                if self.format == "jsonl":
+                    if fields:
+                        yield json.loads(fields)
+                elif number == 0:
+                    self.columns = fields.split("\t")
+                else:
+                    record = dict(zip(self.columns, fields.split("\t")))
+                    record["row"] = int(record["row"])
+                    yield record
+        if complete < self.path.stat().st_size:
+            with open(self.path, "r+b") as f:
+                f.truncate(complete)
+
+    def write(self, records: List[Dict]) -> None:
+        if not records:
+            return
+        if self.columns is None:
+            self.columns = list(records[0])
+        if self._file is None:
+            new = not self.path.exists() or self.path.stat().st_size == 0
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8", newline="")
+            if new and self.format == "tsv":
+                self._file.write("\t".join(self.columns) + "\n")
+        if self.format == "jsonl":
+            lines = [json.dumps(record, ensure_ascii=False) + "\n" for record in records]
+        else:
+            lines = ["\t".join(_tsv_field(record.get(column, "")) for column in self.columns) + "\n"
+                     for record in records]
+        self._file.write("".join(lines))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def rank_output_path(path, rank: int, world_size: int) -> Path:
+    """Output file of one torch.distributed rank, next to the merged `path`."""
+    path = Path(path)
+    return path.with_name(f"{path.stem}.rank{rank}-of-{world_size}{path.suffix}")
+
+
+def merge_outputs(paths: List[Path], destination) -> None:
+    """Concatenate the outputs of several ranks into `destination`, with a single TSV header."""
+    destination = Path(destination)
+    tmp_path = destination.with_name(destination.name + ".tmp")
+    header = None
+    with open(tmp_path, "wb") as out:
+        for path in paths:
+            if not path.exists():
+                continue
+            with open(path, "rb") as f:
+                if destination.suffix.lower() == ".tsv":
+                    first = f.readline()
+                    if header is None:
+                        header = first
+                        out.write(first)
+                while True:
+                    block = f.read(1024 * 1024)
+                    if not block:
+                        break
+                    out.write(block)
+    os.replace(tmp_path, destination)
+
+
+def _tsv_field(value) -> str:
+    # keep one record per line whatever the transcription contains
+    return str(value).replace("\t", " ").replace("\n", " ").replace("\r", " ")
+
+
+class WerCounter:
+    """Word error rate accumulated over batches instead of over the whole manifest at once."""
+    def __init__(self):
+        self.errors = 0
+        self.reference_words = 0
+
+    def update(self, references: List[str], hypotheses: List[str]) -> None:
+        pairs = [(str(ref), str(hyp)) for ref, hyp in zip(references, hypotheses) if str(ref).strip()]
+        if not pairs:
+            return
+        result = jiwer.process_words([ref for ref, _ in pairs], [hyp for _, hyp in pairs])
+        self.errors += result.substitutions + result.deletions + result.insertions
+        self.reference_words += result.substitutions + result.deletions + result.hits
+
+    def all_reduce(self) -> None:
+        """Add up the counts of every torch.distributed rank, on every rank."""
+        counts = torch.tensor([self.errors, self.reference_words], dtype=torch.float64)
+        dist.all_reduce(counts)
+        self.errors, self.reference_words = int(counts[0]), int(counts[1])
+
+    @property
+    def wer(self) -> Optional[float]:
+        return self.errors / self.reference_words if self.reference_words else None
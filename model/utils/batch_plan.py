@@ -0,0 +1,97 @@
+import os
+from typing import List, Optional, Sequence
+
+from model.utils.audio import parse_wav_header, soundfile
+
+
+# bytes read from the start of a WAV file to find its "data" chunk
+WAV_PROBE_BYTES = 64 * 1024
+
+
+def probe_duration(audio_path) -> Optional[float]:
+    """Read the duration of an audio file, in seconds, without decoding it.
+
+    WAV durations come from the header, FLAC ones from `soundfile` when it
+    is installed and anything else from `ffprobe` (through pydub).
+
+    Returns:
+        the duration, or None when it cannot be found out cheaply.
+    """
+    try:
+        with open(audio_path, "rb") as f:
+            header = f.read(WAV_PROBE_BYTES)
+        info = parse_wav_header(header)
+        if info is not None:
+            # streamed WAV files often leave the data size at 0 or 0xFFFFFFFF
+            data_size = os.path.getsize(audio_path) - info.data_offset
+            if 0 < info.data_size < data_size:
+                data_size = info.data_size
+            frame_bytes = info.channels * info.bits_per_sample // 8
+            return data_size // frame_bytes / info.sample_rate
+        if soundfile is not None and header[:4] == b"fLaC":
+            return soundfile.info(audio_path).duration
+        from pydub.utils import mediainfo
+        return float(mediainfo(audio_path)["duration"])
+    except Exception:
+        return None
+
+
+def duration_to_frames(duration: float, sample_rate: int = 16000,
+                       frame_length: int = 25, frame_shift: int = 10) -> int:
+    """Number of fbank frames computed from `duration` seconds of audio."""
+    num_samples = int(duration * sample_rate)
+    window_size = sample_rate * frame_length // 1000
+    window_shift = sample_rate * frame_shift // 1000
+    if num_samples < window_size:
+        return 0
+    return 1 + (num_samples - window_size) // window_shift
+
+
+def num_chunks(num_frames: int, chunk_size: int, subsampling: int = 8, context: int = 15) -> int:
+    """Number of chunks `forward_parallel_chunk` splits `num_frames` fbank frames into.
+
+    Every chunk costs the same whatever it holds, so this, not the duration,
+    is what an utterance costs in a batch: the last chunk is padded up to
+    the full chunk size.
+
+    Args:
+        num_frames: fbank frames (10 ms) of the utterance.
+        chunk_size: encoder frames per chunk.
+        subsampling: `model.encoder.embed.subsampling_factor`.
+        context: `model.encoder.embed.right_context + 1`.
+    """
+    size = (chunk_size - 1) * subsampling + context
+    step = subsampling * chunk_size
+    if num_frames <= size:
+        return 1
+    return 1 + -(-(num_frames - size) // step)
+
+
+def plan_batches(durations: Sequence[Optional[float]], max_chunks: int, chunk_size: int,
+                 subsampling: int = 8, context: int = 15) -> List[List[int]]:
+    """Group utterances into batches of at most `max_chunks` chunks.
+
+    Utterances are taken longest first, so that the utterances of a batch
+    have similar lengths and a batch is only closed when the next one
+    really doesn't fit. An utterance over the budget on its own, or whose
+    duration is unknown (None), is decoded alone.
+
+    Returns:
+        batches of indices into `durations`; every index appears once.
+    """
+    known = [i for i, duration in enumerate(durations) if duration is not None]
+    known.sort(key=lambda i: durations[i], reverse=True)
+
+    batches = []
+    batch, batch_chunks = [], 0
+    for i in known:
+        chunks = num_chunks(duration_to_frames(durations[i]), chunk_size, subsampling, context)
+        if batch and batch_chunks + chunks > max_chunks:
+            batches.append(batch)
+            batch, batch_chunks = [], 0
+        batch.append(i)
+        batch_chunks += chunks
+    if batch:
+        batches.append(batch)
+    batches += [[i] for i, duration in enumerate(durations) if duration is None]
+    return batches
@@ -0,0 +1,121 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+from loguru import logger
+
+
+class MicroBatcher:
+    """Collect single-utterance requests into micro-batches.
+
+    Requests are queued by `submit` and flushed to `batch_fn` as soon as
+    either `max_wait_ms` has elapsed since the first request of the batch,
+    the accumulated audio reaches `max_batch_duration` seconds, or
+    `max_batch_size` requests are waiting. `batch_fn` receives the list of
+    items and must return one result per item, in the same order.
+    """
+    def __init__(self,
+                 batch_fn: Callable[[List[Any]], Awaitable[List[Any]]],
+                 max_wait_ms: float = 50,
+                 max_batch_duration: float = 600,
+                 max_batch_size: int = 64):
+        self.batch_fn = batch_fn
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_duration = max_batch_duration
+        self.max_batch_size = max_batch_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._carry: Optional[Tuple[Any, float, asyncio.Future]] = None
+        self._inflight: List[Tuple[Any, float, asyncio.Future]] = []
+
+    def start(self) -> None:
+        """Start the background flushing loop on the running event loop."""
+        if self._worker is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the flushing loop and fail every request still waiting."""
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+
+        pending = self._inflight + ([self._carry] if self._carry is not None else [])
+        self._inflight = []
+        self._carry = None
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        for _, _, future in pending:
+            if not future.done():
+                future.set_exception(RuntimeError("Micro-batcher stopped"))
+
+    def qsize(self) -> int:
+        """Number of requests waiting for the next batch."""
+        waiting = self._queue.qsize() if self._queue is not None else 0
+        return waiting + (self._carry is not None)
+
+    async def submit(self, item: Any, duration: float) -> Any:
+        """Queue one item of `duration` seconds and wait for its result."""
+        if self._worker is None:
+            raise RuntimeError("Micro-batcher is not running")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, duration, future))
+        return await future
+
+    async def _collect(self) -> List[Tuple[Any, float, asyncio.Future]]:
+        if self._carry is not None:
+            first, self._carry = self._carry, None
+        else:
+            first = await self._queue.get()
+        batch = [first]
+        total_duration = first[1]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size and total_duration < self.max_batch_duration:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                entry = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if total_duration + entry[1] > self.max_batch_duration:
+                # keep it for the next batch rather than overshoot the budget
+                self._carry = entry
+                break
+            batch.append(entry)
+            total_duration += entry[1]
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect()
+            # requests whose client went away don't need to be decoded
+            batch = [entry for entry in batch if not entry[2].done()]
+            if not batch:
+                continue
+
+            self._inflight = batch
+            items = [item for item, _, _ in batch]
+            logger.debug("Flushing micro-batch of {} requests ({:.1f}s of audio)",
+                         len(items), sum(duration for _, duration, _ in batch))
+            try:
+                results = await self.batch_fn(items)
+            except Exception as e:
+                self._inflight = []
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self._inflight = []
+
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
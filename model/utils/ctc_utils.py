@@ -1,4 +1,5 @@
 import math
+import torch
 from .common import remove_duplicates_and_blank
 
 def class2str(target, char_dict):
@@ -38,51 +39,78 @@ def get_output(hyps, char_dict):
     return decodes
 
 
-def get_output_with_timestamps(hyps, char_dict):
-    decodes = []
-    max_silence = 20
-    for tokens in hyps: # cost O(input_batch_size | ccu)
-        tokens = tokens.cpu()
-        start = -1
-        end = -1
-        prev_end = -1
-        silence_cum = 0
-        decode_per_time = []
+class CTCSegmenter:
+    """Split a greedy CTC token stream into timestamped segments.
+
+    A segment is closed after `max_silence` consecutive blank frames. Tokens
+    can be fed in pieces (e.g. window by window while streaming); each call
+    to `accept` returns the segments that were closed by the new tokens.
+    """
+    def __init__(self, char_dict, max_silence=20):
+        self.char_dict = char_dict
+        self.max_silence = max_silence
+        self.time_stamp = -1
+        self.start = -1
+        self.end = -1
+        self.prev_end = -1
+        self.silence_cum = 0
+        self.decode_per_time = []
+
+    def _item(self, end):
+        return {
+            "decode": class2str(remove_duplicates_and_blank(self.decode_per_time), self.char_dict),
+            "start": milliseconds_to_hhmmssms(self.start * 8 * 10),
+            "end": milliseconds_to_hhmmssms(end * 8 * 10)
+        }
+
+    def accept(self, tokens):
+        """Consume the next frames' token ids and return the closed segments."""
+        if torch.is_tensor(tokens):
+            tokens = tokens.cpu().tolist()
         decode = []
-        for time_stamp, token in enumerate(tokens):
+        for token in tokens:
+            self.time_stamp += 1
             if token == 0:
-                silence_cum += 1
+                self.silence_cum += 1
             else:
-                if (start == -1) and (end == -1):
-                    if prev_end != -1:
-                        start = math.ceil((time_stamp + prev_end)/2)
+                if (self.start == -1) and (self.end == -1):
+                    if self.prev_end != -1:
+                        self.start = math.ceil((self.time_stamp + self.prev_end)/2)
                     else:
-                        start = max(time_stamp - int(max_silence/2), 0)
-                silence_cum = 0
-                decode_per_time.append(token)
-                    
-            if (silence_cum == max_silence) and (start != -1):
-                end = time_stamp
-                prev_end = end
-                item = {
-                    "decode": class2str(remove_duplicates_and_blank(decode_per_time), char_dict),
-                    "start": milliseconds_to_hhmmssms(start * 8 * 10),
-                    "end": milliseconds_to_hhmmssms(end * 8 * 10)
-                }
-                decode.append(item)
-                decode_per_time = []
-                start = -1
-                end = -1
-                silence_cum = 0
-            
-
-        if (start != -1) and (end == -1) and (len(decode_per_time) > 0):
-            item = {
-                "decode": class2str(remove_duplicates_and_blank(decode_per_time), char_dict),
-                "start": milliseconds_to_hhmmssms(start * 8 * 10),
-                "end": milliseconds_to_hhmmssms(time_stamp * 8 * 10)
-            }
-            decode.append(item)
+                        self.start = max(self.time_stamp - int(self.max_silence/2), 0)
+                self.silence_cum = 0
+                self.decode_per_time.append(token)
+
+            if (self.silence_cum == self.max_silence) and (self.start != -1):
+                self.end = self.time_stamp
+                self.prev_end = self.end
+                decode.append(self._item(self.end))
+                self.decode_per_time = []
+                self.start = -1
+                self.end = -1
+                self.silence_cum = 0
+        return decode
+
+    def partial(self):
+        """The segment that is still open, or None."""
+        if (self.start != -1) and (len(self.decode_per_time) > 0):
+            return self._item(self.time_stamp)
+        return None
+
+    def finalize(self):
+        """Close the open segment at the end of the stream."""
+        item = self.partial()
+        self.decode_per_time = []
+        self.start = -1
+        return [item] if item is not None else []
+
+
+def get_output_with_timestamps(hyps, char_dict):
+    decodes = []
+    for tokens in hyps: # cost O(input_batch_size | ccu)
+        segmenter = CTCSegmenter(char_dict)
+        decode = segmenter.accept(tokens)
+        decode += segmenter.finalize()
         decodes.append(decode)
 
-    return decodes
\ No newline at end of file
+    return decodes
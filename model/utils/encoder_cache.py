@@ -0,0 +1,73 @@
+from typing import List, Optional, Tuple
+
+import torch
+
+
+class EncoderCache:
+    """Attention / convolution caches of every encoder layer, preallocated on the compute device.
+
+    `att_cache` is (num_blocks, left_context_size, heads, 2 * d_k) and
+    `cnn_cache` is (num_blocks, channels, lorder), with a stream axis after
+    the layer axis when `streams` is given, one slot per stream.
+    Passed to `forward_parallel_chunk` with `update_caches_in_place=True`,
+    they are overwritten with the new caches layer by layer, so decoding
+    window after window neither allocates caches nor copies them to the
+    host. They only leave the device when `offload` is called, e.g. for a
+    streaming session that has gone idle; `restore` brings them back.
+    """
+    def __init__(self, model, left_context_size: int, streams: Optional[int] = None, device=None):
+        encoder = model.encoder
+        device = device if device is not None else next(model.parameters()).device
+        stream_axis = () if streams is None else (streams,)
+        self.att_cache = torch.zeros((encoder.num_blocks,) + stream_axis + (
+            left_context_size, encoder.attention_heads, encoder._output_size * 2 // encoder.attention_heads),
+            device=device)
+        self.cnn_cache = torch.zeros((encoder.num_blocks,) + stream_axis + (
+            encoder._output_size, encoder.cnn_module_kernel // 2), device=device)
+
+    @property
+    def device(self) -> torch.device:
+        return self.att_cache.device
+
+    def reset(self, slot: Optional[int] = None) -> None:
+        """Zero the caches, or those of one stream slot."""
+        if slot is None:
+            self.att_cache.zero_()
+            self.cnn_cache.zero_()
+        else:
+            self.att_cache[:, slot].zero_()
+            self.cnn_cache[:, slot].zero_()
+
+    def update(self, layer: int, att_cache: torch.Tensor, cnn_cache: torch.Tensor) -> None:
+        """Overwrite the caches of one layer with those it returned."""
+        self.att_cache[layer].copy_(att_cache)
+        self.cnn_cache[layer].copy_(cnn_cache)
+
+    def gather(self, slots: List[int]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Caches of the given stream slots, stacked along the stream axis in that order.
+
+        The first slots in order are a view of the buffers, so the encoder
+        updates them directly; other selections are copied and need `scatter`.
+        """
+        if slots == list(range(len(slots))):
+            return self.att_cache[:, :len(slots)], self.cnn_cache[:, :len(slots)]
+        index = torch.tensor(slots, device=self.device)
+        return self.att_cache.index_select(1, index), self.cnn_cache.index_select(1, index)
+
+    def scatter(self, slots: List[int], att_cache: torch.Tensor, cnn_cache: torch.Tensor) -> None:
+        """Write back caches returned for the stream slots of `gather`."""
+        if att_cache.data_ptr() == self.att_cache.data_ptr() and cnn_cache.data_ptr() == self.cnn_cache.data_ptr():
+            return
+        index = torch.tensor(slots, device=self.device)
+        self.att_cache.index_copy_(1, index, att_cache)
+        self.cnn_cache.index_copy_(1, index, cnn_cache)
+
+    def offload(self) -> None:
+        """Move the caches to host memory."""
+        self.att_cache = self.att_cache.cpu()
+        self.cnn_cache = self.cnn_cache.cpu()
+
+    def restore(self, device) -> None:
+        """Move offloaded caches back to the compute device."""
+        self.att_cache = self.att_cache.to(device)
+        self.cnn_cache = self.cnn_cache.to(device)
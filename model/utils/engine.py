@@ -0,0 +1,341 @@
+import asyncio
+import collections
+import itertools
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Deque, Dict, Optional
+
+import torch
+import torch.multiprocessing as mp
+from loguru import logger
+
+from model.utils import profiling
+from model.utils.metrics import REGISTRY
+
+
+class EngineBusyError(RuntimeError):
+    """Raised when the inference queue is full and a job cannot be accepted."""
+
+
+_STOP = object()
+
+
+class InferenceEngine:
+    """Own the model and run every inference job on a dedicated thread.
+
+    Jobs are callables that take the model and the character dictionary as
+    `model=` / `char_dict=` keyword arguments, which matches the signature of
+    the decode.py entry points (`endless_decode`, `batch_decode`, ...). The
+    queue is bounded so that callers get an `EngineBusyError` instead of
+    piling up unbounded work behind a long recording.
+    """
+    def __init__(self, max_queue_size: int = 32, name: str = "inference-engine"):
+        self.max_queue_size = max_queue_size
+        self.name = name
+        self.model = None
+        self.char_dict = None
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def qsize(self) -> int:
+        """Number of jobs waiting for the worker thread."""
+        return self._queue.qsize()
+
+    @property
+    def local(self) -> "InferenceEngine":
+        """Engine for stateful jobs that must run in this process."""
+        return self
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Let queued jobs finish, then stop the worker thread."""
+        if not self.running:
+            return
+        self._queue.put((_STOP, None, None, None))
+        self._thread.join(timeout)
+        self._thread = None
+
+    def load(self, init_fn: Callable, *args) -> None:
+        """Build the model on the worker thread with `init_fn(*args)`.
+
+        `init_fn` must return `(model, char_dict)`, like `decode.init`.
+        Blocks until the model is ready.
+        """
+        self.start()
+        future: Future = Future()
+
+        def _load(model=None, char_dict=None):
+            self.model, self.char_dict = init_fn(*args)
+
+        self._queue.put((_load, (), {}, future))
+        future.result()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """Queue `fn(*args, **kwargs, model=..., char_dict=...)` for the worker.
+
+        Raises:
+            EngineBusyError: if `max_queue_size` jobs are already waiting.
+        """
+        if not self.running:
+            raise RuntimeError("Inference engine is not running")
+        future: Future = Future()
+        try:
+            self._queue.put_nowait((fn, args, kwargs, future))
+        except queue.Full:
+            raise EngineBusyError(f"Inference queue is full ({self.max_queue_size} jobs waiting)")
+        return future
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """Awaitable version of `submit` for asyncio handlers."""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _run(self) -> None:
+        while True:
+            fn, args, kwargs, future = self._queue.get()
+            if fn is _STOP:
+                break
+            # skip jobs whose caller has already given up on them
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs, model=self.model, char_dict=self.char_dict)
+            except BaseException as e:
+                logger.exception("Inference job {} failed", getattr(fn, "__name__", fn))
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+
+def _worker_main(index: int, tasks, results, model, char_dict, num_threads: int, cpus) -> None:
+    """Loop of a forked inference worker; `model` is inherited from the parent."""
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+    # a profiler running in the parent at fork time is not ours
+    profiling.stop()
+    # nor are the measurements inherited with it; the parent already counts them
+    REGISTRY.drain()
+    while True:
+        job = tasks.get()
+        if job is None:
+            break
+        job_id, fn, args, kwargs, profile = job
+        # the job is profiled when the parent was profiling as it was submitted
+        if profile:
+            profiling.start()
+        try:
+            result = fn(*args, **kwargs, model=model, char_dict=char_dict)
+            kind = "done"
+        except BaseException as e:
+            result, kind = RuntimeError(f"{type(e).__name__}: {e}"), "failed"
+        profiler = profiling.stop()
+        # stage timings recorded here are shipped to the parent's /metrics and profiler
+        results.put((kind, index, job_id, (result, REGISTRY.drain(), profiler.drain() if profiler else [])))
+
+
+class ProcessInferenceEngine(InferenceEngine):
+    """Run inference jobs in forked CPU worker processes sharing one model.
+
+    The checkpoint is loaded once in the parent and its parameters are moved
+    to shared memory before `num_workers` processes are forked, so every
+    worker references the same weights instead of holding its own copy.
+    Each worker runs with `threads_per_worker` intra-op threads, optionally
+    pinned to its own block of cores.
+
+    Jobs are handed to idle workers one at a time by the parent, which
+    therefore always knows what a worker was running when it dies. Jobs and
+    their arguments are pickled to the workers, so they must be module level
+    functions (`decode.endless_decode`, ...). Jobs that mutate state living in
+    the parent, like streaming sessions, go through `local`, an in-process
+    engine thread that uses the same shared weights.
+    """
+    def __init__(self,
+                 max_queue_size: int = 32,
+                 num_workers: int = 4,
+                 threads_per_worker: int = 0,
+                 pin_cpus: bool = False,
+                 name: str = "inference-engine"):
+        super().__init__(max_queue_size=max_queue_size, name=name)
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // num_workers)
+        self.pin_cpus = pin_cpus
+        self._local = InferenceEngine(max_queue_size=max_queue_size, name=f"{name}-local")
+        self._ctx = mp.get_context("fork")
+        self._results = None
+        self._workers = []
+        self._task_queues = []
+        self._dispatcher: Optional[threading.Thread] = None
+        self._backlog: Deque = collections.deque()
+        self._pending: Dict[int, Future] = {}
+        self._running_jobs: Dict[int, int] = {}
+        self._idle = set()
+        self._stopping = False
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count()
+
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    @property
+    def local(self) -> InferenceEngine:
+        return self._local
+
+    def qsize(self) -> int:
+        with self._lock:
+            return len(self._backlog)
+
+    def start(self) -> None:
+        """Workers are forked by `load`, once the model exists."""
+        self._local.start()
+
+    def load(self, init_fn: Callable, *args) -> None:
+        """Load the model in this process, share its weights and fork the workers."""
+        if self.running:
+            raise RuntimeError("Inference workers are already running")
+        self.model, self.char_dict = init_fn(*args)
+        self.model.share_memory()
+        self._local.model, self._local.char_dict = self.model, self.char_dict
+        self._local.start()
+
+        self._results = self._ctx.Queue()
+        self._task_queues = [self._ctx.Queue() for _ in range(self.num_workers)]
+        self._workers = [self._spawn(index) for index in range(self.num_workers)]
+        self._idle = set(range(self.num_workers))
+        self._stopping = False
+        self._dispatcher = threading.Thread(target=self._dispatch, name=f"{self.name}-dispatcher", daemon=True)
+        self._dispatcher.start()
+        logger.info("Started {} inference workers with {} threads each", self.num_workers, self.threads_per_worker)
+
+    def _spawn(self, index: int):
+        cpus = None
+        if self.pin_cpus and hasattr(os, "sched_setaffinity"):
+            available = sorted(os.sched_getaffinity(0))
+            block = available[index * self.threads_per_worker:(index + 1) * self.threads_per_worker]
+            cpus = set(block) or None
+        worker = self._ctx.Process(
+            target=_worker_main,
+            args=(index, self._task_queues[index], self._results, self.model, self.char_dict,
+                  self.threads_per_worker, cpus),
+            name=f"{self.name}-{index}",
+            daemon=True,
+        )
+        worker.start()
+        return worker
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._local.stop(timeout)
+        if not self.running:
+            return
+        with self._lock:
+            self._stopping = True
+        for tasks in self._task_queues:
+            tasks.put(None)
+        for worker in self._workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+        self._results.put(("stop", None, None, None))
+        self._dispatcher.join(timeout)
+        self._dispatcher = None
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._backlog.clear()
+            self._running_jobs = {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(RuntimeError("Inference engine stopped"))
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        if not self.running:
+            raise RuntimeError("Inference engine is not running")
+        future: Future = Future()
+        future.set_running_or_notify_cancel()
+        with self._lock:
+            if len(self._backlog) >= self.max_queue_size:
+                raise EngineBusyError(f"Inference queue is full ({self.max_queue_size} jobs waiting)")
+            job_id = next(self._job_ids)
+            self._pending[job_id] = future
+            self._backlog.append((job_id, fn, args, kwargs, profiling.active() is not None))
+            self._assign()
+        return future
+
+    def _assign(self) -> None:
+        """Hand queued jobs to idle workers; called with the lock held."""
+        while self._idle and self._backlog:
+            index = self._idle.pop()
+            job = self._backlog.popleft()
+            self._running_jobs[index] = job[0]
+            self._task_queues[index].put(job)
+
+    def _dispatch(self) -> None:
+        while True:
+            try:
+                kind, index, job_id, payload = self._results.get(timeout=1.0)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            if kind == "stop":
+                break
+            payload, measurements, events = payload
+            REGISTRY.merge(measurements)
+            profiler = profiling.active()
+            if profiler is not None and events:
+                profiler.merge(events)
+            with self._lock:
+                future = self._pending.pop(job_id, None)
+                self._running_jobs.pop(index, None)
+                self._idle.add(index)
+                self._assign()
+            if future is not None:
+                if kind == "done":
+                    future.set_result(payload)
+                else:
+                    future.set_exception(payload)
+            # results keep flowing while other workers are busy, so look for
+            # dead workers here too, not only when the queue goes quiet
+            self._check_workers()
+
+    def _check_workers(self) -> None:
+        """Replace dead workers and fail the job they were running."""
+        for index, worker in enumerate(self._workers):
+            if worker.is_alive():
+                continue
+            with self._lock:
+                # workers leaving on `stop`'s sentinel are not replaced
+                if self._stopping:
+                    return
+                job_id = self._running_jobs.pop(index, None)
+                future = self._pending.pop(job_id, None) if job_id is not None else None
+                self._task_queues[index] = self._ctx.Queue()
+                self._workers[index] = self._spawn(index)
+                self._idle.add(index)
+                self._assign()
+            logger.error("Inference worker {} died with exit code {}, restarted it", index, worker.exitcode)
+            if future is not None:
+                future.set_exception(RuntimeError(f"Inference worker died with exit code {worker.exitcode}"))
+
+
+def create_engine(engine_config: Dict) -> InferenceEngine:
+    """Build the inference engine described by the `engine` config section."""
+    if engine_config.get('mode', 'thread') == 'process':
+        return ProcessInferenceEngine(
+            max_queue_size=engine_config['max_queue_size'],
+            num_workers=engine_config['num_workers'],
+            threads_per_worker=engine_config['threads_per_worker'],
+            pin_cpus=engine_config['pin_cpus'],
+        )
+    return InferenceEngine(max_queue_size=engine_config['max_queue_size'])
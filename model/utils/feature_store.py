@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+
+from model.utils.features import FBANK_CONF
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS features (
+    key TEXT PRIMARY KEY,
+    shard TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    frames INTEGER NOT NULL,
+    dtype TEXT NOT NULL
+);
+"""
+
+
+def feature_key(audio_path, fbank_conf: Optional[Dict] = None) -> str:
+    """Identify the features of a file: its path, size and mtime plus the fbank parameters.
+
+    Rewriting the file or changing the fbank parameters changes the key, so
+    stale features are never served; they are only left behind on disk.
+    """
+    path = Path(audio_path).resolve()
+    stat = path.stat()
+    digest = hashlib.sha256(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    digest.update(json.dumps(fbank_conf or FBANK_CONF, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class FeatureStore:
+    """On-disk cache of (T, 80) fbank features, read back through memory maps.
+
+    Features are appended to shard files of up to `shard_mb` MB and located
+    through a SQLite index, so that repeated runs over the same files (e.g.
+    sweeps over the chunk and context sizes) skip audio decoding and fbank
+    entirely. Every store instance appends to shards of its own, so several
+    processes can fill one directory at the same time.
+    """
+    def __init__(self, directory, dtype: str = "float16", shard_mb: int = 1024):
+        self.directory = Path(directory)
+        self.dtype = np.dtype(dtype)
+        self.shard_bytes = shard_mb * 1024 * 1024
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.directory / "index.sqlite3", timeout=30,
+                                   isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._maps: Dict[str, np.memmap] = {}
+        self._writer = None
+        self._writer_name = None
+        self._writer_size = 0
+
+    def _lookup(self, key: str):
+        with self._lock:
+            return self._db.execute("SELECT shard, offset, frames, dtype FROM features WHERE key = ?",
+                                    (key,)).fetchone()
+
+    def num_frames(self, audio_path) -> Optional[int]:
+        """Number of cached feature frames of `audio_path`, None when not cached."""
+        try:
+            row = self._lookup(feature_key(audio_path))
+        except OSError:
+            return None
+        return row[2] if row is not None else None
+
+    def get(self, audio_path) -> Optional[torch.Tensor]:
+        """Cached float32 (T, 80) features of `audio_path`, or None."""
+        row = self._lookup(feature_key(audio_path))
+        if row is None:
+            return None
+        shard, offset, frames, dtype = row
+        dtype = np.dtype(dtype)
+        end = offset + frames * FBANK_CONF['num_mel_bins'] * dtype.itemsize
+        with self._lock:
+            data = self._maps.get(shard)
+            if data is None or len(data) < end:
+                # shards still being appended to are mapped again once they grew
+                data = self._maps[shard] = np.memmap(self.directory / shard, dtype=np.uint8, mode="c")
+        feats = torch.from_numpy(data[offset:end].view(dtype).reshape(frames, -1))
+        return feats if feats.dtype == torch.float32 else feats.float()
+
+    def put(self, audio_path, feats: torch.Tensor) -> torch.Tensor:
+        """Store the features of `audio_path`; returns them as `get` will, in the stored precision.
+
+        Decoding the returned features rather than `feats` gives the run that
+        fills the store the same transcripts as the runs reading from it.
+        """
+        key = feature_key(audio_path)
+        stored = feats.detach().cpu().numpy().astype(self.dtype, copy=False)
+        data = stored.tobytes()
+        with self._lock:
+            if self._writer is None or self._writer_size + len(data) > self.shard_bytes:
+                self._open_shard()
+            offset = self._writer_size
+            self._writer.write(data)
+            # the data is on disk before the index points to it
+            self._writer.flush()
+            self._writer_size += len(data)
+            self._db.execute("INSERT OR REPLACE INTO features (key, shard, offset, frames, dtype) "
+                             "VALUES (?, ?, ?, ?, ?)",
+                             (key, self._writer_name, offset, feats.shape[0], self.dtype.str))
+        stored = torch.from_numpy(stored)
+        return stored if stored.dtype == torch.float32 else stored.float()
+
+    def _open_shard(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        self._writer_name = f"shard-{os.getpid()}-{uuid.uuid4().hex[:8]}.bin"
+        self._writer = open(self.directory / self._writer_name, "wb")
+        self._writer_size = 0
+
+    def close(self) -> None:
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            self._maps.clear()
+            self._db.close()
@@ -0,0 +1,52 @@
+from typing import Optional
+
+import torch
+import torchaudio.compliance.kaldi as kaldi
+
+from model.utils import metrics
+
+
+FBANK_CONF = dict(
+    num_mel_bins=80,
+    frame_length=25,
+    frame_shift=10,
+    dither=0.0,
+    energy_floor=0.0,
+    sample_frequency=16000,
+)
+
+
+def compute_fbank(waveform: torch.Tensor) -> torch.Tensor:
+    """Compute the (T, 80) log-mel filterbank features the model expects."""
+    with metrics.stage("fbank"):
+        return kaldi.fbank(waveform, **FBANK_CONF)
+
+
+class FbankStream:
+    """Compute fbank features incrementally from a stream of samples.
+
+    Kaldi frames (with `snip_edges`) only depend on the samples inside their
+    own window, so feeding the audio piece by piece and keeping the samples
+    of the not yet complete frames gives exactly the features of the whole
+    recording.
+    """
+    def __init__(self):
+        sample_frequency = FBANK_CONF['sample_frequency']
+        self.window_size = int(sample_frequency * FBANK_CONF['frame_length'] / 1000)
+        self.window_shift = int(sample_frequency * FBANK_CONF['frame_shift'] / 1000)
+        self._samples = torch.zeros(1, 0)
+        self.num_frames = 0
+
+    def accept_waveform(self, waveform: torch.Tensor) -> Optional[torch.Tensor]:
+        """Append (1, T) samples and return the newly completed frames, if any."""
+        self._samples = torch.cat([self._samples, waveform.to(torch.float32)], dim=1)
+        n_samples = self._samples.size(1)
+        if n_samples < self.window_size:
+            return None
+
+        n_frames = 1 + (n_samples - self.window_size) // self.window_shift
+        used = (n_frames - 1) * self.window_shift + self.window_size
+        feats = compute_fbank(self._samples[:, :used])
+        self._samples = self._samples[:, n_frames * self.window_shift:]
+        self.num_frames += n_frames
+        return feats
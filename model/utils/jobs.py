@@ -0,0 +1,321 @@
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from model.utils.engine import EngineBusyError
+
+
+PENDING = "pending"
+PROCESSING = "processing"
+COMPLETED = "completed"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    results TEXT NOT NULL DEFAULT '[]',
+    errors TEXT NOT NULL DEFAULT '[]',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+"""
+
+
+class QueueFullError(RuntimeError):
+    """Raised when too many jobs are already waiting to be processed."""
+
+
+def _iso(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+class JobStore:
+    """Durable batch job queue backed by a local SQLite database.
+
+    Several processes on one host can share the database file, which must
+    live on a local disk (WAL mode does not work over network filesystems)
+    and so must the uploads the jobs refer to. Jobs are claimed inside
+    an immediate transaction and held with a lease that the consumer renews
+    while it works. A job whose lease runs out (its worker crashed or was
+    killed by a deploy) becomes claimable again, up to `max_attempts` times.
+    Finished jobs are kept for `result_ttl_hours` and then removed by
+    `expire`.
+    """
+    def __init__(self,
+                 path,
+                 lease_seconds: float = 300,
+                 max_attempts: int = 3,
+                 max_pending: int = 1000,
+                 result_ttl_hours: float = 24):
+        self.path = Path(path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self.result_ttl_hours = result_ttl_hours
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections must not be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self) -> "_Transaction":
+        return _Transaction(self._connection())
+
+    def create(self, payload: Dict, job_id: Optional[str] = None) -> str:
+        """Queue a new job and return its id.
+
+        Raises:
+            QueueFullError: if `max_pending` jobs are already waiting.
+        """
+        job_id = job_id or str(uuid.uuid4())
+        now = time.time()
+        with self._transaction() as conn:
+            pending = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (PENDING,)).fetchone()[0]
+            if pending >= self.max_pending:
+                raise QueueFullError(f"Job queue is full ({pending} jobs waiting)")
+            conn.execute(
+                "INSERT INTO jobs (id, status, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, PENDING, json.dumps(payload), now, now),
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """Public view of a job: status, results, errors and last update time."""
+        # a plain read: status polls must not take the write lock
+        row = self._connection().execute("SELECT status, results, errors, updated_at FROM jobs WHERE id = ?",
+                                         (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "status": row["status"],
+            "results": json.loads(row["results"]),
+            "errors": json.loads(row["errors"]),
+            "last_updated": _iso(row["updated_at"]),
+        }
+
+    def claim(self, worker_id: str) -> Optional[Tuple[str, Dict]]:
+        """Lease the oldest runnable job to `worker_id`.
+
+        Jobs that are processing under an expired lease are taken over; those
+        that already used up `max_attempts` are marked failed instead.
+
+        Returns:
+            `(job_id, payload)`, or None when there is nothing to do.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, errors = json_insert(errors, '$[#]', ?), lease_owner = NULL, "
+                "updated_at = ? WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                (FAILED, "Worker stopped before the job completed", now, PROCESSING, now, self.max_attempts),
+            )
+            row = conn.execute(
+                "SELECT id, payload FROM jobs WHERE status = ? OR (status = ? AND lease_expires < ?) "
+                "ORDER BY created_at LIMIT 1",
+                (PENDING, PROCESSING, now),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_owner = ?, lease_expires = ?, "
+                "updated_at = ? WHERE id = ?",
+                (PROCESSING, worker_id, now + self.lease_seconds, now, row["id"]),
+            )
+        return row["id"], json.loads(row["payload"])
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        """Extend the lease; False if the job is no longer held by `worker_id`."""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND status = ? AND lease_owner = ?",
+                (time.time() + self.lease_seconds, job_id, PROCESSING, worker_id),
+            )
+        return cursor.rowcount == 1
+
+    def release(self, job_id: str, worker_id: str) -> None:
+        """Give a claimed job back to the queue without counting the attempt."""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts - 1, lease_owner = NULL, lease_expires = NULL, "
+                "updated_at = ? WHERE id = ? AND lease_owner = ?",
+                (PENDING, time.time(), job_id, worker_id),
+            )
+
+    def complete(self, job_id: str, worker_id: str, results: List) -> bool:
+        """Store the results of a job; False if it is no longer held by `worker_id`."""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, results = ?, lease_owner = NULL, updated_at = ? "
+                "WHERE id = ? AND lease_owner = ?",
+                (COMPLETED, json.dumps(results), time.time(), job_id, worker_id),
+            )
+        return cursor.rowcount == 1
+
+    def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        """Mark a job failed; False if it is no longer held by `worker_id`."""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, errors = json_insert(errors, '$[#]', ?), lease_owner = NULL, "
+                "updated_at = ? WHERE id = ? AND lease_owner = ?",
+                (FAILED, error, time.time(), job_id, worker_id),
+            )
+        return cursor.rowcount == 1
+
+    def expire(self) -> List[Dict]:
+        """Delete finished jobs older than `result_ttl_hours`; return their payloads."""
+        cutoff = time.time() - self.result_ttl_hours * 3600
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT id, payload FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+                                (COMPLETED, FAILED, cutoff)).fetchall()
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(row["id"],) for row in rows])
+        return [json.loads(row["payload"]) for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        rows = self._connection().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+
+class _Transaction:
+    """`with` block running its statements in one immediate transaction."""
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+class JobConsumer:
+    """Claim jobs from a `JobStore` and run them with `handler`.
+
+    `handler(job_id, payload)` is awaited and returns the job results. The
+    lease is renewed while it runs. Jobs rejected with `EngineBusyError`
+    are handed back to the queue and retried later. `on_finished(payload)`
+    is called once a job reached a final state, to drop its input files.
+    """
+    def __init__(self,
+                 store: JobStore,
+                 handler: Callable[[str, Dict], Awaitable[List]],
+                 on_finished: Optional[Callable[[Dict], Any]] = None,
+                 poll_interval: float = 1.0,
+                 worker_id: Optional[str] = None):
+        self.store = store
+        self.handler = handler
+        self.on_finished = on_finished
+        self.poll_interval = poll_interval
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        """Stop consuming; a job being processed is left to its lease."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def notify(self) -> None:
+        """Wake the consumer up after a job was queued."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run(self) -> None:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        last_expiry = 0.0
+        while True:
+            if time.monotonic() - last_expiry > 600:
+                last_expiry = time.monotonic()
+                for payload in await asyncio.to_thread(self.store.expire):
+                    self._finished(payload)
+            try:
+                processed = await self.run_once()
+            except sqlite3.Error as e:
+                logger.error(f"Job store error: {e}")
+                processed = False
+            if not processed:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def run_once(self) -> bool:
+        """Claim and process one job; False when the queue was empty."""
+        job = await asyncio.to_thread(self.store.claim, self.worker_id)
+        if job is None:
+            return False
+        job_id, payload = job
+        heartbeat = asyncio.get_running_loop().create_task(self._heartbeat(job_id))
+        try:
+            results = await self.handler(job_id, payload)
+        except EngineBusyError:
+            await asyncio.to_thread(self.store.release, job_id, self.worker_id)
+            await asyncio.sleep(self.poll_interval)
+            return True
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Batch job {job_id} failed: {e}")
+            stored = await asyncio.to_thread(self.store.fail, job_id, self.worker_id, str(e))
+        else:
+            stored = await asyncio.to_thread(self.store.complete, job_id, self.worker_id, results)
+        finally:
+            heartbeat.cancel()
+        if not stored:
+            # another consumer took the job over and still needs its files
+            logger.warning(f"Lost the lease on batch job {job_id}, its outcome was discarded")
+            return True
+        self._finished(payload)
+        return True
+
+    async def _heartbeat(self, job_id: str) -> None:
+        while True:
+            await asyncio.sleep(self.store.lease_seconds / 3)
+            if not await asyncio.to_thread(self.store.heartbeat, job_id, self.worker_id):
+                logger.warning(f"Lost the lease on batch job {job_id}")
+                return
+
+    def _finished(self, payload: Dict) -> None:
+        if self.on_finished is None:
+            return
+        try:
+            self.on_finished(payload)
+        except Exception as e:
+            logger.error(f"Failed to clean up after a batch job: {e}")
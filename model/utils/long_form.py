@@ -0,0 +1,91 @@
+from typing import List, Optional, Sequence, Tuple
+
+import torch
+
+from model.utils.vad import frame_energy_db
+
+
+def plan_segments(feats: torch.Tensor, segment_frames: int, overlap_frames: int,
+                  search_frames: Optional[int] = None, align: int = 8) -> Tuple[List[int], List[Tuple[int, int]]]:
+    """Cut a long recording into overlapping segments that can be decoded independently.
+
+    A cut is made about every `segment_frames` fbank frames, at the quietest
+    point (energy smoothed over 0.3 s) within `search_frames` of the target,
+    so that cuts tend to fall in pauses. Segment `k` spans from cut `k` to
+    cut `k + 1`, extended by `overlap_frames // 2` on both sides so that
+    the frames around each cut are decoded with context in both segments.
+
+    Returns:
+        the cuts, `[0, ..., T]`, and the `(start, end)` fbank frames of each
+        segment; every boundary is a multiple of `align` (the subsampling).
+    """
+    num_frames = feats.shape[0]
+    search_frames = segment_frames // 4 if search_frames is None else search_frames
+    half = overlap_frames // 2
+    energy = frame_energy_db(feats)
+    if num_frames:
+        energy = torch.nn.functional.avg_pool1d(energy.view(1, 1, -1), 31, stride=1, padding=15,
+                                                count_include_pad=False).view(-1)
+
+    cuts = [0]
+    while num_frames - cuts[-1] > segment_frames + search_frames:
+        target = cuts[-1] + segment_frames
+        low, high = target - search_frames, target + search_frames
+        cut = low + int(torch.argmin(energy[low:high + 1]))
+        cuts.append(max(cut // align * align, cuts[-1] + align))
+    cuts.append(num_frames)
+
+    segments = []
+    for start, end in zip(cuts[:-1], cuts[1:]):
+        start = max(start - half, 0) // align * align
+        end = min(-(-(end + half) // align) * align, num_frames)
+        segments.append((start, end))
+    return cuts, segments
+
+
+def stitch_hyps(segment_hyps: Sequence[torch.Tensor], segments: Sequence[Tuple[int, int]], cuts: Sequence[int],
+                subsampling: int, num_frames: int) -> torch.Tensor:
+    """Join the greedy CTC tokens of overlapping segments into one token sequence.
+
+    Around each cut both neighbours have decoded the same frames. The switch
+    from one segment to the next is made at the frame nearest the cut where
+    both predict blank, so that no token is cut in two, dropped or emitted
+    twice; when there is no such frame, at the cut itself.
+
+    Args:
+        segment_hyps: per encoder frame token ids of each segment.
+        segments, cuts: as returned by `plan_segments`.
+        subsampling: fbank frames per encoder frame.
+        num_frames: encoder frames of the whole recording.
+    """
+    firsts = [start // subsampling for start, _ in segments]
+    switches = [0]
+    for k in range(1, len(segment_hyps)):
+        previous, current = segment_hyps[k - 1], segment_hyps[k]
+        low = firsts[k]
+        high = min(firsts[k - 1] + previous.shape[0], firsts[k] + current.shape[0])
+        cut = min(max(cuts[k] // subsampling, low), high)
+        switch = cut
+        if high > low:
+            both_blank = (previous[low - firsts[k - 1]:high - firsts[k - 1]] == 0) & (current[:high - low] == 0)
+            candidates = torch.nonzero(both_blank).view(-1) + low
+            if candidates.numel():
+                switch = int(candidates[torch.argmin((candidates - cut).abs())])
+        switches.append(max(switch, switches[-1]))
+    switches.append(num_frames)
+
+    hyps = torch.zeros(num_frames, dtype=torch.long)
+    for k, tokens in enumerate(segment_hyps):
+        start = max(switches[k], firsts[k])
+        end = min(switches[k + 1], firsts[k] + tokens.shape[0], num_frames)
+        if end > start:
+            hyps[start:end] = tokens[start - firsts[k]:end - firsts[k]].cpu()
+    return hyps
+
+
+def frame_agreement(hyps: torch.Tensor, reference: torch.Tensor) -> float:
+    """Share of encoder frames on which two greedy CTC token sequences agree."""
+    length = min(hyps.shape[0], reference.shape[0])
+    if length == 0:
+        return 1.0
+    return float((hyps[:length].cpu() == reference[:length].cpu()).float().mean())
@@ -0,0 +1,263 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from model.utils import profiling
+
+
+# Prometheus histogram buckets, in seconds, for the inference stages
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+RTF_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Monotonically increasing value, e.g. seconds of audio decoded."""
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                                for key, value in items]
+
+    def drain(self) -> Dict:
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values: Dict) -> None:
+        with self._lock:
+            for key, value in values.items():
+                self._values[key] = self._values.get(key, 0.0) + value
+
+
+class Gauge(_Metric):
+    """Value that goes up and down; either set directly or read from a callback at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._function: Optional[Callable[[], Iterable[Tuple[Dict, float]]]] = None
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function: Optional[Callable[[], Iterable[Tuple[Dict, float]]]]) -> None:
+        """Compute the samples when scraped; `function` yields `(labels, value)` pairs."""
+        self._function = function
+
+    def render(self) -> List[str]:
+        if self._function is not None:
+            try:
+                items = sorted((self._key(labels), value) for labels, value in self._function())
+            except Exception:
+                # a broken callback must not take the whole endpoint down
+                items = []
+        else:
+            with self._lock:
+                items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                                for key, value in items]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets, e.g. stage latencies."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = STAGE_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, ([*state[0]], state[1], state[2])) for key, state in self._values.items())
+        lines = self.header()
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+    def drain(self) -> Dict:
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values: Dict) -> None:
+        with self._lock:
+            for key, (counts, total, count) in values.items():
+                state = self._values.get(key)
+                if state is None:
+                    state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+                state[0] = [a + b for a, b in zip(state[0], counts)]
+                state[1] += total
+                state[2] += count
+
+
+class Registry:
+    """Set of metrics rendered together in the Prometheus text format."""
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = STAGE_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    def drain(self) -> Dict[str, Dict]:
+        """Take the counter and histogram values recorded since the last drain.
+
+        Used by forked inference workers to ship their measurements to the
+        process serving /metrics, which adds them up with `merge`.
+        """
+        return {name: metric.drain() for name, metric in self._metrics.items()
+                if isinstance(metric, (Counter, Histogram))}
+
+    def merge(self, values: Dict[str, Dict]) -> None:
+        for name, metric_values in values.items():
+            if metric_values:
+                self._metrics[name].merge(metric_values)
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "chunkformer_stage_seconds",
+    "Time spent in each inference stage (load_audio, fbank, forward_parallel_chunk, ctc_forward, "
+    "get_output_with_timestamps, ...)",
+    ["stage"])
+AUDIO_SECONDS = REGISTRY.counter(
+    "chunkformer_audio_seconds_total", "Seconds of audio run through the encoder", ["entrypoint"])
+ENCODER_FRAMES = REGISTRY.counter(
+    "chunkformer_encoder_frames_total",
+    "Encoder output frames (80 ms) computed in chunk batches, real or padding of the last chunk",
+    ["kind"])
+VAD_SKIPPED_SECONDS = REGISTRY.counter(
+    "chunkformer_vad_skipped_seconds_total", "Seconds of audio left out of the encoder as non-speech by the VAD")
+REAL_TIME_FACTOR = REGISTRY.histogram(
+    "chunkformer_real_time_factor", "Processing time divided by audio duration, per request",
+    ["endpoint"], buckets=RTF_BUCKETS)
+
+QUEUE_DEPTH = REGISTRY.gauge(
+    "chunkformer_queue_depth", "Work waiting in front of the model (engine jobs, micro-batch requests, batch jobs)",
+    ["queue"])
+MODEL_LOADED = REGISTRY.gauge("chunkformer_model_loaded", "1 once the model is loaded")
+RESULT_CACHE = REGISTRY.gauge(
+    "chunkformer_result_cache", "Result cache state (memory_entries, disk_entries, disk_size_mb, hits, misses)",
+    ["stat"])
+
+
+@contextmanager
+def stage(name: str):
+    """Time a block as inference stage `name`: `with metrics.stage("fbank"): ...`.
+
+    The block is also a region of the `profiling` trace when profiling is on.
+    """
+    with STAGE_SECONDS.time(stage=name), profiling.region(name):
+        yield
+
+
+def record_chunk_batch(encoder_outs, encoder_lens) -> None:
+    """Count real vs padded encoder frames of one `forward_parallel_chunk` output.
+
+    `encoder_outs` is (num_chunks, chunk_size, D); everything beyond the
+    real lengths is padding of the last chunk of each utterance.
+    """
+    real = int(encoder_lens.sum())
+    total = encoder_outs.shape[0] * encoder_outs.shape[1]
+    ENCODER_FRAMES.inc(real, kind="real")
+    ENCODER_FRAMES.inc(max(total - real, 0), kind="padded")
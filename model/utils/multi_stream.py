@@ -0,0 +1,225 @@
+import collections
+import itertools
+from typing import Deque, Dict, List, Optional, Tuple
+
+import torch
+
+from model.utils import metrics
+from model.utils.encoder_cache import EncoderCache
+
+
+def window_size(total_batch_duration: float, chunk_size: int, subsampling: int, max_streams: int = 1) -> int:
+    """Encoder frames each stream keeps per window, so that a full batch of windows fits `total_batch_duration`."""
+    max_frames = int((total_batch_duration // 0.01)) // 2  # in 10ms second
+    return chunk_size * max(1, max_frames // chunk_size // subsampling // max_streams)
+
+
+def relative_right_context(model, chunk_size: int, right_context_size: int) -> int:
+    """Fbank frames past the end of a window that still change its encoder output."""
+    conv_lorder = model.encoder.cnn_module_kernel // 2
+    right = max(right_context_size, conv_lorder)
+    return (right + max(chunk_size, right) * (model.encoder.num_blocks - 1)) * model.encoder.embed.subsampling_factor
+
+
+class _Stream:
+    def __init__(self, stream_id: int):
+        self.id = stream_id
+        # features from fbank frame `base` on; the frames before it are decoded
+        self.feats = torch.zeros(0, 80)
+        self.pieces: List[torch.Tensor] = []
+        self.base = 0
+        self.num_frames = 0
+        self.closed = False
+        self.window = 0
+        # slot of the stream's attention / convolution caches in the decoder's EncoderCache
+        self.slot: Optional[int] = None
+        self.offset = 0
+        self.hyps: List[torch.Tensor] = []
+
+
+class MultiStreamDecoder:
+    """Decode several long recordings together, one window of each per encoder call.
+
+    Every stream is decoded window after window with its own attention /
+    convolution caches and offset, exactly like `sequential_hyps` decodes
+    one recording. The windows of the streams in flight go through a single
+    `forward_parallel_chunk` call with their caches stacked along the batch
+    axis (one slot each of an `EncoderCache` kept on the device), so N recordings advance in lock step at the batch throughput of
+    `batch_decode` instead of one after another. At most `max_streams` are
+    in flight: a stream leaves the batch after its last window and the next
+    queued recording joins in its place.
+
+    Recordings can also be fed piece by piece (`open`, `extend`, `close`):
+    a window is decoded as soon as its features and those of its right
+    context have arrived, and the features of decoded windows are dropped,
+    so memory does not grow with the length of the recording.
+    """
+    def __init__(self, model,
+                 chunk_size: int = 64,
+                 left_context_size: int = 128,
+                 right_context_size: int = 128,
+                 window: int = 64,
+                 max_streams: int = 8):
+        """
+        Args:
+            chunk_size, left_context_size, right_context_size: attention
+                configuration, in encoder frames (80 ms).
+            window (int): encoder frames kept per window of each stream, a
+                multiple of chunk_size; see `window_size`.
+            max_streams (int): streams decoded in the same encoder call.
+        """
+        assert window % chunk_size == 0, "window must be a multiple of chunk_size"
+        self.model = model
+        self.chunk_size = chunk_size
+        self.left_context_size = left_context_size
+        self.right_context_size = right_context_size
+        self.window = window
+        self.max_streams = max_streams
+        self.device = next(model.parameters()).device
+        self.subsampling = model.encoder.embed.subsampling_factor
+        self.right_context = relative_right_context(model, chunk_size, right_context_size)
+        self._queue: Deque[_Stream] = collections.deque()
+        self._active: List[_Stream] = []
+        self._streams: Dict[int, _Stream] = {}
+        self._ids = itertools.count()
+        self._cache = EncoderCache(model, left_context_size, streams=max_streams, device=self.device)
+        self._free_slots = list(range(max_streams))
+
+    def open(self) -> int:
+        """Queue a recording whose features will be fed with `extend`; returns its stream id."""
+        stream = _Stream(next(self._ids))
+        self._streams[stream.id] = stream
+        self._queue.append(stream)
+        return stream.id
+
+    def extend(self, stream_id: int, feats: torch.Tensor) -> None:
+        """Append the next (T, 80) fbank frames of an open stream."""
+        stream = self._streams[stream_id]
+        assert not stream.closed, "the stream is closed"
+        stream.pieces.append(feats)
+        stream.num_frames += feats.shape[0]
+
+    def close(self, stream_id: int) -> None:
+        """Mark the end of a stream's features; its last windows can then be decoded."""
+        self._streams[stream_id].closed = True
+
+    def add(self, feats: torch.Tensor) -> int:
+        """Queue the (T, 80) fbank features of a whole recording; returns its stream id."""
+        stream_id = self.open()
+        stream = self._streams[stream_id]
+        stream.feats, stream.num_frames, stream.closed = feats, feats.shape[0], True
+        return stream_id
+
+    def pop_tokens(self, stream_id: int) -> torch.Tensor:
+        """Tokens decoded so far for a stream in flight; `step` then only returns the rest."""
+        stream = self._streams[stream_id]
+        hyps = torch.cat(stream.hyps) if stream.hyps else torch.zeros(0, dtype=torch.long, device=self.device)
+        stream.hyps = []
+        return hyps
+
+    @property
+    def pending(self) -> int:
+        """Streams queued or in flight."""
+        return len(self._queue) + len(self._active)
+
+    def num_windows(self, num_frames: int) -> int:
+        """Windows needed for a recording of `num_frames` fbank frames."""
+        step = self.window * self.subsampling
+        return min(-(-num_frames // step), -(-max(num_frames - self.right_context, 0) // step) + 1)
+
+    def _join(self) -> List[Tuple[int, torch.Tensor]]:
+        finished = []
+        while self._queue and len(self._active) < self.max_streams:
+            stream = self._queue.popleft()
+            if stream.closed and stream.num_frames == 0:
+                del self._streams[stream.id]
+                finished.append((stream.id, torch.zeros(0, dtype=torch.long, device=self.device)))
+                continue
+            # the lowest free slot, so that streams in flight tend to fill the first slots
+            stream.slot = min(self._free_slots)
+            self._free_slots.remove(stream.slot)
+            self._cache.reset(stream.slot)
+            self._active.append(stream)
+        return finished
+
+    def _ready(self, stream: _Stream) -> bool:
+        """Whether the features of the stream's next window and of its right context have arrived."""
+        needed = self.window * self.subsampling * (stream.window + 1) + 7 + self.right_context
+        return stream.closed or stream.num_frames >= needed
+
+    @torch.no_grad()
+    def step(self) -> List[Tuple[int, torch.Tensor]]:
+        """Decode the next window of every stream in flight whose features are ready.
+
+        Returns:
+            the `(stream id, greedy CTC tokens per encoder frame)` of the
+            streams that ended with this window.
+        """
+        finished = self._join()
+        ready = [stream for stream in self._active if self._ready(stream)]
+        if not ready:
+            return finished
+
+        step = self.window * self.subsampling
+        xs, complete, lasts = [], [], []
+        for stream in ready:
+            if stream.pieces:
+                stream.feats = torch.cat([stream.feats] + stream.pieces, dim=0)
+                stream.pieces = []
+            num_frames = stream.num_frames
+            start = step * stream.window
+            end = min(step * (stream.window + 1) + 7, num_frames)
+            xs.append(stream.feats[start - stream.base:end + self.right_context - stream.base])
+            # the window reaches the end of the recording together with its right context
+            complete.append(stream.closed and start + self.right_context >= num_frames)
+            lasts.append(stream.closed and start + max(self.right_context, step) >= num_frames)
+        xs_origin_lens = torch.tensor([x.shape[0] for x in xs], dtype=torch.int, device=self.device)
+        offset = torch.tensor([stream.offset for stream in ready], dtype=torch.int, device=self.device)
+        slots = [stream.slot for stream in ready]
+        att_cache, cnn_cache = self._cache.gather(slots)
+
+        with metrics.stage("forward_parallel_chunk"):
+            encoder_outs, encoder_lens, n_chunks, att_cache, cnn_cache, _ = self.model.encoder.forward_parallel_chunk(
+                xs=xs,
+                xs_origin_lens=xs_origin_lens,
+                chunk_size=self.chunk_size,
+                left_context_size=self.left_context_size,
+                right_context_size=self.right_context_size,
+                att_cache=att_cache,
+                cnn_cache=cnn_cache,
+                truncated_context_size=self.window,
+                offset=offset,
+                stream_caches=True,
+                update_caches_in_place=True
+            )
+        self._cache.scatter(slots, att_cache, cnn_cache)
+        metrics.record_chunk_batch(encoder_outs, encoder_lens)
+        with metrics.stage("ctc_forward"):
+            hyps = self.model.encoder.ctc_forward(encoder_outs, encoder_lens, n_chunks)
+
+        for stream, hyp, whole, last in zip(ready, hyps, complete, lasts):
+            # the output of the right context is decoded again by the next window
+            kept = hyp if whole else hyp[:self.window]
+            stream.hyps.append(kept)
+            stream.offset += kept.shape[0]
+            stream.window += 1
+            if last:
+                del self._streams[stream.id]
+                self._free_slots.append(stream.slot)
+                finished.append((stream.id, torch.cat(stream.hyps)))
+            else:
+                # only the next windows' features are kept
+                stream.feats = stream.feats[step * stream.window - stream.base:]
+                stream.base = step * stream.window
+        finished_ids = {stream_id for stream_id, _ in finished}
+        self._active = [stream for stream in self._active if stream.id not in finished_ids]
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
+        return finished
+
+    def run(self) -> Dict[int, torch.Tensor]:
+        """Decode every queued recording, all of them closed; returns the tokens of each stream id."""
+        results = {}
+        while self.pending:
+            results.update(self.step())
+        return results
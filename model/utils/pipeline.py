@@ -0,0 +1,179 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, List, Optional, Sequence
+
+
+_DONE = object()
+
+
+class StageStats:
+    """Throughput of one pipeline stage.
+
+    `busy` is the time spent doing the stage's own work and `waiting` the
+    time it sat idle for its input (or for room in its output queue): the
+    bottleneck is the stage that is busy while the others wait.
+    """
+    def __init__(self, name: str, workers: int = 1):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, items: int = 1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.busy += time.perf_counter() - start
+                self.items += items
+
+    @contextmanager
+    def wait(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.waiting += time.perf_counter() - start
+
+    def summary(self, wall_time: float) -> str:
+        # workers of a pool are busy at the same time, report per worker
+        busy = self.busy / self.workers
+        rate = self.items / busy if busy > 0 else 0.0
+        return (f"{self.name}: {self.items} items, {rate:.2f} items/s while busy, "
+                f"busy {100 * busy / wall_time if wall_time else 0:.0f}% of {wall_time:.1f}s, "
+                f"waited {self.waiting:.1f}s")
+
+
+class BatchPipeline:
+    """Overlap audio loading, the encoder and post-processing over planned batches.
+
+    Three stages connected by bounded queues:
+
+    - `load_fn(item)` runs on a pool of `num_workers` threads (ffmpeg runs
+      in a subprocess and fbank in torch, neither holds the GIL), up to
+      `prefetch_batches` batches ahead of the encoder;
+    - `encode_fn(batch, loaded)` runs on the calling thread, one batch at
+      a time, with the loaded items of the batch in order;
+    - `output_fn(batch, encoded)` runs on a writer thread, in batch order.
+
+    The first exception raised by any stage stops the pipeline and is
+    re-raised by `run`.
+    """
+    def __init__(self,
+                 load_fn: Callable[[Any], Any],
+                 encode_fn: Callable[[List[Any], List[Any]], Any],
+                 output_fn: Callable[[List[Any], Any], None],
+                 num_workers: int = 4,
+                 prefetch_batches: int = 2,
+                 stats: Optional[List[StageStats]] = None):
+        self.load_fn = load_fn
+        self.encode_fn = encode_fn
+        self.output_fn = output_fn
+        self.num_workers = max(1, num_workers)
+        self.prefetch_batches = max(1, prefetch_batches)
+        # pass the stats of a previous pipeline to add this one's work to them
+        self.stats = stats or [StageStats("load", self.num_workers), StageStats("encode"), StageStats("output")]
+        self.wall_time = 0.0
+
+    def _load(self, item):
+        with self.stats[0].measure():
+            return self.load_fn(item)
+
+    def _put(self, q: queue.Queue, value, stop: threading.Event) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue, stop: threading.Event):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def run(self, batches: Sequence[List[Any]]) -> None:
+        start = time.perf_counter()
+        stop = threading.Event()
+        loaded: queue.Queue = queue.Queue(maxsize=self.prefetch_batches)
+        encoded: queue.Queue = queue.Queue(maxsize=self.prefetch_batches)
+        errors: List[BaseException] = []
+        load_stats, encode_stats, output_stats = self.stats
+
+        with ThreadPoolExecutor(self.num_workers, thread_name_prefix="pipeline-load") as pool:
+            def feed():
+                # submitting stalls once prefetch_batches batches are waiting for the encoder
+                for batch in batches:
+                    futures = [pool.submit(self._load, item) for item in batch]
+                    if not self._put(loaded, (batch, futures), stop):
+                        for future in futures:
+                            future.cancel()
+                        return
+                self._put(loaded, _DONE, stop)
+
+            def write():
+                while True:
+                    with output_stats.wait():
+                        entry = encoded.get()
+                    if entry is _DONE:
+                        return
+                    if errors:
+                        continue  # keep draining so the encoder never blocks
+                    batch, result = entry
+                    try:
+                        with output_stats.measure(len(batch)):
+                            self.output_fn(batch, result)
+                    except BaseException as e:
+                        errors.append(e)
+                        stop.set()
+
+            feeder = threading.Thread(target=feed, name="pipeline-feed", daemon=True)
+            writer = threading.Thread(target=write, name="pipeline-write", daemon=True)
+            feeder.start()
+            writer.start()
+            try:
+                while not stop.is_set():
+                    with encode_stats.wait():
+                        entry = self._get(loaded, stop)
+                        if entry is _DONE:
+                            break
+                        batch, futures = entry
+                        items = [future.result() for future in futures]
+                    with encode_stats.measure(len(batch)):
+                        result = self.encode_fn(batch, items)
+                    with encode_stats.wait():
+                        if not self._put(encoded, (batch, result), stop):
+                            break
+            except BaseException as e:
+                errors.insert(0, e)
+                stop.set()
+            finally:
+                encoded.put(_DONE)
+                writer.join()
+                stop.set()
+                feeder.join()
+                # don't load batches nobody is going to encode
+                while not loaded.empty():
+                    entry = loaded.get_nowait()
+                    if entry is not _DONE:
+                        for future in entry[1]:
+                            future.cancel()
+        self.wall_time = time.perf_counter() - start
+        if errors:
+            raise errors[0]
+
+    def summary(self) -> List[str]:
+        """One throughput line per stage, for the last `run`."""
+        return [stats.summary(self.wall_time) for stats in self.stats]
@@ -0,0 +1,19 @@
+# Random-weight model configurations, for benchmark.py and the tests
+
+ENCODER_DEFAULTS = {
+    'activation_type': 'swish',
+    'pos_enc_layer_type': 'stream_rel_pos',
+    'selfattention_layer_type': 'stream_rel_selfattn',
+    'cnn_module_norm': 'layer_norm',
+    'use_dynamic_conv': True,
+    'causal': False,
+}
+
+MODEL_PRESETS = {
+    'tiny': {'cmvn_file': None, 'is_json_cmvn': True, 'input_dim': 80, 'output_dim': 32,
+             'encoder_conf': dict(ENCODER_DEFAULTS, output_size=64, attention_heads=4,
+                                  linear_units=128, num_blocks=4, cnn_module_kernel=15)},
+    'large': {'cmvn_file': None, 'is_json_cmvn': True, 'input_dim': 80, 'output_dim': 6992,
+              'encoder_conf': dict(ENCODER_DEFAULTS, output_size=512, attention_heads=8,
+                                   linear_units=2048, num_blocks=17, cnn_module_kernel=15)},
+}
@@ -0,0 +1,168 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import torch
+
+
+# layer indices are folded together when summarizing by stage
+_LAYER = re.compile(r"layer\d+")
+
+
+class Profiler:
+    """Record wall time and memory of named, nested regions of inference.
+
+    Regions are opened with the module level `region(name)`, which does
+    nothing unless a profiler was `start`ed. Nested regions are named by
+    their path ("forward_parallel_chunk/layer03/attention"). Each region is
+    also a `torch.profiler.record_function` range, so the same names show
+    up in a torch.profiler trace.
+
+    Memory is the change over the region of the allocated device memory on
+    CUDA and of the process RSS on CPU. On CUDA, regions synchronize the
+    device so that their time is the time of their kernels.
+    """
+    def __init__(self, device: Optional[torch.device] = None):
+        self.device = torch.device(device or "cpu")
+        self.events: List[Dict] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _memory_mb(self) -> float:
+        if self.device.type == "cuda":
+            return torch.cuda.memory_allocated(self.device) / (1024 * 1024)
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+        except OSError:
+            return 0.0
+
+    def _sync(self) -> None:
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    @contextmanager
+    def region(self, name: str):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(name)
+        path = "/".join(stack)
+        self._sync()
+        memory = self._memory_mb()
+        start = time.perf_counter()
+        try:
+            with torch.profiler.record_function(path):
+                yield
+        finally:
+            self._sync()
+            end = time.perf_counter()
+            stack.pop()
+            event = {"name": name, "cat": "chunkformer", "ph": "X",
+                     "ts": start * 1e6, "dur": (end - start) * 1e6,
+                     "pid": os.getpid(), "tid": threading.get_ident(),
+                     "args": {"path": path, "memory_mb": round(self._memory_mb() - memory, 3)}}
+            with self._lock:
+                self.events.append(event)
+
+    def drain(self) -> List[Dict]:
+        """Take the events recorded so far, e.g. to ship them from a worker process."""
+        with self._lock:
+            events, self.events = self.events, []
+        return events
+
+    def merge(self, events: List[Dict]) -> None:
+        with self._lock:
+            self.events.extend(events)
+
+    def summary(self, by_stage: bool = False) -> List[Dict]:
+        """Totals per region path, in the order the regions first appeared.
+
+        With `by_stage`, the layers are added up: "layer03/attention" and
+        "layer04/attention" both count as "layer*/attention".
+        """
+        with self._lock:
+            events = list(self.events)
+        rows: Dict[str, Dict] = {}
+        for event in events:
+            path = event["args"]["path"]
+            if by_stage:
+                path = _LAYER.sub("layer*", path)
+            row = rows.get(path)
+            if row is None:
+                row = rows[path] = {"path": path, "calls": 0, "total_ms": 0.0, "memory_mb": 0.0}
+            row["calls"] += 1
+            row["total_ms"] += event["dur"] / 1000
+            row["memory_mb"] = max(row["memory_mb"], event["args"]["memory_mb"])
+
+        roots = sum(row["total_ms"] for row in rows.values() if "/" not in row["path"])
+        for row in rows.values():
+            row["mean_ms"] = row["total_ms"] / row["calls"]
+            # share of the parent region, or of all top level regions
+            parent = rows.get(row["path"].rsplit("/", 1)[0]) if "/" in row["path"] else None
+            total = parent["total_ms"] if parent else roots
+            row["percent"] = 100 * row["total_ms"] / total if total else 0.0
+        # children right below their parent, in order of first appearance
+        order = {path: i for i, path in enumerate(rows)}
+        return sorted(rows.values(), key=lambda row: [order["/".join(row["path"].split("/")[:depth + 1])]
+                                                       for depth in range(row["path"].count("/") + 1)])
+
+    def format_summary(self, by_stage: bool = False) -> str:
+        lines = [f"{'region':<48} {'calls':>7} {'total ms':>11} {'mean ms':>9} {'% parent':>8} {'max +MB':>8}"]
+        for row in self.summary(by_stage):
+            depth = row["path"].count("/")
+            name = "  " * depth + row["path"].rsplit("/", 1)[-1]
+            lines.append(f"{name:<48} {row['calls']:>7} {row['total_ms']:>11.2f} {row['mean_ms']:>9.3f} "
+                         f"{row['percent']:>8.1f} {row['memory_mb']:>8.1f}")
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path) -> None:
+        """Write the regions as a Chrome trace (chrome://tracing, Perfetto)."""
+        with self._lock:
+            events = list(self.events)
+        Path(path).write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
+
+    def save(self, directory) -> Path:
+        """Write trace.json, summary.txt and summary.json to `directory`."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        self.export_chrome_trace(directory / "trace.json")
+        (directory / "summary.txt").write_text(
+            self.format_summary() + "\n\n" + self.format_summary(by_stage=True) + "\n")
+        (directory / "summary.json").write_text(json.dumps(
+            {"regions": self.summary(), "stages": self.summary(by_stage=True)}, indent=2))
+        return directory
+
+
+_active: Optional[Profiler] = None
+
+
+def start(device: Optional[torch.device] = None) -> Profiler:
+    """Turn profiling on for the whole process; regions are recorded until `stop`."""
+    global _active
+    _active = Profiler(device)
+    return _active
+
+
+def stop() -> Optional[Profiler]:
+    """Turn profiling off and return the profiler holding what was recorded."""
+    global _active
+    profiler, _active = _active, None
+    return profiler
+
+
+def active() -> Optional[Profiler]:
+    return _active
+
+
+def region(name: str):
+    """Profile a block as region `name`: `with profiling.region("attention"): ...`."""
+    profiler = _active
+    if profiler is None:
+        return nullcontext()
+    return profiler.region(name)
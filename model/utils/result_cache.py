@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+@lru_cache(maxsize=None)
+def checkpoint_id(checkpoint) -> str:
+    """Identify a checkpoint directory by the names, sizes and mtimes of its files.
+
+    Replacing the weights changes the id, which invalidates every cached
+    result computed with the old ones. The id is computed once per process,
+    like the model is loaded once.
+    """
+    path = Path(checkpoint)
+    digest = hashlib.sha256(str(path.resolve()).encode())
+    if path.is_dir():
+        for file in sorted(path.iterdir()):
+            if file.is_file():
+                stat = file.stat()
+                digest.update(f"{file.name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:16]
+
+
+# result of an in-flight computation whose caller was cancelled
+_ABANDONED = object()
+
+
+def cache_key(audio_sha256: str, params: Dict) -> str:
+    """Content address of a transcription: SHA-256 of the audio bytes plus decode parameters."""
+    digest = hashlib.sha256(audio_sha256.encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Two-tier cache of JSON serializable transcription results.
+
+    Results are kept in an in-memory LRU of `max_entries` items in front of
+    a directory of one JSON file per key, bounded to `max_disk_bytes` by
+    dropping the least recently used files. The disk tier can be shared by
+    several processes (API, batch workers): every write scans the directory
+    again and reads and writes set a file's mtime, so the bound and the
+    recency order cover the files of all of them. `get_or_compute`
+    coalesces concurrent requests for the same key into a single computation.
+    """
+    def __init__(self, directory, max_entries: int = 1024, max_disk_bytes: int = 512 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[str, Any]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self._disk = self._scan()
+        self._disk_bytes = sum(self._disk.values())
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def _scan(self) -> "OrderedDict[str, int]":
+        """Sizes of the files on disk, written by any process, least recently used first."""
+        entries = []
+        for file in self.directory.glob("*/*.json"):
+            try:
+                stat = file.stat()
+            except OSError:
+                # evicted by another process meanwhile
+                continue
+            entries.append((stat.st_mtime_ns, file.stem, stat.st_size))
+        return OrderedDict((key, size) for _, key, size in sorted(entries))
+
+    @staticmethod
+    def _touch(path: Path) -> None:
+        # the kernel's own timestamps are too coarse to order writes made in a row
+        now = time.time_ns()
+        os.utime(path, ns=(now, now))
+
+    def get_memory(self, key: str) -> Optional[Any]:
+        with self._lock:
+            if key not in self._memory:
+                return None
+            self._memory.move_to_end(key)
+            return self._memory[key]
+
+    def get(self, key: str) -> Optional[Any]:
+        """Look the key up in memory, then on disk; None on a miss."""
+        value = self.get_memory(key)
+        if value is not None:
+            return value
+        path = self._path(key)
+        try:
+            value = json.loads(path.read_text(encoding="utf-8"))
+            self._touch(path)
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+        self._remember(key, value)
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        self._remember(key, value)
+        path = self._path(key)
+        data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        path.parent.mkdir(exist_ok=True)
+        # write then rename so that readers in other processes never see half a file
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        self._touch(tmp_path)
+        os.replace(tmp_path, path)
+
+        disk = self._scan()
+        evicted = []
+        with self._lock:
+            self._disk, self._disk_bytes = disk, sum(disk.values())
+            while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+                old_key, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                self._path(old_key).unlink()
+            except OSError:
+                pass
+
+    def _remember(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the cached result for `key`, computing it once if needed.
+
+        Callers asking for a key that is already being computed wait for
+        that computation instead of starting their own. If the caller that
+        computes it is cancelled, one of the waiters takes over with its own
+        `compute`. Failures are not cached and are raised to every waiting
+        caller.
+        """
+        while True:
+            value = self.get_memory(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            if key not in self._inflight:
+                break
+            value = await asyncio.shield(self._inflight[key])
+            if value is not _ABANDONED:
+                self.hits += 1
+                return value
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await asyncio.to_thread(self.get, key)
+            if value is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                value = await compute()
+                await asyncio.to_thread(self.put, key, value)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            # the waiters' own requests are still alive, one of them computes instead
+            future.set_result(_ABANDONED)
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # the exception is re-raised here, do not warn when nobody else waited
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "disk_entries": len(self._disk),
+                "disk_size_mb": round(self._disk_bytes / (1024 * 1024), 2),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,146 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+from model.utils import metrics
+from model.utils.ctc_utils import CTCSegmenter
+from model.utils.encoder_cache import EncoderCache
+from model.utils.features import FbankStream
+
+
+class StreamingSession:
+    """Incremental transcription state for one live audio stream.
+
+    Audio is pushed in arbitrary pieces. Features are computed as samples
+    arrive and the encoder is run whenever `decoding_window` encoder frames
+    plus `lookahead` frames of future audio are available, carrying the
+    attention/convolution caches and the offset from one window to the next
+    the same way `endless_decode` does. With `lookahead` equal to the
+    relative right context of the whole encoder the result matches
+    `endless_decode`; smaller values trade a little accuracy for latency.
+
+    Methods taking `model` / `char_dict` keywords are meant to be run on the
+    inference engine.
+    """
+    def __init__(self,
+                 chunk_size: int = 64,
+                 left_context_size: int = 128,
+                 right_context_size: int = 128,
+                 decoding_window: int = 64,
+                 lookahead: int = 128):
+        """
+        Args:
+            chunk_size, left_context_size, right_context_size: attention
+                configuration, in encoder frames (80 ms).
+            decoding_window (int): encoder frames emitted per encoder call,
+                a multiple of chunk_size.
+            lookahead (int): encoder frames of future audio each window
+                waits for before it is decoded.
+        """
+        assert decoding_window % chunk_size == 0, "decoding_window must be a multiple of chunk_size"
+        self.chunk_size = chunk_size
+        self.left_context_size = left_context_size
+        self.right_context_size = right_context_size
+        self.decoding_window = decoding_window
+        self.lookahead = lookahead
+
+        self.fbank = FbankStream()
+        self.feats = torch.zeros(0, 80)
+        self.cache: Optional[EncoderCache] = None
+        self.offset = None
+        self.segmenter: Optional[CTCSegmenter] = None
+        self._pending = b""
+
+    def _init_state(self, model, char_dict) -> None:
+        device = next(model.parameters()).device
+        self.cache = EncoderCache(model, self.left_context_size, device=device)
+        self.offset = torch.zeros(1, dtype=torch.int, device=device)
+        self.segmenter = CTCSegmenter(char_dict)
+
+    def _window_frames(self, model):
+        """Feature frames consumed per window and needed beyond its end."""
+        subsampling = model.encoder.embed.subsampling_factor
+        # the last chunk of a window reads `right_context + 1 - subsampling` extra frames
+        extra = model.encoder.embed.right_context + 1 - subsampling
+        return self.decoding_window * subsampling, extra + self.lookahead * subsampling
+
+    @torch.no_grad()
+    def _decode(self, x: torch.Tensor, model, keep: Optional[int]) -> List[int]:
+        device = self.offset.device
+        if self.cache.device != device:
+            self.cache.restore(device)
+        x_len = torch.tensor([x.shape[0]], dtype=torch.int, device=device)
+        with metrics.stage("forward_parallel_chunk"):
+            encoder_outs, encoder_lens, _, _, _, self.offset = model.encoder.forward_parallel_chunk(
+                xs=x.unsqueeze(0),
+                xs_origin_lens=x_len,
+                chunk_size=self.chunk_size,
+                left_context_size=self.left_context_size,
+                right_context_size=self.right_context_size,
+                att_cache=self.cache.att_cache,
+                cnn_cache=self.cache.cnn_cache,
+                truncated_context_size=self.decoding_window,
+                offset=self.offset,
+                update_caches_in_place=True
+            )
+        metrics.record_chunk_batch(encoder_outs, encoder_lens)
+        encoder_outs = encoder_outs.reshape(1, -1, encoder_outs.shape[-1])[:, :encoder_lens]
+        if keep is not None:
+            encoder_outs = encoder_outs[:, :keep]
+        self.offset = self.offset - encoder_lens + encoder_outs.shape[1]
+        metrics.AUDIO_SECONDS.inc(encoder_outs.shape[1] * model.encoder.embed.subsampling_factor / 100,
+                                  entrypoint="streaming")
+        with metrics.stage("ctc_forward"):
+            return model.encoder.ctc_forward(encoder_outs).squeeze(0)
+
+    def _events(self, segments: List[Dict], final: bool = False) -> List[Dict]:
+        events = [{"type": "segment", **segment} for segment in segments]
+        partial = None if final else self.segmenter.partial()
+        if partial is not None:
+            events.append({"type": "partial", **partial})
+        return events
+
+    def accept_waveform(self, waveform: torch.Tensor, model=None, char_dict=None) -> List[Dict]:
+        """Push (1, T) samples; return the segments closed so far and the open one."""
+        if self.segmenter is None:
+            self._init_state(model, char_dict)
+        feats = self.fbank.accept_waveform(waveform)
+        if feats is not None:
+            self.feats = torch.cat([self.feats, feats], dim=0)
+
+        window, needed = self._window_frames(model)
+        segments = []
+        decoded = False
+        while self.feats.shape[0] >= window + needed:
+            hyp = self._decode(self.feats[:window + needed], model, keep=self.decoding_window)
+            segments += self.segmenter.accept(hyp)
+            self.feats = self.feats[window:]
+            decoded = True
+        return self._events(segments) if decoded else []
+
+    def accept_pcm16(self, data: bytes, model=None, char_dict=None) -> List[Dict]:
+        """Push raw 16-bit little endian mono PCM bytes."""
+        data = self._pending + data
+        usable = len(data) - len(data) % 2
+        self._pending = data[usable:]
+        samples = np.frombuffer(data[:usable], dtype="<i2").astype(np.float32)
+        return self.accept_waveform(torch.from_numpy(samples).unsqueeze(0), model=model, char_dict=char_dict)
+
+    def park(self, model=None, char_dict=None) -> None:
+        """Move the caches of an idle session to host memory; the next window brings them back."""
+        if self.cache is not None:
+            self.cache.offload()
+
+    def finalize(self, model=None, char_dict=None) -> List[Dict]:
+        """Decode the remaining audio without lookahead and close the stream."""
+        if self.segmenter is None:
+            self._init_state(model, char_dict)
+        segments = []
+        context = model.encoder.embed.right_context + 1
+        if self.feats.shape[0] >= context:
+            hyp = self._decode(self.feats, model, keep=None)
+            segments += self.segmenter.accept(hyp)
+        self.feats = torch.zeros(0, 80)
+        segments += self.segmenter.finalize()
+        return self._events(segments, final=True)
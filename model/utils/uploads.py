@@ -0,0 +1,182 @@
+import hashlib
+import uuid
+from pathlib import Path
+from typing import AsyncIterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+from litestar import Request
+from litestar.exceptions import ClientException
+from multipart import MultipartSegment, ParserError, ParserLimitReached, PushMultipartParser
+
+from model.utils.audio import (RAW_PCM_EXTENSIONS, WAVE_FORMAT_PCM, WavInfo, parse_wav_header,
+                               pcm_to_int16_scale, read_audio_file, to_mono_waveform)
+from model.utils.features import FbankStream, compute_fbank
+
+
+# bytes of a WAV file searched for the "data" chunk before giving up on it
+WAV_HEADER_LIMIT = 64 * 1024
+# sample bytes collected before they are converted, to keep small network
+# reads from turning into many tiny fbank calls
+PCM_BLOCK_BYTES = 32 * 1024
+
+
+async def iter_multipart_files(request: Request) -> AsyncIterator[Tuple[str, object]]:
+    """Parse a multipart/form-data body while it is being received.
+
+    Unlike declaring an `UploadFile` parameter, nothing is buffered: the
+    caller gets `("file", segment)` when a file part starts, `("data", bytes)`
+    for each piece of its content as it arrives and `("end", segment)` when
+    the part is complete. Parts that are not files are skipped.
+    """
+    boundary = request.content_type[1].get("boundary", "").encode()
+    if not boundary:
+        return
+    segment: Optional[MultipartSegment] = None
+    try:
+        with PushMultipartParser(boundary, max_segment_count=request.app.multipart_form_part_limit) as parser:
+            stream = request.stream()
+            while not parser.closed:
+                chunk = await anext(stream, b"")
+                for part in parser.parse(chunk):
+                    if isinstance(part, MultipartSegment):
+                        segment = part
+                        if segment.filename is not None:
+                            yield "file", segment
+                    elif part:
+                        if segment is not None and segment.filename is not None:
+                            yield "data", bytes(part)
+                    else:
+                        if segment is None:
+                            raise ClientException("Unexpected eof in multipart/form-data")
+                        if segment.filename is not None:
+                            yield "end", segment
+                        segment = None
+    except ParserError as exc:
+        raise ClientException("Invalid multipart/form-data") from exc
+    except ParserLimitReached:
+        raise ClientException("Request Entity Too Large") from None
+
+
+class UploadDecoder:
+    """Decode an uploaded audio file piece by piece while it is received.
+
+    Headerless PCM (".pcm" / ".raw") and WAV files already at `frame_rate`
+    are turned into fbank features as the bytes arrive, so feature
+    extraction is done by the time the upload completes and the upload
+    itself is never held in memory. WAV files at another rate are converted
+    to samples on the fly and resampled once complete. Anything else is
+    spooled to a file under `spool_dir` and decoded afterwards: FLAC with
+    `soundfile`, the rest by the caller through ffmpeg.
+
+    The SHA-256 of the upload is computed on the way, for the result cache.
+    """
+    def __init__(self, filename: str, spool_dir, frame_rate: int = 16000):
+        self.filename = filename
+        self.spool_dir = Path(spool_dir)
+        self.frame_rate = frame_rate
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.spool_path: Optional[Path] = None
+
+        self._info: Optional[WavInfo] = None
+        self._head: Optional[bytearray] = bytearray()
+        self._remaining = 0
+        self._pending = b""
+        self._spool = None
+        self._fbank = FbankStream()
+        self._feats: List[torch.Tensor] = []
+        self._samples: List[np.ndarray] = []
+        if Path(filename).suffix.lower() in RAW_PCM_EXTENSIONS:
+            self._start_pcm(WavInfo(WAVE_FORMAT_PCM, 1, frame_rate, 16, 0, 2 ** 62))
+
+    def _start_pcm(self, info: WavInfo) -> None:
+        self._info = info
+        # WAV files written to a pipe leave the data size at 0 or 0xFFFFFFFF: read to the end
+        self._remaining = 2 ** 62 if info.data_size in (0, 0xFFFFFFFF) else info.data_size
+        self._head = None
+
+    def _start_spool(self) -> None:
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.spool_path = self.spool_dir / f"{uuid.uuid4()}{Path(self.filename).suffix}"
+        self._spool = open(self.spool_path, "wb")
+        self._spool.write(self._head)
+        self._head = None
+
+    def feed(self, chunk: bytes) -> None:
+        """Consume the next piece of the upload."""
+        self.digest.update(chunk)
+        self.size += len(chunk)
+        if self._head is not None:
+            # still looking for the WAV "data" chunk
+            self._head += chunk
+            info = parse_wav_header(bytes(self._head))
+            if info is not None:
+                chunk = bytes(self._head[info.data_offset:])
+                self._start_pcm(info)
+            elif len(self._head) < 12 or (self._head[:4] == b"RIFF" and len(self._head) < WAV_HEADER_LIMIT):
+                return
+            else:
+                self._start_spool()
+                return
+        if self._spool is not None:
+            self._spool.write(chunk)
+        else:
+            self._accept_pcm(chunk)
+
+    def _accept_pcm(self, chunk: bytes, flush: bool = False) -> None:
+        chunk = chunk[:self._remaining]
+        self._remaining -= len(chunk)
+        data = self._pending + chunk
+        if len(data) < PCM_BLOCK_BYTES and not flush:
+            self._pending = data
+            return
+        frame_bytes = self._info.channels * self._info.bits_per_sample // 8
+        usable = len(data) - len(data) % frame_bytes
+        self._pending = data[usable:]
+        if usable == 0:
+            return
+        samples = pcm_to_int16_scale(data[:usable], self._info)
+        samples = samples.mean(axis=1, dtype=np.float32) if samples.shape[1] > 1 else samples[:, 0]
+        if self._info.sample_rate != self.frame_rate:
+            self._samples.append(samples)
+            return
+        feats = self._fbank.accept_waveform(torch.from_numpy(np.ascontiguousarray(samples)).unsqueeze(0))
+        if feats is not None:
+            self._feats.append(feats)
+
+    def finish(self) -> Optional[torch.Tensor]:
+        """Complete the upload.
+
+        Returns:
+            the (T, 80) fbank features, or None when the audio must be loaded
+            from `spool_path` with ffmpeg.
+        """
+        if self._head is not None:
+            # too short to be anything we can parse
+            self._start_spool()
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+            return self._decode_spooled()
+        self._accept_pcm(b"", flush=True)
+        if self._samples:
+            samples = np.concatenate(self._samples)[:, None]
+            return compute_fbank(to_mono_waveform(samples, self._info.sample_rate, self.frame_rate))
+        if not self._feats:
+            raise ValueError("Uploaded audio is too short")
+        return torch.cat(self._feats)
+
+    def _decode_spooled(self) -> Optional[torch.Tensor]:
+        waveform = read_audio_file(self.spool_path, self.frame_rate)
+        if waveform is None:
+            return None
+        return compute_fbank(waveform)
+
+    def close(self) -> None:
+        """Remove the spooled file, if any."""
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        if self.spool_path is not None and self.spool_path.exists():
+            self.spool_path.unlink()
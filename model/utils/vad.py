@@ -0,0 +1,99 @@
+import importlib
+import math
+from typing import Callable, List, Tuple
+
+import torch
+
+
+# fbank frames per second (10 ms frame shift)
+FRAMES_PER_SECOND = 100
+
+
+def frame_energy_db(feats: torch.Tensor) -> torch.Tensor:
+    """Total mel energy of each fbank frame, in dB."""
+    return 10 / math.log(10) * torch.logsumexp(feats.float(), dim=1)
+
+
+class EnergyVAD:
+    """Mark fbank frames as speech when they are louder than the noise floor.
+
+    The frame energy is the total mel energy of the frame, in dB. The noise
+    floor is the `noise_percentile`th percentile of the recording's frame
+    energies, and frames more than `threshold_db` above it are speech. This
+    suits recordings with a stable background, like calls, and costs next
+    to nothing next to the encoder.
+    """
+    def __init__(self, threshold_db: float = 12.0, noise_percentile: float = 10.0):
+        self.threshold_db = threshold_db
+        self.noise_percentile = noise_percentile
+
+    def __call__(self, feats: torch.Tensor) -> torch.Tensor:
+        energy = frame_energy_db(feats)
+        if energy.numel() == 0:
+            return energy > 0
+        floor = torch.quantile(energy, self.noise_percentile / 100)
+        return energy > floor + self.threshold_db
+
+
+def load_detector(name: str, threshold_db: float = 12.0) -> Callable[[torch.Tensor], torch.Tensor]:
+    """VAD named on the command line: "energy", or "package.module:function".
+
+    A pluggable detector is a callable taking the (T, 80) fbank features and
+    returning a (T,) boolean tensor that is True on speech frames.
+    """
+    if name == "energy":
+        return EnergyVAD(threshold_db)
+    module, _, attribute = name.partition(":")
+    if not attribute:
+        raise ValueError(f"Unknown VAD {name!r}, use 'energy' or 'package.module:function'")
+    return getattr(importlib.import_module(module), attribute)
+
+
+def speech_regions(speech: torch.Tensor, min_silence: int, padding: int, align: int = 1) -> List[Tuple[int, int]]:
+    """Turn a per-frame speech mask into the `[start, end)` frame ranges to decode.
+
+    Speech is extended by `padding` frames on both sides, only silences of
+    at least `min_silence` frames are left out, and the boundaries are
+    rounded outwards to multiples of `align` (the encoder's subsampling) so
+    that every encoder frame of a region maps back to one original frame.
+    """
+    num_frames = speech.shape[0]
+    speech = speech.bool().cpu()
+    if padding > 0 and num_frames:
+        speech = torch.nn.functional.max_pool1d(speech.float().view(1, 1, -1), 2 * padding + 1,
+                                                stride=1, padding=padding).view(-1).bool()
+    regions: List[Tuple[int, int]] = []
+    changes = torch.nonzero(speech[1:] != speech[:-1]).view(-1).add(1).tolist()
+    bounds = [0] + changes + [num_frames]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if not speech[start]:
+            continue
+        start, end = start // align * align, min(-(-end // align) * align, num_frames)
+        if regions and start - regions[-1][1] < min_silence:
+            regions[-1] = (regions[-1][0], end)
+        else:
+            regions.append((start, end))
+    return regions
+
+
+def collapse(feats: torch.Tensor, regions: List[Tuple[int, int]]) -> torch.Tensor:
+    """Features of the speech regions only, back to back."""
+    if not regions:
+        return feats[:0]
+    return torch.cat([feats[start:end] for start, end in regions])
+
+
+def expand_hyps(hyps: torch.Tensor, regions: List[Tuple[int, int]], subsampling: int, num_frames: int) -> torch.Tensor:
+    """Put the per encoder frame tokens of the collapsed audio back on the original timeline.
+
+    Skipped silences become blank (0) frames, so segment boundaries and
+    timestamps come out in original time.
+    """
+    expanded = torch.zeros(num_frames, dtype=hyps.dtype, device=hyps.device)
+    position = 0
+    for start, end in regions:
+        first = start // subsampling
+        count = max(min((end - start) // subsampling, hyps.shape[0] - position, num_frames - first), 0)
+        expanded[first:first + count] = hyps[position:position + count]
+        position += count
+    return expanded
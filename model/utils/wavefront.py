@@ -0,0 +1,166 @@
+from typing import List
+
+import torch
+
+from model.utils import metrics, profiling
+from model.utils.encoder_cache import EncoderCache
+
+
+def layer_lookahead(model, chunk_size: int, right_context_size: int) -> int:
+    """Encoder frames of a layer's input past a chunk that still change the layer's output for it.
+
+    The convolution of a chunk reads the attention output of the first
+    frames of the following chunks, which attends to their right context.
+    """
+    conv_lorder = model.encoder.cnn_module_kernel // 2
+    conv_chunks = -(-conv_lorder // chunk_size)
+    return -(-(conv_chunks * chunk_size + right_context_size) // chunk_size) * chunk_size
+
+
+def wavefront_window(total_batch_duration: float, chunk_size: int, subsampling: int, lookahead: int) -> int:
+    """Encoder frames each layer call keeps, so that with its lookahead it fills `total_batch_duration`.
+
+    The lookahead is the only work done twice, so the largest window that
+    fits has the smallest overhead.
+    """
+    max_frames = int(total_batch_duration * 100) // subsampling
+    return chunk_size * max(1, (max_frames - lookahead) // chunk_size)
+
+
+class WavefrontDecoder:
+    """Decode a long recording layer by layer, computing every hidden state once.
+
+    Window by window decoding (`sequential_hyps`) runs each window together
+    with the relative right context of the whole encoder through every
+    layer and throws that part away, so about `num_blocks * right_context`
+    frames are encoded again in every window. Here each layer keeps its own
+    attention / convolution caches and a buffer of the input frames it has
+    not consumed yet. A layer runs as soon as its input reaches `window`
+    frames past what it has already done plus its own lookahead (the right
+    context of one layer), so only that one layer lookahead is computed
+    twice; the layers advance like a wavefront, each a lookahead behind the
+    one below. The output is the same as encoding the recording in one piece.
+
+    Features are fed with `accept`, in pieces of any size, and `finalize`
+    decodes what is left at the end of the recording; both return the
+    greedy CTC tokens of the encoder frames completed by the call.
+    """
+    def __init__(self, model,
+                 chunk_size: int = 64,
+                 left_context_size: int = 128,
+                 right_context_size: int = 128,
+                 window: int = 1024):
+        """
+        Args:
+            chunk_size, left_context_size, right_context_size: attention
+                configuration, in encoder frames (80 ms).
+            window (int): encoder frames a layer keeps per call, a multiple
+                of chunk_size; see `wavefront_window`.
+        """
+        assert window % chunk_size == 0, "window must be a multiple of chunk_size"
+        encoder = model.encoder
+        self.model = model
+        self.chunk_size = chunk_size
+        self.left_context_size = left_context_size
+        self.right_context_size = right_context_size
+        self.window = window
+        self.lookahead = layer_lookahead(model, chunk_size, right_context_size)
+        self.device = next(model.parameters()).device
+        subsampling = encoder.embed.subsampling_factor
+        # fbank frames of `window` encoder frames, and the extra frames their last chunk reads
+        self.fbank_step = window * subsampling
+        self.fbank_extra = encoder.embed.right_context + 1 - subsampling
+
+        self.feats = torch.zeros(0, 80)
+        self.pos_emb = None
+        # inputs[i] holds the input frames of layer i from frame done[i] on;
+        # inputs[num_blocks] the encoder output not decoded yet
+        self.inputs = [torch.zeros(0, encoder._output_size, device=self.device)
+                       for _ in range(encoder.num_blocks + 1)]
+        self.done = [0] * encoder.num_blocks
+        self.cache = EncoderCache(model, left_context_size, device=self.device)
+
+    def _embed(self, final: bool) -> bool:
+        """Subsample the next window of features, unless layer 0 already has enough input."""
+        if self.inputs[0].shape[0] >= self.window + self.lookahead or self.feats.shape[0] == 0:
+            return False
+        if self.feats.shape[0] >= self.fbank_step + self.fbank_extra:
+            used, consumed = self.fbank_step + self.fbank_extra, self.fbank_step
+        elif final:
+            used = consumed = self.feats.shape[0]
+        else:
+            return False
+        with profiling.region("subsampling"):
+            xs, self.pos_emb = self.model.encoder.embed_chunks(self.feats[:used].to(self.device), self.chunk_size,
+                                                               self.left_context_size, self.right_context_size)
+        self.feats = self.feats[consumed:]
+        self.inputs[0] = torch.cat([self.inputs[0], xs])
+        return True
+
+    def _layer(self, i: int, final: bool) -> bool:
+        """Run layer `i` on its buffered input, if enough of it has arrived."""
+        available = self.inputs[i].shape[0]
+        # at the end of the recording, once every layer below is done, nothing is left to wait for
+        flush = final and self.feats.shape[0] == 0 and all(x.shape[0] == 0 for x in self.inputs[:i])
+        if flush:
+            keep = min(available, self.window)
+        else:
+            keep = min((available - self.lookahead) // self.chunk_size * self.chunk_size, self.window)
+        if keep <= 0:
+            return False
+
+        x = self.inputs[i][:keep + self.lookahead]
+        num_frames = x.shape[0]
+        n_chunk = -(-num_frames // self.chunk_size)
+        x = torch.nn.functional.pad(x, (0, 0, 0, n_chunk * self.chunk_size - num_frames))
+        x = x.view(n_chunk, self.chunk_size, -1)
+        encoder = self.model.encoder
+        att_mask, mask_pad = encoder.chunk_masks(n_chunk, num_frames, self.done[i], self.chunk_size,
+                                                 self.left_context_size, self.right_context_size, self.device)
+        with profiling.region(f"layer{i:02d}"):
+            x, _, att_cache, cnn_cache = encoder.encoders[i].forward_parallel_chunk(
+                x, att_mask, self.pos_emb,
+                mask_pad=mask_pad,
+                right_context_size=self.right_context_size,
+                left_context_size=self.left_context_size,
+                att_cache=self.cache.att_cache[i],
+                cnn_cache=self.cache.cnn_cache[i],
+                truncated_context_size=keep
+            )
+            self.cache.update(i, att_cache, cnn_cache)
+        self.inputs[i] = self.inputs[i][keep:]
+        self.done[i] += keep
+        self.inputs[i + 1] = torch.cat([self.inputs[i + 1], x.reshape(-1, x.shape[-1])[:keep]])
+        return True
+
+    @torch.no_grad()
+    def _run(self, final: bool) -> torch.Tensor:
+        num_blocks = len(self.done)
+        with metrics.stage("forward_parallel_chunk"):
+            progress = True
+            while progress:
+                progress = self._embed(final)
+                for i in range(num_blocks):
+                    progress = self._layer(i, final) or progress
+
+        xs, self.inputs[num_blocks] = self.inputs[num_blocks], self.inputs[num_blocks][:0]
+        if xs.shape[0] == 0:
+            return torch.zeros(0, dtype=torch.long, device=self.device)
+        encoder = self.model.encoder
+        if encoder.normalize_before:
+            xs = encoder.after_norm(xs)
+        with metrics.stage("ctc_forward"):
+            return encoder.ctc_forward(xs.unsqueeze(0)).squeeze(0)
+
+    def accept(self, feats: torch.Tensor) -> torch.Tensor:
+        """Feed the next (T, 80) fbank frames; returns the tokens of the encoder frames they complete."""
+        self.feats = torch.cat([self.feats, feats.to(self.feats.dtype)])
+        return self._run(final=False)
+
+    def finalize(self) -> torch.Tensor:
+        """Decode everything left at the end of the recording."""
+        return self._run(final=True)
+
+    def pending_frames(self) -> List[int]:
+        """Frames waiting in front of the subsampling and of each layer."""
+        return [self.feats.shape[0]] + [x.shape[0] for x in self.inputs[:-1]]
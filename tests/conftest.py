@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.utils.init_model import init_model
+from model.utils.presets import MODEL_PRESETS
+
+
+TINY_MODEL_CONFIG = MODEL_PRESETS['tiny']
+
+
+@pytest.fixture(scope="session")
+def tiny_model():
+    """A small randomly initialised ChunkFormer and a matching character table."""
+    torch.manual_seed(0)
+    model = init_model(TINY_MODEL_CONFIG, None)
+    model.eval()
+    char_dict = {i: chr(ord('a') + i % 26) for i in range(TINY_MODEL_CONFIG['output_dim'])}
+    return model, char_dict
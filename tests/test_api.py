@@ -5,15 +5,20 @@ from pathlib import Path
 from unittest.mock import MagicMock
 
 import pytest
+import torch
 from litestar.testing import TestClient
 
 # Add the parent directory to the path to import api
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from model.utils.audio import decode_audio_bytes
+from model.utils.features import compute_fbank
+from model.utils.jobs import JobConsumer
+
 # Mock decode module before importing api
 sys.modules['decode'] = MagicMock()
 sys.modules['decode'].init = MagicMock(return_value=("dummy_model", {"a": 1}))
-sys.modules['decode'].load_audio = MagicMock(return_value="dummy_audio")
+sys.modules['decode'].load_audio = MagicMock(return_value=torch.zeros(1, 16000))
 sys.modules['decode'].endless_decode = MagicMock(return_value="dummy transcription")
 sys.modules['decode'].batch_decode = MagicMock()
 
@@ -26,6 +31,9 @@ def setup_dummy_environment(monkeypatch, tmp_path: Path):
     checkpoint_dir = tmp_path / "model"
     checkpoint_dir.mkdir(parents=True, exist_ok=True)
     monkeypatch.setenv("MODEL_CHECKPOINT", str(checkpoint_dir))
+    monkeypatch.setattr(api, "JOBS_DB", tmp_path / "jobs.sqlite3")
+    monkeypatch.setattr(api, "RESULT_CACHE_DIR", tmp_path / "results")
+    monkeypatch.setattr(api, "JOB_AUDIO_DIR", tmp_path / "jobs")
 
 
 @pytest.fixture()
@@ -90,26 +98,24 @@ def test_batch_transcription_segments_structure(client, monkeypatch, tmp_path):
     Verify that the batch transcription status payload returns segments per file with the
     correct structure and types when processing is completed.
     """
-    # Patch background processor to immediately mark task as completed with segments
-    async def immediate_process(task_id, files):
-        api.task_store[task_id]["status"] = "completed"
-        api.task_store[task_id]["results"] = [
+    # Patch the job handler to immediately return segments
+    async def immediate_process(task_id, payload):
+        return [
             {
-                "filename": f.filename or "file.wav",
+                "filename": f["filename"] or "file.wav",
                 "segments": [
                     {"start": 0, "end": 2, "decode": "foo"},
                     {"start": 2.0, "end": 4.5, "decode": "bar"},
                 ],
             }
-            for f in files
+            for f in payload["files"]
         ]
 
-    monkeypatch.setattr(api, "process_batch_files", immediate_process)
-
     files = [("data", ("sample1.wav", b"fakebytes", "audio/wav"))]
     upload_resp = client.post("/batch-transcribe", files=files)
     assert upload_resp.status_code == 201
     task_id = upload_resp.json()["task_id"]
+    assert asyncio.run(JobConsumer(api.job_store, immediate_process, on_finished=api.remove_job_files).run_once())
 
     poll_resp = client.get(f"/task-status/{task_id}")
     assert poll_resp.status_code == 200
@@ -140,26 +146,160 @@ def test_transcribe_audio_no_file(client):
 def test_batch_transcription_flow(client, monkeypatch, tmp_path):
     """End-to-end happy path for batch transcription: upload -> poll -> completed."""
 
-    async def immediate_process(task_id, files):
-        # Directly mark as completed without async processing
-        api.task_store[task_id]["status"] = "completed"
-        api.task_store[task_id]["results"] = [
-            {"filename": f.filename or "file.wav", "transcription": "dummy transcription"}
-            for f in files
-        ]
+    processed = []
 
-    monkeypatch.setattr(api, "process_batch_files", immediate_process)
+    def fake_run_batch_job(payload, model=None, char_dict=None):
+        processed.extend(Path(f["path"]).read_bytes() for f in payload["files"])
+        return [{"filename": f["filename"], "transcription": "dummy transcription"} for f in payload["files"]]
+
+    monkeypatch.setattr(api, "run_batch_job", fake_run_batch_job)
 
     # Single fake file upload (repeatable for multiple files)
     files = [("data", ("sample1.wav", b"fakebytes", "audio/wav"))]
     upload_resp = client.post("/batch-transcribe", files=files)
     assert upload_resp.status_code == 201  # POST endpoints typically return 201 (Created)
     task_id = upload_resp.json()["task_id"]
+    assert client.get(f"/task-status/{task_id}").json()["status"] == "pending"
+
+    # Run one consumer step the way the API consumers do
+    consumer = JobConsumer(api.job_store, api.process_batch_job, on_finished=api.remove_job_files)
+    assert asyncio.run(consumer.run_once())
+    assert processed == [b"fakebytes"]
+    assert not (api.JOB_AUDIO_DIR / task_id).exists()
 
-    # Immediately poll status – should already be completed due to patched processor
     poll_resp = client.get(f"/task-status/{task_id}")
     assert poll_resp.status_code == 200
     body = poll_resp.json()
 
     assert body["status"] == "completed"
-    assert body["results"] and body["results"][0]["transcription"] == "dummy transcription"
\ No newline at end of file
+    assert body["results"] and body["results"][0]["transcription"] == "dummy transcription"
+
+def test_transcribe_audio_queue_full_returns_429(client, monkeypatch):
+    """When the inference queue is full the request is rejected with 429 instead of waiting."""
+    def busy_submit(*args, **kwargs):
+        raise api.EngineBusyError("Inference queue is full")
+
+    monkeypatch.setattr(api.engine, "submit", busy_submit)
+
+    response = client.post(
+        "/transcribe_audio/",
+        files={"data": ("sample.wav", b"fakebytes", "audio/wav")}
+    )
+    assert response.status_code == 429
+
+
+def test_transcribe_wav_is_decoded_while_streaming(client, monkeypatch):
+    """WAV uploads are turned into features from the request stream, without a temp file or ffmpeg."""
+    def fail_load_audio(path):
+        raise AssertionError("load_audio should not be used for WAV uploads")
+
+    received = {}
+
+    def fake_endless_decode(args, waveform=None, feats=None, **kwargs):
+        received["waveform"] = waveform
+        received["feats"] = feats
+        return "dummy transcription"
+
+    monkeypatch.setattr(api, "load_audio", fail_load_audio)
+    monkeypatch.setattr(api, "endless_decode", fake_endless_decode)
+
+    wav_path = Path(__file__).parent / "test1.wav"
+    response = client.post(
+        "/transcribe_audio/",
+        files={"data": ("test1.wav", wav_path.read_bytes(), "audio/wav")}
+    )
+    assert response.status_code == 201
+    assert response.json()["transcription"] == "dummy transcription"
+    assert received["waveform"] is None
+    expected = compute_fbank(decode_audio_bytes(wav_path.read_bytes(), "test1.wav"))
+    assert received["feats"].shape == expected.shape
+    assert torch.allclose(received["feats"], expected, atol=1e-3)
+
+
+def test_identical_uploads_are_served_from_the_result_cache(client, monkeypatch):
+    calls = []
+
+    def counting_endless_decode(args, waveform=None, **kwargs):
+        calls.append(args)
+        return [{"start": "00:00:00:000", "end": "00:00:01:000", "decode": "xin chào"}]
+
+    monkeypatch.setattr(api, "endless_decode", counting_endless_decode)
+
+    bodies = [
+        client.post("/transcribe_audio/", files={"data": (name, b"samebytes", "audio/wav")}).json()
+        for name in ["a.wav", "b.wav"]
+    ]
+    assert len(calls) == 1
+    assert bodies[0]["transcription"] == bodies[1]["transcription"]
+    assert client.get("/cache/status").json()["result_cache"]["hits"] == 1
+
+
+def test_metrics_endpoint_reports_requests_and_queues(client):
+    client.post("/transcribe_audio/", files={"data": ("sample.wav", b"fakebytes", "audio/wav")})
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'chunkformer_real_time_factor_count{endpoint="transcribe_audio"}' in response.text
+    assert 'chunkformer_queue_depth{queue="engine"} 0' in response.text
+    assert "chunkformer_model_loaded 0" in response.text
+
+
+def test_profile_toggle_records_decode_stages(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(api, "PROFILES_DIR", tmp_path / "profiles")
+
+    def fake_decode(*args, **kwargs):
+        with api.metrics.stage("forward_parallel_chunk"):
+            return "dummy transcription"
+
+    monkeypatch.setattr(api, "endless_decode", fake_decode)
+    monkeypatch.setattr(api, "batcher", None)
+    assert client.post("/profile/stop").status_code == 400
+    assert client.post("/profile/start").status_code == 201
+    client.post("/transcribe_audio/", files={"data": ("sample.wav", b"fakebytes", "audio/wav")})
+
+    response = client.post("/profile/stop")
+    assert response.status_code == 201
+    body = response.json()
+    assert [row["path"] for row in body["stages"]] == ["forward_parallel_chunk"]
+    assert (Path(body["directory"]) / "trace.json").exists()
+
+
+def test_streaming_websocket_protocol(client, monkeypatch):
+    """PCM frames are fed to the streaming session and its events are pushed back as JSON."""
+    received = []
+
+    class FakeSession:
+        def __init__(self, **kwargs):
+            pass
+
+        def accept_pcm16(self, data, model=None, char_dict=None):
+            received.append(data)
+            return [{"type": "partial", "decode": "hel", "start": "00:00:00:000", "end": "00:00:00:800"}]
+
+        def finalize(self, model=None, char_dict=None):
+            return [{"type": "segment", "decode": "hello", "start": "00:00:00:000", "end": "00:00:01:600"}]
+
+    monkeypatch.setattr(api, "StreamingSession", FakeSession)
+
+    with client.websocket_connect("/ws/transcribe") as ws:
+        ws.send_bytes(b"\x00\x01" * 160)
+        assert ws.receive_json()["type"] == "partial"
+        ws.send_text("EOS")
+        final = ws.receive_json()
+        assert final["type"] == "segment" and final["decode"] == "hello"
+        assert ws.receive_json() == {"type": "end"}
+
+    assert received == [b"\x00\x01" * 160]
+
+
+def test_result_key_covers_decode_settings(monkeypatch):
+    """Cached transcripts are not reused after a setting that changes them is edited."""
+    key = api.result_key("a" * 64, "segments")
+    monkeypatch.setitem(api.config['model'], 'max_streams', 4)
+    assert api.result_key("a" * 64, "segments") == key
+    for section, name, value in [('model', 'long_form_mode', 'wavefront'), ('model', 'segment_overlap', 1),
+                                 ('model', 'total_batch_duration', 7), ('vad', 'padding', 0.9)]:
+        monkeypatch.setitem(api.config[section], name, value)
+        assert api.result_key("a" * 64, "segments") != key
+        key = api.result_key("a" * 64, "segments")
@@ -0,0 +1,88 @@
+import os
+import struct
+import sys
+
+import numpy as np
+import pytest
+import soundfile
+import torch
+import torchaudio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.utils.audio import decode_audio_bytes, get_resampler, iter_audio_blocks, parse_wav_header, read_audio_file
+
+
+def make_wav(samples: np.ndarray, sample_rate: int) -> bytes:
+    """Build a 16-bit PCM WAV file from (T, C) int16 samples."""
+    channels = samples.shape[1]
+    data = samples.astype("<i2").tobytes()
+    fmt = struct.pack("<HHIIHH", 1, channels, sample_rate, sample_rate * channels * 2, channels * 2, 16)
+    return (b"RIFF" + struct.pack("<I", 4 + 8 + len(fmt) + 8 + len(data)) + b"WAVE"
+            + b"fmt " + struct.pack("<I", len(fmt)) + fmt
+            + b"data" + struct.pack("<I", len(data)) + data)
+
+
+def test_stereo_wav_is_downmixed_in_int16_scale():
+    left = np.full(1600, 1000, dtype=np.int16)
+    right = np.full(1600, 3000, dtype=np.int16)
+    waveform = decode_audio_bytes(make_wav(np.stack([left, right], axis=1), 16000), "a.wav")
+
+    assert waveform.shape == (1, 1600)
+    assert waveform.dtype.is_floating_point
+    assert waveform[0, 100].item() == pytest.approx(2000.0)
+
+
+def test_wav_is_resampled_to_target_rate():
+    samples = (np.sin(np.arange(8000) / 10) * 10000).astype(np.int16)[:, None]
+    waveform = decode_audio_bytes(make_wav(samples, 8000), "a.wav", frame_rate=16000)
+    assert waveform.shape == (1, 16000)
+
+
+def test_raw_pcm_is_read_as_16bit_mono():
+    samples = np.arange(-5, 5, dtype="<i2")
+    waveform = decode_audio_bytes(samples.tobytes(), "stream.pcm")
+    assert waveform.tolist() == [[float(v) for v in samples]]
+
+
+def test_unknown_content_falls_back():
+    assert decode_audio_bytes(b"ID3\x03 not a wav", "song.mp3") is None
+    assert parse_wav_header(b"fakebytes") is None
+
+
+def test_audio_file_fast_path(tmp_path):
+    samples = (np.sin(np.arange(16000) / 7) * 8000).astype(np.int16)[:, None]
+    path = tmp_path / "a.wav"
+    path.write_bytes(make_wav(samples, 16000))
+    assert read_audio_file(path).tolist() == [samples[:, 0].astype(float).tolist()]
+
+    # a streamed WAV whose data size was never filled in
+    content = bytearray(make_wav(samples[:8000], 8000))
+    content[40:44] = b"\xff\xff\xff\xff"
+    path.write_bytes(bytes(content))
+    expected = torchaudio.functional.resample(torch.from_numpy(samples[:8000, 0].astype(np.float32))[None], 8000, 16000)
+    assert torch.allclose(read_audio_file(path), expected, atol=1e-2)
+    assert get_resampler(8000, 16000) is get_resampler(8000, 16000)
+
+    path.write_bytes(b"ID3\x03 not a wav")
+    assert read_audio_file(path) is None
+
+
+def test_flac_round_trip(tmp_path):
+    left = (np.sin(np.arange(16000) / 7) * 8000).astype(np.int16)
+    samples = np.stack([left, left // 2], axis=1)
+    path = tmp_path / "a.flac"
+    soundfile.write(path, samples, 16000, format="FLAC", subtype="PCM_16")
+
+    expected = decode_audio_bytes(make_wav(samples, 16000), "a.wav")
+    assert torch.equal(read_audio_file(path), expected)
+    assert torch.equal(decode_audio_bytes(path.read_bytes(), "a.flac"), expected)
+
+
+def test_audio_blocks_concatenate_to_the_whole_file(tmp_path):
+    samples = (np.sin(np.arange(40000).reshape(-1, 2) / 7) * 8000).astype(np.int16)
+    path = tmp_path / "a.wav"
+    path.write_bytes(make_wav(samples, 16000))
+    blocks = list(iter_audio_blocks(path, block_seconds=0.3))
+    assert [block.shape[1] for block in blocks] == [4800] * 4 + [800]
+    assert torch.equal(torch.cat(blocks, dim=1), read_audio_file(path))
@@ -0,0 +1,81 @@
+import argparse
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.utils import autotune
+from model.utils.autotune import MemoryProfile, batch_duration_for_budget, load_profiles, tune_total_batch_duration
+from model.utils.multi_stream import relative_right_context, window_size
+from model.utils.wavefront import layer_lookahead, wavefront_window
+
+
+def chunk_budget(duration, chunk_size, subsampling=8):
+    """How decode.py turns total_batch_duration into a number of chunks."""
+    return int(duration // 0.01) // 2 // chunk_size // subsampling
+
+
+@pytest.mark.parametrize("chunk_size", [8, 64])
+def test_duration_matches_the_chunks_that_fit(chunk_size):
+    profile = MemoryProfile(base_mb=1000, per_chunk_mb=30)
+    for budget in (1300, 4000, 64000):
+        max_chunks = int((budget * autotune.SAFETY_FACTOR - 1000) // 30)
+        duration = batch_duration_for_budget(profile, budget, chunk_size)
+        assert chunk_budget(duration, chunk_size) == max_chunks
+        assert chunk_budget(duration + 1, chunk_size) >= max_chunks
+
+    with pytest.raises(ValueError):
+        batch_duration_for_budget(profile, 1000, chunk_size)
+
+
+def test_profile_is_measured_once_then_reused(tiny_model, tmp_path, monkeypatch):
+    model, char_dict = tiny_model
+    args = argparse.Namespace(chunk_size=8, left_context_size=8, right_context_size=8)
+    profiles = tmp_path / "profiles.json"
+
+    probes = []
+    monkeypatch.setattr(autotune, "probe_memory_profile",
+                        lambda model, args: probes.append(args) or MemoryProfile(100, 2.5))
+    monkeypatch.setattr(autotune, "memory_mb", lambda device, peak: 200.0)
+    first = tune_total_batch_duration(args, 1000, profiles, model=model, char_dict=char_dict)
+    second = tune_total_batch_duration(args, 1000, profiles, model=model, char_dict=char_dict)
+
+    assert first == second
+    assert chunk_budget(first, 8) == int((1000 * autotune.SAFETY_FACTOR - 200) // 2.5)
+    assert len(probes) == 1
+    assert list(load_profiles(profiles).values()) == [{"base_mb": 100, "per_chunk_mb": 2.5}]
+
+
+def test_long_form_duration_leaves_room_for_the_lookahead(tiny_model, tmp_path, monkeypatch):
+    model, char_dict = tiny_model
+    monkeypatch.setattr(autotune, "probe_memory_profile", lambda model, args: MemoryProfile(100, 2.5))
+    monkeypatch.setattr(autotune, "memory_mb", lambda device, peak: 200.0)
+    # 8 chunks fit in 260 MB, 4 in 248 MB
+    max_chunks, small_budget = 8, 260
+
+    args = argparse.Namespace(chunk_size=8, left_context_size=8, right_context_size=8,
+                              long_form_mode="sequential", max_streams=1)
+    duration = tune_total_batch_duration(args, small_budget, tmp_path / "profiles.json", long_form=True,
+                                         model=model, char_dict=char_dict)
+    right_context = relative_right_context(model, 8, 8) // 8
+    assert (window_size(duration, 8, 8) + right_context) // 8 <= max_chunks
+    assert duration < tune_total_batch_duration(args, small_budget, model=model, char_dict=char_dict)
+    # the right context alone takes 4 chunks, a window does not fit next to it
+    with pytest.raises(ValueError):
+        tune_total_batch_duration(args, 248, long_form=True, model=model, char_dict=char_dict)
+
+    args.long_form_mode = "wavefront"
+    duration = tune_total_batch_duration(args, small_budget, long_form=True, model=model, char_dict=char_dict)
+    lookahead = layer_lookahead(model, 8, 8)
+    assert (wavefront_window(duration, 8, 8, lookahead) + lookahead) // 8 <= max_chunks
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/clear_refs"), reason="peak RSS reset needs Linux")
+def test_probe_measures_a_chunk_cost(tiny_model):
+    model, _ = tiny_model
+    args = argparse.Namespace(chunk_size=8, left_context_size=8, right_context_size=8)
+    profile = autotune.probe_memory_profile(model, args)
+    assert profile.base_mb > 0
+    assert profile.per_chunk_mb > 0
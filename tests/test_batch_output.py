@@ -0,0 +1,42 @@
+import os
+import sys
+
+import jiwer
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.utils.batch_output import ResultWriter, WerCounter
+
+
+@pytest.mark.parametrize("suffix", [".jsonl", ".tsv"])
+def test_results_are_resumed_from_the_output(tmp_path, suffix):
+    path = tmp_path / f"out{suffix}"
+    writer = ResultWriter(path)
+    assert list(writer.resume()) == []
+    writer.write([{"row": 3, "wav": "c.wav", "decode": "xin chào"},
+                  {"row": 0, "wav": "a.wav", "decode": "một\thai"}])
+    writer.write([{"row": 1, "wav": "b.wav", "decode": ""}])
+    writer.close()
+    # a crash in the middle of writing a line
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"row": 2, "wav"' if suffix == ".jsonl" else "2\tb.w")
+
+    writer = ResultWriter(path)
+    records = list(writer.resume())
+    assert [record["row"] for record in records] == [3, 0, 1]
+    assert records[0]["decode"] == "xin chào"
+    writer.write([{"row": 2, "wav": "b.wav", "decode": "ba"}])
+    writer.close()
+    assert [record["row"] for record in ResultWriter(path).resume()] == [3, 0, 1, 2]
+
+
+def test_wer_accumulated_over_batches_matches_jiwer():
+    references = ["xin chào việt nam", "một hai ba", "", "bốn năm"]
+    hypotheses = ["xin chào nam", "một hai ba bốn", "thừa", "bốn năm"]
+    counter = WerCounter()
+    counter.update(references[:2], hypotheses[:2])
+    counter.update(references[2:], hypotheses[2:])
+    # empty references are skipped, like rows without a transcript
+    assert counter.wer == pytest.approx(jiwer.wer([references[i] for i in (0, 1, 3)],
+                                                  [hypotheses[i] for i in (0, 1, 3)]))
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.utils.batch_plan import duration_to_frames, num_chunks, plan_batches, probe_duration
+from test_audio import make_wav
+
+
+def test_wav_duration_comes_from_the_header(tmp_path):
+    path = tmp_path / "a.wav"
+    path.write_bytes(make_wav(np.zeros((12000, 2), dtype=np.int16), 8000))
+    assert probe_duration(path) == pytest.approx(1.5)
+
+    garbage = tmp_path / "b.mp3"
+    garbage.write_bytes(b"ID3\x03 not audio")
+    assert probe_duration(garbage) is None
+
+
+def test_num_chunks_matches_the_encoder(tiny_model):
+    model, _ = tiny_model
+    embed = model.encoder.embed
+    chunk_size = 8
+    for duration in (0.3, 1.0, 2.37, 5.0):
+        frames = duration_to_frames(duration)
+        x = torch.zeros(frames, 80)
+        _, _, n_chunks, _, _, _ = model.encoder.forward_parallel_chunk(
+            xs=[x], xs_origin_lens=torch.tensor([frames]), chunk_size=chunk_size,
+            left_context_size=8, right_context_size=8, offset=torch.zeros(1, dtype=torch.int))
+        assert n_chunks == [num_chunks(frames, chunk_size, embed.subsampling_factor, embed.right_context + 1)]
+
+
+def test_batches_respect_the_chunk_budget():
+    durations = [3.0, 40.0, None, 5.0, 12.0, 0.5, 41.0, 7.0]
+    batches = plan_batches(durations, max_chunks=10, chunk_size=64)
+
+    assert sorted(i for batch in batches for i in batch) == list(range(len(durations)))
+    assert batches[0] == [6] and batches[-1] == [2]
+    for batch in batches:
+        chunks = sum(num_chunks(duration_to_frames(durations[i]), 64) for i in batch if durations[i])
+        assert len(batch) == 1 or chunks <= 10
@@ -0,0 +1,73 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.utils.batching import MicroBatcher
+
+
+def test_concurrent_requests_share_one_batch():
+    """Requests arriving within the wait window are decoded together and fanned back out."""
+    batches = []
+
+    async def batch_fn(items):
+        batches.append(list(items))
+        return [f"decoded {item}" for item in items]
+
+    async def scenario():
+        batcher = MicroBatcher(batch_fn, max_wait_ms=50, max_batch_duration=100)
+        batcher.start()
+        results = await asyncio.gather(*(batcher.submit(name, 5.0) for name in ["a", "b", "c"]))
+        await batcher.stop()
+        return results
+
+    results = asyncio.run(scenario())
+    assert results == ["decoded a", "decoded b", "decoded c"]
+    assert batches == [["a", "b", "c"]]
+
+
+def test_duration_budget_splits_batches():
+    """A request that would overflow the audio budget is carried over to the next batch."""
+    batches = []
+
+    async def batch_fn(items):
+        batches.append(list(items))
+        return items
+
+    async def scenario():
+        batcher = MicroBatcher(batch_fn, max_wait_ms=50, max_batch_duration=20)
+        batcher.start()
+        results = await asyncio.gather(*(batcher.submit(i, 8.0) for i in range(4)))
+        await batcher.stop()
+        return results
+
+    assert asyncio.run(scenario()) == [0, 1, 2, 3]
+    assert batches == [[0, 1], [2, 3]]
+
+
+def test_batch_failure_propagates_to_every_request():
+    """When decoding a batch fails, every caller in the batch sees the error."""
+    async def batch_fn(items):
+        raise ValueError("decoder exploded")
+
+    async def scenario():
+        batcher = MicroBatcher(batch_fn, max_wait_ms=10)
+        batcher.start()
+        results = await asyncio.gather(batcher.submit("a", 1.0), batcher.submit("b", 1.0),
+                                       return_exceptions=True)
+        await batcher.stop()
+        return results
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(r, ValueError) for r in results)
+
+
+def test_submit_requires_running_batcher():
+    async def batch_fn(items):
+        return items
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(MicroBatcher(batch_fn).submit("a", 1.0))
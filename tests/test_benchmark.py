@@ -0,0 +1,29 @@
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import run_benchmark
+
+
+def test_sweep_reports_every_setting():
+    args = argparse.Namespace(preset="tiny", model_config=None, model_checkpoint=None, device="cpu",
+                              durations=[0.5, 2.0], utterances_per_duration=2, chunk_sizes=[8, 16],
+                              left_context_sizes=[8], right_context_sizes=[8], total_batch_durations=[4],
+                              dtypes=["fp32", "bf16"], threads=[1], repeats=1, seed=0)
+    report = run_benchmark(args)
+    json.dumps(report)
+
+    assert len(report["durations"]) == 4
+    assert len(report["results"]) == 4
+    for result in report["results"]:
+        if "error" in result:
+            continue
+        assert result["audio_seconds"] == round(sum(report["durations"]), 2)
+        assert result["real_time_factor"] > 0
+        assert 0 <= result["padded_fraction"] < 1
+        latency = result["batch_latency_ms"]
+        assert latency["p50"] <= latency["p90"] <= latency["p99"] <= latency["max"]
+    assert any("error" not in result and result["dtype"] == "fp32" for result in report["results"])
@@ -0,0 +1,68 @@
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conftest import TINY_MODEL_CONFIG
+from model.utils.init_model import init_model
+from test_audio import make_wav
+
+
+def decode_rank(rank, world_size, init_file, audio_list, tmp_path):
+    # spawned processes import the real decode module, not the mock of test_api
+    import decode
+    from model.utils.audio import read_audio_file
+
+    torch.set_num_threads(1)
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size)
+    torch.manual_seed(0)
+    model = init_model(TINY_MODEL_CONFIG, None)
+    model.eval()
+    char_dict = {i: chr(ord('a') + i % 26) for i in range(TINY_MODEL_CONFIG['output_dim'])}
+    decode.load_audio = read_audio_file
+    args = argparse.Namespace(audio_list=audio_list, output=os.path.join(tmp_path, "merged.jsonl"),
+                              total_batch_duration=5, chunk_size=8,
+                              left_context_size=8, right_context_size=8, manifest_chunk_rows=4,
+                              prefetch_workers=1, prefetch_batches=1, num_workers=1,
+                              feature_cache=None, feature_cache_dtype="float16")
+    decode.batch_decode(args, model, char_dict)
+    # without --output the decodes are gathered to rank 0, which rewrites the TSV
+    args.output = None
+    decode.batch_decode(args, model, char_dict)
+    dist.destroy_process_group()
+
+    if rank == 0:
+        args.output = os.path.join(tmp_path, "single.jsonl")
+        decode.batch_decode(args, model, char_dict)
+
+
+def test_ranks_split_the_manifest_and_rank_0_merges(tmp_path):
+    rng = np.random.default_rng(0)
+    wavs = []
+    for i, duration in enumerate([1.0, 3.0, 0.5, 2.0, 1.5, 0.7, 2.5]):
+        path = tmp_path / f"{i}.wav"
+        path.write_bytes(make_wav((rng.standard_normal((int(16000 * duration), 1)) * 3000).astype(np.int16), 16000))
+        wavs.append(str(path))
+    audio_list = tmp_path / "list.tsv"
+    pd.DataFrame({"wav": wavs, "txt": ["a b"] * len(wavs)}).to_csv(audio_list, sep="\t", index=False)
+
+    mp.spawn(decode_rank, args=(2, str(tmp_path / "init"), str(audio_list), str(tmp_path)), nprocs=2)
+
+    def records(name):
+        lines = (tmp_path / name).read_text(encoding="utf-8").splitlines()
+        return sorted((json.loads(line) for line in lines), key=lambda record: record["row"])
+
+    expected = records("single.jsonl")
+    assert [record["row"] for record in expected] == list(range(len(wavs)))
+    assert records("merged.jsonl") == expected
+    assert len(records("merged.rank1-of-2.jsonl")) == 3
+    df = pd.read_csv(audio_list, sep="\t", keep_default_na=False)
+    assert df["decode"].to_list() == [record["decode"] for record in expected]
@@ -0,0 +1,128 @@
+import asyncio
+import multiprocessing
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from model.utils import metrics
+from model.utils.engine import EngineBusyError, InferenceEngine, ProcessInferenceEngine
+
+
+def test_jobs_run_off_the_calling_thread_with_the_model():
+    engine = InferenceEngine(max_queue_size=4)
+    engine.load(lambda: ("the model", {0: "<blank>"}))
+
+    def job(x, model=None, char_dict=None):
+        return x, model, threading.current_thread().name
+
+    try:
+        result = asyncio.run(engine.run(job, 3))
+    finally:
+        engine.stop()
+
+    assert result == (3, "the model", engine.name)
+
+
+def test_full_queue_raises_engine_busy():
+    engine = InferenceEngine(max_queue_size=1)
+    engine.start()
+    release = threading.Event()
+    started = threading.Event()
+
+    def blocking_job(model=None, char_dict=None):
+        started.set()
+        release.wait()
+
+    try:
+        running = engine.submit(blocking_job)
+        started.wait()
+        queued = engine.submit(blocking_job)
+        with pytest.raises(EngineBusyError):
+            engine.submit(blocking_job)
+    finally:
+        release.set()
+        engine.stop()
+
+    assert running.done() and queued.done()
+
+
+def test_job_errors_are_returned_to_the_caller():
+    engine = InferenceEngine()
+    engine.start()
+
+    def failing_job(model=None, char_dict=None):
+        raise ValueError("bad audio")
+
+    try:
+        with pytest.raises(ValueError):
+            engine.submit(failing_job).result()
+    finally:
+        engine.stop()
+
+
+def _toy_init():
+    return torch.nn.Linear(4, 2), {0: "<blank>"}
+
+
+@torch.no_grad()
+def _process_job(x, model=None, char_dict=None):
+    return os.getpid(), all(p.is_shared() for p in model.parameters()), float(model(x).sum().detach())
+
+
+def _crashing_job(model=None, char_dict=None):
+    os._exit(3)
+
+
+def _counting_job(model=None, char_dict=None):
+    metrics.AUDIO_SECONDS.inc(1.0, entrypoint="engine-test")
+
+
+def test_process_engine_runs_jobs_on_forked_workers_with_shared_weights():
+    engine = ProcessInferenceEngine(max_queue_size=4, num_workers=2, threads_per_worker=1)
+    engine.load(_toy_init)
+    x = torch.ones(1, 4)
+    try:
+        pid, shared, value = asyncio.run(engine.run(_process_job, x))
+        # a dead worker fails its job and is replaced
+        with pytest.raises(RuntimeError):
+            engine.submit(_crashing_job).result(timeout=30)
+        assert engine.submit(_process_job, x).result(timeout=30)[2] == value
+    finally:
+        engine.stop()
+
+    assert pid != os.getpid()
+    assert shared
+    assert value == pytest.approx(float(engine.model(x).sum().detach()))
+
+
+def test_process_workers_only_report_their_own_measurements():
+    """Values recorded before the fork are not sent back again by every worker."""
+    metrics.AUDIO_SECONDS.inc(100.0, entrypoint="engine-test")
+    before = metrics.AUDIO_SECONDS.value(entrypoint="engine-test")
+    engine = ProcessInferenceEngine(max_queue_size=4, num_workers=2, threads_per_worker=1)
+    engine.load(_toy_init)
+    try:
+        for future in [engine.submit(_counting_job) for _ in range(4)]:
+            future.result(timeout=30)
+    finally:
+        engine.stop()
+
+    assert metrics.AUDIO_SECONDS.value(entrypoint="engine-test") == before + 4.0
+
+
+def test_process_engine_leaves_no_workers_behind_across_restarts():
+    engine = ProcessInferenceEngine(max_queue_size=4, num_workers=2, threads_per_worker=1)
+    before = len(multiprocessing.active_children())
+    for _ in range(3):
+        engine.load(_toy_init)
+        assert engine.submit(_process_job, torch.ones(1, 4)).result(timeout=30)
+        # a late result makes the dispatcher look at the workers while they exit
+        engine._results.put(("done", 0, -1, (None, {}, [])))
+        engine.stop()
+        assert len(multiprocessing.active_children()) == before
@@ -0,0 +1,47 @@
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.utils.feature_store import FeatureStore
+
+
+def test_features_are_served_from_the_shards(tmp_path):
+    audio = [tmp_path / f"{i}.wav" for i in range(3)]
+    for path in audio:
+        path.write_bytes(b"audio")
+    feats = [torch.randn(n, 80) for n in (5, 120, 33)]
+
+    store = FeatureStore(tmp_path / "feats", dtype="float32", shard_mb=0)
+    for path, x in zip(audio, feats):
+        store.put(path, x)
+    assert torch.equal(store.get(audio[1]), feats[1])
+    store.close()
+
+    # a later run, e.g. another process
+    store = FeatureStore(tmp_path / "feats")
+    assert [store.num_frames(path) for path in audio] == [5, 120, 33]
+    for path, x in zip(audio, feats):
+        assert torch.equal(store.get(path), x)
+    assert len(list((tmp_path / "feats").glob("shard-*.bin"))) == 3
+
+    # float16 storage halves the size at a small precision cost
+    stored = store.put(audio[0], feats[0])
+    assert torch.allclose(store.get(audio[0]), feats[0], atol=1e-2)
+    # the run filling the store sees the same features as the runs reading it
+    assert stored.dtype == torch.float32
+    assert torch.equal(stored, store.get(audio[0]))
+    store.close()
+
+
+def test_changed_file_is_a_miss(tmp_path):
+    path = tmp_path / "a.wav"
+    path.write_bytes(b"audio")
+    store = FeatureStore(tmp_path / "feats")
+    store.put(path, torch.ones(4, 80))
+
+    path.write_bytes(b"other audio")
+    assert store.get(path) is None
+    assert store.num_frames(tmp_path / "missing.wav") is None
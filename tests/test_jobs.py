@@ -0,0 +1,79 @@
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.utils.engine import EngineBusyError
+from model.utils.jobs import JobConsumer, JobStore, QueueFullError
+
+
+def test_jobs_survive_reopening_the_store(tmp_path):
+    job_id = JobStore(tmp_path / "jobs.sqlite3").create({"files": ["a.wav"]})
+
+    store = JobStore(tmp_path / "jobs.sqlite3")
+    assert store.get(job_id)["status"] == "pending"
+    assert store.claim("worker-1") == (job_id, {"files": ["a.wav"]})
+    assert store.claim("worker-2") is None
+
+    store.complete(job_id, "worker-1", [{"transcription": "xin chào"}])
+    job = store.get(job_id)
+    assert job["status"] == "completed"
+    assert job["results"] == [{"transcription": "xin chào"}]
+
+
+def test_expired_lease_is_recovered_then_given_up(tmp_path):
+    """A job whose worker died is retried until it used up its attempts."""
+    store = JobStore(tmp_path / "jobs.sqlite3", lease_seconds=0.05, max_attempts=2)
+    job_id = store.create({})
+
+    assert store.claim("crashed-1")[0] == job_id
+    assert store.claim("worker-2") is None  # lease still held
+    time.sleep(0.1)
+    assert store.claim("crashed-2")[0] == job_id
+    assert not store.heartbeat(job_id, "crashed-1")
+    # the first worker cannot overwrite the outcome of the job it lost
+    assert not store.complete(job_id, "crashed-1", [])
+    assert not store.fail(job_id, "crashed-1", "late")
+    assert store.get(job_id)["status"] == "processing"
+    time.sleep(0.1)
+
+    assert store.claim("worker-3") is None
+    job = store.get(job_id)
+    assert job["status"] == "failed"
+    assert job["errors"]
+
+
+def test_max_pending_and_expiry(tmp_path):
+    store = JobStore(tmp_path / "jobs.sqlite3", max_pending=1, result_ttl_hours=0)
+    job_id = store.create({"dir": "a"})
+    with pytest.raises(QueueFullError):
+        store.create({"dir": "b"})
+
+    store.claim("worker")
+    assert store.fail(job_id, "worker", "bad audio")
+    assert store.expire() == [{"dir": "a"}]
+    assert store.get(job_id) is None
+
+
+def test_consumer_hands_busy_jobs_back(tmp_path):
+    store = JobStore(tmp_path / "jobs.sqlite3")
+    job_id = store.create({"n": 1})
+    finished = []
+    calls = []
+
+    async def handler(job_id, payload):
+        calls.append(job_id)
+        if len(calls) == 1:
+            raise EngineBusyError("busy")
+        return [payload["n"]]
+
+    consumer = JobConsumer(store, handler, on_finished=finished.append, poll_interval=0)
+    assert asyncio.run(consumer.run_once())
+    assert store.get(job_id)["status"] == "pending"
+    assert asyncio.run(consumer.run_once())
+    assert store.get(job_id)["results"] == [1]
+    assert finished == [{"n": 1}]
@@ -0,0 +1,62 @@
+import argparse
+import importlib.util
+import os
+import sys
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.utils.features import compute_fbank
+from model.utils.long_form import frame_agreement, plan_segments, stitch_hyps
+
+
+def test_segments_overlap_and_cut_in_pauses():
+    rng = np.random.default_rng(0)
+    # 10 s of speech-like noise with a pause from 4.5 s to 5.0 s
+    waveform = rng.standard_normal(16000 * 10) * 3000
+    waveform[72000:80000] *= 0.001
+    feats = compute_fbank(torch.from_numpy(waveform.astype(np.float32)).unsqueeze(0))
+
+    cuts, segments = plan_segments(feats, segment_frames=400, overlap_frames=100, search_frames=150, align=8)
+    assert len(cuts) == 3 and cuts[0] == 0 and cuts[-1] == feats.shape[0]
+    assert 450 <= cuts[1] <= 500 and cuts[1] % 8 == 0
+    # half the overlap on each side of the cut, rounded outwards to whole encoder frames
+    assert segments[0] == (0, cuts[1] + 56)
+    assert segments[1] == ((cuts[1] - 50) // 8 * 8, feats.shape[0])
+
+
+def test_stitching_switches_where_both_segments_are_blank():
+    truth = torch.tensor([0, 3, 3, 0, 5, 0, 0, 7, 7, 0, 2, 0, 4, 0, 0, 6])
+    segments = [(0, 88), (56, 128)]  # encoder frames 0-10 and 7-15
+    cuts = [0, 72, 128]
+    first = truth[0:11].clone()
+    first[10] = 9  # the end of a segment lacks right context
+    second = truth[7:16].clone()
+    second[0] = 1  # and its start lacks left context
+    hyps = stitch_hyps([first, second], segments, cuts, subsampling=8, num_frames=16)
+    assert torch.equal(hyps, truth)
+    assert frame_agreement(hyps, truth) == 1.0
+
+
+def load_decode():
+    # test_api replaces the `decode` module with a mock, load the real one under another name
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "decode.py")
+    spec = importlib.util.spec_from_file_location("real_decode", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_parallel_mode_accepts_recordings_without_encoder_frames(tiny_model):
+    """Too short for one encoder frame, or no speech left after the VAD: no tokens, as in the other modes."""
+    model, char_dict = tiny_model
+    decode = load_decode()
+    torch.manual_seed(0)
+    for feats, vad in [(torch.zeros(0, 80), None), (torch.randn(5, 80), None), (torch.rand(3000, 80), "energy")]:
+        args = argparse.Namespace(chunk_size=8, left_context_size=16, right_context_size=16, total_batch_duration=6,
+                                  long_form_mode="parallel", segment_duration=10, segment_overlap=2, num_workers=1,
+                                  vad=vad, vad_threshold_db=12.0, vad_min_silence=1.0, vad_padding=0.3,
+                                  long_form_audio=None)
+        assert decode.endless_decode(args, model, char_dict, feats=feats) == []
@@ -0,0 +1,44 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.utils.metrics import Registry
+
+
+def test_prometheus_text_format():
+    registry = Registry()
+    frames = registry.counter("frames_total", "Encoder frames", ["kind"])
+    stage = registry.histogram("stage_seconds", "Stage time", ["stage"], buckets=(0.1, 1.0))
+    depth = registry.gauge("queue_depth", "Waiting jobs", ["queue"])
+
+    frames.inc(640, kind="real")
+    frames.inc(12, kind="padded")
+    stage.observe(0.05, stage="fbank")
+    stage.observe(0.5, stage="fbank")
+    depth.set_function(lambda: [({"queue": "engine"}, 3)])
+
+    lines = registry.render().splitlines()
+    assert "# TYPE frames_total counter" in lines
+    assert 'frames_total{kind="real"} 640' in lines
+    assert 'stage_seconds_bucket{stage="fbank",le="0.1"} 1' in lines
+    assert 'stage_seconds_bucket{stage="fbank",le="1"} 2' in lines
+    assert 'stage_seconds_bucket{stage="fbank",le="+Inf"} 2' in lines
+    assert 'stage_seconds_count{stage="fbank"} 2' in lines
+    assert 'queue_depth{queue="engine"} 3' in lines
+
+
+def test_worker_measurements_are_merged():
+    """What a forked worker drains is added to the serving process' values."""
+    parent, worker = Registry(), Registry()
+    for registry in (parent, worker):
+        registry.counter("audio_seconds_total", "Audio", ["entrypoint"])
+        registry.histogram("stage_seconds", "Stage time", ["stage"])
+    parent._metrics["audio_seconds_total"].inc(1.5, entrypoint="endless_decode")
+    worker._metrics["audio_seconds_total"].inc(2.0, entrypoint="endless_decode")
+    worker._metrics["stage_seconds"].observe(0.2, stage="ctc_forward")
+
+    parent.merge(worker.drain())
+    assert parent._metrics["audio_seconds_total"].value(entrypoint="endless_decode") == 3.5
+    assert parent._metrics["stage_seconds"].count(stage="ctc_forward") == 1
+    assert worker._metrics["stage_seconds"].count(stage="ctc_forward") == 0
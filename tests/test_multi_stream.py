@@ -0,0 +1,70 @@
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.utils.multi_stream import MultiStreamDecoder, window_size
+
+
+def decode_alone(model, feats, window):
+    decoder = MultiStreamDecoder(model, chunk_size=8, left_context_size=16, right_context_size=16,
+                                 window=window, max_streams=1)
+    decoder.add(feats)
+    return decoder.run()[0]
+
+
+def test_streams_decoded_together_match_each_decoded_alone(tiny_model):
+    model, _ = tiny_model
+    torch.manual_seed(0)
+    # more recordings than streams, of very different lengths, so streams leave and join mid-run
+    lengths = [3000, 700, 5000, 0, 2500]
+    recordings = [torch.randn(length, 80) for length in lengths]
+    window = window_size(6, chunk_size=8, subsampling=8)
+
+    decoder = MultiStreamDecoder(model, chunk_size=8, left_context_size=16, right_context_size=16,
+                                 window=window, max_streams=2)
+    ids = [decoder.add(feats) for feats in recordings]
+    steps, finished = 0, {}
+    while decoder.pending:
+        finished.update(decoder.step())
+        steps += 1
+
+    assert sorted(finished) == ids
+    for stream_id, feats in zip(ids, recordings):
+        alone = decode_alone(model, feats, window)
+        assert torch.equal(finished[stream_id], alone)
+        assert alone.shape[0] == int(model.encoder.embed.calc_length(torch.tensor([feats.shape[0]]))) or not len(feats)
+    # lock step: fewer encoder calls than decoding the recordings one after another
+    assert steps < sum(decoder.num_windows(length) for length in lengths)
+
+
+def test_features_fed_piece_by_piece_are_decoded_in_bounded_memory(tiny_model):
+    model, _ = tiny_model
+    torch.manual_seed(1)
+    feats = torch.randn(6000, 80)
+    window = window_size(6, chunk_size=8, subsampling=8)
+    expected = decode_alone(model, feats, window)
+
+    decoder = MultiStreamDecoder(model, chunk_size=8, left_context_size=16, right_context_size=16,
+                                 window=window, max_streams=1)
+    stream_id = decoder.open()
+    tokens, buffered = [], []
+    for piece in feats.split(333):
+        decoder.extend(stream_id, piece)
+        # as many windows as the new features complete
+        while True:
+            assert decoder.step() == []
+            tokens.append(decoder.pop_tokens(stream_id))
+            if tokens[-1].numel() == 0:
+                break
+        buffered.append(decoder._streams[stream_id].feats.shape[0])
+    # windows are decoded while the features arrive, not only at the end
+    assert sum(t.shape[0] for t in tokens) > expected.shape[0] // 2
+    decoder.close(stream_id)
+    tokens += list(decoder.run().values())
+
+    assert torch.equal(torch.cat(tokens), expected)
+    # decoded features are dropped: a window, its right context and one piece at most
+    assert max(buffered) <= window * 8 + 7 + decoder.right_context + 333
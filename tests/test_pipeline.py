@@ -0,0 +1,63 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.utils.pipeline import BatchPipeline
+
+
+def test_stages_overlap_and_keep_batch_order():
+    batches = [[0, 1], [2], [3, 4, 5], [6]]
+    encoder_thread = threading.current_thread()
+    outputs = []
+
+    def load(item):
+        time.sleep(0.02 * (item % 3))  # items finish out of order
+        return item * 10
+
+    def encode(batch, loaded):
+        assert threading.current_thread() is encoder_thread
+        time.sleep(0.02)
+        return loaded
+
+    def output(batch, encoded):
+        assert threading.current_thread() is not encoder_thread
+        outputs.append((batch, encoded))
+
+    pipeline = BatchPipeline(load, encode, output, num_workers=3, prefetch_batches=1)
+    pipeline.run(batches)
+
+    assert outputs == [(batch, [item * 10 for item in batch]) for batch in batches]
+    load_stats, encode_stats, output_stats = pipeline.stats
+    assert (load_stats.items, encode_stats.items, output_stats.items) == (7, 7, 7)
+    assert len(pipeline.summary()) == 3
+
+
+@pytest.mark.parametrize("failing_stage", ["load", "encode", "output"])
+def test_first_error_stops_the_pipeline(failing_stage):
+    encoded = []
+
+    def load(item):
+        if failing_stage == "load" and item == 2:
+            raise ValueError("bad audio")
+        return item
+
+    def encode(batch, loaded):
+        if failing_stage == "encode" and batch == [2]:
+            raise ValueError("bad audio")
+        encoded.append(batch)
+        return loaded
+
+    def output(batch, result):
+        if failing_stage == "output" and batch == [2]:
+            raise ValueError("bad audio")
+
+    pipeline = BatchPipeline(load, encode, output, num_workers=2, prefetch_batches=1)
+    with pytest.raises(ValueError, match="bad audio"):
+        pipeline.run([[i] for i in range(100)])
+    # the pipeline stopped instead of encoding the remaining batches
+    assert len(encoded) < 10
@@ -0,0 +1,69 @@
+import json
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.utils import profiling
+from model.utils.engine import ProcessInferenceEngine
+
+
+def _forward(model, x):
+    return model.encoder.forward_parallel_chunk(xs=[x], xs_origin_lens=torch.tensor([x.shape[0]], dtype=torch.int),
+                                                chunk_size=8, left_context_size=8, right_context_size=8,
+                                                offset=torch.zeros(1, dtype=torch.int))[0]
+
+
+@torch.no_grad()
+def test_encoder_stages_and_layers_are_profiled(tiny_model, tmp_path):
+    model, _ = tiny_model
+    x = torch.randn(300, 80)
+    expected = _forward(model, x)
+
+    profiler = profiling.start()
+    try:
+        with profiling.region("forward_parallel_chunk"):
+            output = _forward(model, x)
+    finally:
+        assert profiling.stop() is profiler
+    assert torch.equal(output, expected)
+
+    paths = [row["path"] for row in profiler.summary()]
+    assert paths[:4] == ["forward_parallel_chunk", "forward_parallel_chunk/chunk_unfold",
+                         "forward_parallel_chunk/subsampling", "forward_parallel_chunk/masks"]
+    assert paths[4:9] == ["forward_parallel_chunk/layer00"] + [
+        f"forward_parallel_chunk/layer00/{stage}" for stage in ("ffn_macaron", "attention", "conv", "ffn")]
+    stages = {row["path"]: row for row in profiler.summary(by_stage=True)}
+    assert stages["forward_parallel_chunk/layer*/attention"]["calls"] == model.encoder.num_blocks
+    assert 0 < stages["forward_parallel_chunk/layer*"]["percent"] <= 100
+
+    profiler.save(tmp_path)
+    trace = json.loads((tmp_path / "trace.json").read_text())
+    assert len(trace["traceEvents"]) == len(profiler.events)
+    assert "layer*" in (tmp_path / "summary.txt").read_text()
+
+
+def _toy_init():
+    return torch.nn.Linear(4, 2), {0: "<blank>"}
+
+
+def _profiled_job(model=None, char_dict=None):
+    with profiling.region("job"):
+        return os.getpid()
+
+
+def test_process_engine_workers_ship_their_regions_to_the_parent():
+    engine = ProcessInferenceEngine(max_queue_size=4, num_workers=1, threads_per_worker=1)
+    engine.load(_toy_init)
+    try:
+        engine.submit(_profiled_job).result(timeout=30)
+        profiler = profiling.start()
+        try:
+            pid = engine.submit(_profiled_job).result(timeout=30)
+        finally:
+            profiling.stop()
+    finally:
+        engine.stop()
+    assert [(event["name"], event["pid"]) for event in profiler.events] == [("job", pid)]
@@ -0,0 +1,106 @@
+import asyncio
+import hashlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.utils.result_cache import ResultCache, cache_key
+
+
+def test_key_depends_on_audio_and_parameters():
+    params = {"chunk_size": 64, "left_context_size": 128}
+    audio, other = hashlib.sha256(b"audio").hexdigest(), hashlib.sha256(b"other").hexdigest()
+    assert cache_key(audio, params) == cache_key(audio, dict(reversed(params.items())))
+    assert cache_key(audio, params) != cache_key(other, params)
+    assert cache_key(audio, params) != cache_key(audio, {**params, "chunk_size": 32})
+
+
+def test_memory_lru_falls_back_to_disk(tmp_path):
+    cache = ResultCache(tmp_path, max_entries=1)
+    cache.put("a" * 64, "first")
+    cache.put("b" * 64, ["second"])
+    assert cache.get_memory("a" * 64) is None
+    assert cache.get("a" * 64) == "first"
+
+    # a new process sees the disk tier
+    assert ResultCache(tmp_path).get("b" * 64) == ["second"]
+
+
+def test_disk_tier_is_size_bounded(tmp_path):
+    cache = ResultCache(tmp_path, max_entries=1, max_disk_bytes=250)
+    for i in range(5):
+        cache.put(f"{i:064d}", "x" * 100)
+    assert cache.stats()["disk_entries"] == 2
+    assert cache.get(f"{0:064d}") is None
+    assert cache.get(f"{4:064d}") == "x" * 100
+
+
+
+def test_disk_bound_covers_the_files_of_every_process(tmp_path):
+    api, worker = (ResultCache(tmp_path, max_entries=1, max_disk_bytes=250) for _ in range(2))
+    for i in range(6):
+        (api if i % 2 else worker).put(f"{i:064d}", "x" * 100)
+    assert sum(f.stat().st_size for f in tmp_path.glob("*/*.json")) <= 250
+    assert api.stats()["disk_entries"] == 2
+    # a file read by one process is kept over a later one when the other evicts
+    assert api.get(f"{4:064d}") == "x" * 100
+    worker.put(f"{6:064d}", "x" * 100)
+    assert worker.get(f"{5:064d}") is None
+    assert worker.get(f"{4:064d}") == "x" * 100
+
+
+def test_concurrent_duplicates_share_one_computation(tmp_path):
+    cache = ResultCache(tmp_path)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "decoded"
+
+    async def scenario():
+        return await asyncio.gather(*(cache.get_or_compute("k" * 64, compute) for _ in range(5)))
+
+    assert asyncio.run(scenario()) == ["decoded"] * 5
+    assert calls == [1]
+
+
+def test_waiter_takes_over_when_the_computing_request_is_cancelled(tmp_path):
+    cache = ResultCache(tmp_path)
+    calls = []
+
+    async def compute(name):
+        calls.append(name)
+        await asyncio.sleep(0.05)
+        return f"decoded by {name}"
+
+    async def scenario():
+        leader = asyncio.create_task(cache.get_or_compute("k" * 64, lambda: compute("leader")))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(cache.get_or_compute("k" * 64, lambda: compute("waiter")))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await waiter
+
+    assert asyncio.run(scenario()) == "decoded by waiter"
+    assert calls == ["leader", "waiter"]
+    assert cache.get("k" * 64) == "decoded by waiter"
+
+
+def test_failures_are_not_cached(tmp_path):
+    cache = ResultCache(tmp_path)
+
+    async def failing():
+        raise ValueError("bad audio")
+
+    async def succeeding():
+        return "decoded"
+
+    with pytest.raises(ValueError):
+        asyncio.run(cache.get_or_compute("k" * 64, failing))
+    assert asyncio.run(cache.get_or_compute("k" * 64, succeeding)) == "decoded"
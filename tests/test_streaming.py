@@ -0,0 +1,101 @@
+import torch
+
+from model.utils.features import FbankStream, compute_fbank
+from model.utils.streaming import StreamingSession
+
+
+def encode_full(model, feats, chunk_size, left_context_size, right_context_size):
+    with torch.no_grad():
+        outs, lens, n_chunks, _, _, _ = model.encoder.forward_parallel_chunk(
+            xs=[feats],
+            xs_origin_lens=torch.tensor([feats.shape[0]], dtype=torch.int),
+            chunk_size=chunk_size,
+            left_context_size=left_context_size,
+            right_context_size=right_context_size,
+            offset=torch.zeros(1, dtype=torch.int))
+    return outs.reshape(-1, outs.shape[-1])[:lens[0]]
+
+
+def test_fbank_stream_matches_whole_recording():
+    torch.manual_seed(0)
+    waveform = torch.randn(1, 16000 * 3) * 3000
+    stream = FbankStream()
+    pieces = [stream.accept_waveform(piece) for piece in torch.split(waveform, 1234, dim=1)]
+    feats = torch.cat([piece for piece in pieces if piece is not None])
+    assert torch.allclose(feats, compute_fbank(waveform), atol=1e-4)
+
+
+def test_streaming_with_full_lookahead_matches_offline_encoder(tiny_model, monkeypatch):
+    """With the encoder's full relative right context as lookahead, streaming is exact."""
+    model, char_dict = tiny_model
+    torch.manual_seed(1)
+    waveform = torch.randn(1, 16000 * 20) * 3000
+
+    streamed = []
+    ctc_forward = model.encoder.ctc_forward
+
+    def spy(xs, *args, **kwargs):
+        streamed.append(xs.reshape(-1, xs.shape[-1]))
+        return ctc_forward(xs, *args, **kwargs)
+
+    monkeypatch.setattr(model.encoder, "ctc_forward", spy)
+
+    chunk = 16
+    num_blocks = model.encoder.num_blocks
+    session = StreamingSession(chunk, chunk, chunk, decoding_window=chunk,
+                               lookahead=chunk + chunk * (num_blocks - 1))
+    events = []
+    for piece in torch.split(waveform, 3200, dim=1):
+        events += session.accept_waveform(piece, model=model, char_dict=char_dict)
+    events += session.finalize(model=model, char_dict=char_dict)
+
+    expected = encode_full(model, compute_fbank(waveform), chunk, chunk, chunk)
+    assert torch.allclose(torch.cat(streamed), expected, atol=1e-4)
+    assert events and events[-1]["type"] == "segment"
+
+
+def test_parked_session_resumes_where_it_left_off(tiny_model):
+    """Caches are updated in place on the device and only leave it when the session is parked."""
+    model, char_dict = tiny_model
+    torch.manual_seed(2)
+    waveform = torch.randn(1, 16000 * 12) * 3000
+
+    def transcribe(park):
+        session = StreamingSession(16, 16, 16, decoding_window=16, lookahead=32)
+        events, buffers = [], set()
+        for piece in torch.split(waveform, 8000, dim=1):
+            events += session.accept_waveform(piece, model=model, char_dict=char_dict)
+            buffers.add(session.cache.att_cache.data_ptr())
+            if park:
+                session.park()
+        events += session.finalize(model=model, char_dict=char_dict)
+        return events, buffers
+
+    events, buffers = transcribe(park=False)
+    assert len(buffers) == 1
+    assert transcribe(park=True)[0] == events
+
+
+def test_caller_caches_are_only_overwritten_on_request(tiny_model):
+    model, _ = tiny_model
+    torch.manual_seed(3)
+    feats = torch.randn(600, 80)
+    encoder = model.encoder
+    att_cache = torch.randn(encoder.num_blocks, 16, encoder.attention_heads,
+                            encoder._output_size * 2 // encoder.attention_heads)
+    cnn_cache = torch.randn(encoder.num_blocks, encoder._output_size, encoder.cnn_module_kernel // 2)
+
+    def encode(att, cnn, in_place):
+        with torch.no_grad():
+            return encoder.forward_parallel_chunk(
+                xs=feats.unsqueeze(0), xs_origin_lens=torch.tensor([feats.shape[0]], dtype=torch.int),
+                chunk_size=16, left_context_size=16, right_context_size=16, att_cache=att, cnn_cache=cnn,
+                truncated_context_size=32, offset=torch.zeros(1, dtype=torch.int), update_caches_in_place=in_place)
+
+    att, cnn = att_cache.clone(), cnn_cache.clone()
+    _, _, _, new_att, new_cnn, _ = encode(att, cnn, in_place=False)
+    assert torch.equal(att, att_cache) and torch.equal(cnn, cnn_cache)
+
+    _, _, _, updated_att, updated_cnn, _ = encode(att, cnn, in_place=True)
+    assert updated_att is att and updated_cnn is cnn
+    assert torch.equal(att, new_att) and torch.equal(cnn, new_cnn)
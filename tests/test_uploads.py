@@ -0,0 +1,61 @@
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.utils.audio import decode_audio_bytes
+from model.utils.features import compute_fbank
+from model.utils.uploads import UploadDecoder
+from test_audio import make_wav
+
+
+def feed_in_pieces(decoder, content, size):
+    for start in range(0, len(content), size):
+        decoder.feed(content[start:start + size])
+    return decoder.finish()
+
+
+@pytest.mark.parametrize("piece_size", [50, 65536])
+def test_wav_features_match_decoding_the_whole_file(tmp_path, piece_size):
+    content = (Path(__file__).parent / "test1.wav").read_bytes()
+    feats = feed_in_pieces(UploadDecoder("test1.wav", tmp_path), content, piece_size)
+
+    expected = compute_fbank(decode_audio_bytes(content, "test1.wav"))
+    assert feats.shape == expected.shape
+    assert torch.allclose(feats, expected, atol=1e-3)
+    assert not any(tmp_path.iterdir())
+
+
+def test_other_sample_rates_are_resampled(tmp_path):
+    samples = (np.sin(np.arange(8000) / 10) * 10000).astype(np.int16)[:, None]
+    content = make_wav(samples, 8000)
+    feats = feed_in_pieces(UploadDecoder("a.wav", tmp_path), content, 333)
+    expected = compute_fbank(decode_audio_bytes(content, "a.wav"))
+    assert torch.allclose(feats, expected, atol=1e-3)
+
+
+@pytest.mark.parametrize("data_size", [0, 0xFFFFFFFF])
+def test_streamed_wav_without_data_size_is_read_to_the_end(tmp_path, data_size):
+    content = (Path(__file__).parent / "test1.wav").read_bytes()
+    expected = compute_fbank(decode_audio_bytes(content, "test1.wav"))
+    size_offset = content.index(b"data") + 4
+    content = content[:size_offset] + data_size.to_bytes(4, "little") + content[size_offset + 4:]
+
+    feats = feed_in_pieces(UploadDecoder("test1.wav", tmp_path), content, 4096)
+    assert torch.allclose(feats, expected, atol=1e-3)
+
+
+def test_unknown_formats_are_spooled_for_ffmpeg(tmp_path):
+    content = b"ID3" + bytes(range(256)) * 10
+    decoder = UploadDecoder("a.mp3", tmp_path)
+    assert feed_in_pieces(decoder, content, 100) is None
+    assert decoder.spool_path.read_bytes() == content
+    assert decoder.size == len(content)
+
+    decoder.close()
+    assert not decoder.spool_path.exists()
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.utils.features import compute_fbank
+from model.utils.vad import EnergyVAD, collapse, expand_hyps, speech_regions
+
+
+def test_energy_vad_finds_speech_between_silences():
+    rng = np.random.default_rng(0)
+    quiet = lambda seconds: rng.standard_normal(16000 * seconds) * 10
+    loud = lambda seconds: rng.standard_normal(16000 * seconds) * 3000
+    waveform = np.concatenate([quiet(3), loud(2), quiet(1), loud(1), quiet(4)]).astype(np.float32)
+    feats = compute_fbank(torch.from_numpy(waveform).unsqueeze(0))
+
+    regions = speech_regions(EnergyVAD()(feats), min_silence=150, padding=30, align=8)
+    # the 1 s pause is shorter than min_silence once padded, so it is kept
+    assert len(regions) == 1
+    start, end = regions[0]
+    assert start % 8 == 0 and 260 <= start <= 272
+    assert 700 <= end <= 744
+    assert collapse(feats, regions).shape[0] == end - start
+
+
+def test_speech_regions_merge_short_gaps_and_align():
+    speech = torch.zeros(1000, dtype=torch.bool)
+    speech[100:200] = True
+    speech[230:300] = True
+    speech[600:700] = True
+    assert speech_regions(speech, min_silence=50, padding=10, align=8) == [(88, 312), (584, 712)]
+    assert speech_regions(torch.zeros(50, dtype=torch.bool), min_silence=50, padding=10) == []
+
+
+def test_hyps_are_put_back_in_original_time():
+    regions = [(16, 40), (80, 96)]
+    hyps = torch.tensor([1, 2, 3, 4, 5])
+    assert expand_hyps(hyps, regions, subsampling=8, num_frames=13).tolist() == [0, 0, 1, 2, 3, 0, 0, 0, 0, 0, 4, 5, 0]
+
+
+def test_energy_vad_accepts_empty_features():
+    assert EnergyVAD()(torch.zeros(0, 80)).shape == (0,)
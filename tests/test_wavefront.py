@@ -0,0 +1,33 @@
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model.utils.multi_stream import MultiStreamDecoder, window_size
+from model.utils.wavefront import WavefrontDecoder, layer_lookahead
+
+
+def test_layer_by_layer_decoding_matches_encoding_in_one_piece(tiny_model):
+    model, _ = tiny_model
+    torch.manual_seed(2)
+    feats = torch.randn(7001, 80)
+    # small right context: a chunk's convolution needs the next chunk's attention output
+    for chunk_size, right_context_size in ((8, 16), (16, 4)):
+        whole = MultiStreamDecoder(model, chunk_size=chunk_size, left_context_size=32,
+                                   right_context_size=right_context_size,
+                                   window=window_size(1000, chunk_size, subsampling=8))
+        whole.add(feats)
+        expected = whole.run()[0]
+        assert layer_lookahead(model, chunk_size, right_context_size) == (24 if chunk_size == 8 else 32)
+
+        for window, piece in ((chunk_size, 7001), (8 * chunk_size, 555)):
+            decoder = WavefrontDecoder(model, chunk_size=chunk_size, left_context_size=32,
+                                       right_context_size=right_context_size, window=window)
+            tokens = [decoder.accept(x) for x in feats.split(piece)]
+            # tokens come out while the features arrive; each layer only holds about a window and its lookahead
+            assert sum(t.shape[0] for t in tokens) > 0
+            assert max(decoder.pending_frames()[1:]) <= 2 * window + decoder.lookahead
+            tokens.append(decoder.finalize())
+            assert torch.equal(torch.cat(tokens), expected)